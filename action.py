@@ -1,32 +1,74 @@
-import pandas as pd
-import numpy as np
 import sys
 
+
+# Confidence cut-offs: above ALERT_THRESHOLD an agent is alerted, from LOCK_THRESHOLD on the user is locked as well.
+ALERT_THRESHOLD = 0.6
+LOCK_THRESHOLD = 0.9
+DECISIONS = ['NOTHING: NON-FRAUDSTER',
+             'ALERT AGENT: POSSIBLE FRAUDSTER',
+             'LOCK AND ALERT AGENT: LIKELY FRAUDSTER']
+
+INDEX_PATH = 'predictions.idx'
+_index = None
+
+
+def action_code(c):
+    """
+    Index into DECISIONS for one confidence.
+    """
+
+    return 0 if c <= ALERT_THRESHOLD else 1 if (c > ALERT_THRESHOLD and c < LOCK_THRESHOLD) else 2
+
+
+def action_codes(confidences):
+    """
+    Vectorized action_code.
+    """
+
+    import numpy as np
+
+    c = np.asarray(confidences)
+    return np.where(c <= ALERT_THRESHOLD, 0, np.where(c < LOCK_THRESHOLD, 1, 2)).astype('uint8')
+
+
+def open_index(path=INDEX_PATH):
+    """
+    Opens the decision index written by test.py (see decision_index.py) for patrol.
+    """
+
+    global _index
+    from decision_index import DecisionIndex
+    _index = DecisionIndex(path)
+    return _index
+
+
 def patrol(ID):
-    return decision_dict[ID]
+    """
+    The decision for user ID. Raises KeyError, 'unknown user' or 'invalid user id', when there is none.
+    """
+
+    if _index is None:
+        open_index()
+    try:
+        found = _index.lookup(ID)
+    except ValueError:
+        raise KeyError('invalid user id') from None
+    if found is None:
+        raise KeyError('unknown user')
+    return DECISIONS[found[0]]
+
 
 if __name__ == '__main__':
-    
+
     try:
-        predictions = pd.read_csv('predictions.csv')
-    except:
+        open_index()
+    except (OSError, ValueError):
         print('Predictions file not found. Please generate the predictions first via test.py')
         sys.exit(0)
-    
-    decision = ['NOTHING: NON-FRAUDSTER' if c <= 0.6
-            else 'ALERT AGENT: POSSIBLE FRAUDSTER' if (c > 0.6 and c < 0.9)
-            else 'LOCK AND ALERT AGENT: LIKELY FRAUDSTER'
-            for c in predictions['Confidence'].values]
-        
-    # Make dictionary:
-    decision_dict = dict(zip(list(predictions['ID']), decision))
-    
+
     ID = input('Please enter the user ID')
-    
-    print(patrol(ID))
-    
-    
-    
-    
-    
-    
\ No newline at end of file
+
+    try:
+        print(patrol(ID))
+    except KeyError as e:
+        print('{}: {}'.format(e.args[0].capitalize(), ID))
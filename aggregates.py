@@ -0,0 +1,155 @@
+import numpy as np
+import pandas as pd
+
+from fx import to_timestamps
+
+
+# Attributes for which we keep the value a user transacts with most often (see max_count_extractor).
+MODE_ATTRIBUTES = ['MERCHANT_COUNTRY', 'SOURCE', 'TYPE']
+
+
+def group_starts(sorted_codes):
+    """
+    Positions at which a new group starts in an array of sorted integer codes.
+    """
+
+    return np.flatnonzero(np.diff(sorted_codes, prepend=sorted_codes[:1] - 1))
+
+
+def factorize_sorted(values):
+    """
+    pd.factorize(values, sort=True), except that categoricals are also sorted by value rather than by category order.
+    """
+
+    codes, uniques = pd.factorize(values)
+    uniques = np.asarray(uniques, dtype=object)
+    order = np.argsort(uniques, kind='stable')
+    # The extra trailing entry is picked up by the -1 code of missing values.
+    rank = np.empty(len(order) + 1, dtype='int64')
+    rank[order], rank[-1] = np.arange(len(order)), -1
+    return rank[codes], uniques[order]
+
+
+def count_values(user_codes, user_ids, values):
+    """
+    Number of transactions per user and non-null value, as a USER_ID, VALUE, COUNT frame.
+    """
+
+    codes, uniques = pd.factorize(values)
+    valid = codes >= 0
+    keys = user_codes[valid].astype('int64') * len(uniques) + codes[valid]
+    keys, counts = np.unique(keys, return_counts=True)
+    return pd.DataFrame({'USER_ID': np.asarray(user_ids, dtype=object)[keys // len(uniques)],
+                         'VALUE': np.asarray(uniques, dtype=object)[keys % len(uniques)],
+                         'COUNT': counts})
+
+
+def top_counts(users, vals, counts):
+    """
+    For (user, value, count) rows of integer codes, the value with the highest count for every user. Ties go to the
+    smallest value code so the result is deterministic. Returns the users and their values.
+    """
+
+    # Sort by user, then count descending, then value, and keep the first row of every user.
+    order = np.lexsort((vals, -counts, users))
+    users, vals = users[order], vals[order]
+    first = group_starts(users)
+    return users[first], vals[first]
+
+
+def mode_from_counts(counts, user_ids):
+    """
+    Most frequent value per user in user_ids from a count_values frame (ties go to the smallest value).
+    Users without any non-null value get NaN.
+    """
+
+    users = pd.Index(user_ids).get_indexer(counts['USER_ID'])
+    vals, uniques = pd.factorize(counts['VALUE'], sort=True)
+    users, vals = top_counts(users, vals, counts['COUNT'].values)
+
+    res = np.full(len(user_ids), np.nan, dtype=object)
+    res[users] = np.asarray(uniques, dtype=object)[vals]
+    return res
+
+
+def partial_aggregates(df_transactions, fx_index):
+    """
+    Mergeable per-user aggregates of a set of transactions (a whole table or one chunk of it): value counts for the
+    MODE_ATTRIBUTES and, per user, the first transaction, the largest USD amount and the number of transactions.
+    Combine several with merge_partials and turn them into features input with finalize.
+    """
+
+    user_codes, user_ids = pd.factorize(df_transactions['USER_ID'])
+    ts = to_timestamps(df_transactions['CREATED_DATE'])
+    amount_usd = fx_index.to_usd(df_transactions['AMOUNT'].values, df_transactions['CURRENCY'],
+                                 ts.view('datetime64[ns]'))
+
+    # One sort by (user, time): the group starts give the first transactions and reduceat gives the rest.
+    order = np.lexsort((ts, user_codes))
+    starts = group_starts(user_codes[order])
+    first = order[starts]
+
+    users = pd.DataFrame({'FIRST_TS': ts[first],
+                          'FIRST_STATE': df_transactions['STATE'].values[first],
+                          'FIRST_AMOUNT_USD': amount_usd[first],
+                          'AMOUNT_USD': np.fmax.reduceat(amount_usd[order], starts),
+                          'N_TRANSACTIONS': np.diff(np.r_[starts, len(order)])},
+                         index=pd.Index(user_ids, name='USER_ID'))
+    counts = {attr: count_values(user_codes, user_ids, df_transactions[attr].values) for attr in MODE_ATTRIBUTES}
+    return {'users': users, 'counts': counts}
+
+
+def merge_partials(partials):
+    """
+    Combines partial aggregates of disjoint sets of transactions. On equal timestamps the first transaction of the
+    earlier partial wins, so merging chunks in file order gives the same result as aggregating the whole file.
+    """
+
+    users = pd.concat([p['users'] for p in partials]).reset_index()
+    first = users.sort_values('FIRST_TS', kind='mergesort').drop_duplicates('USER_ID').set_index('USER_ID')
+    totals = users.groupby('USER_ID', sort=False).agg({'AMOUNT_USD': 'max', 'N_TRANSACTIONS': 'sum'})
+
+    users = first[['FIRST_TS', 'FIRST_STATE', 'FIRST_AMOUNT_USD']].join(totals)
+    counts = {attr: pd.concat([p['counts'][attr] for p in partials])
+                      .groupby(['USER_ID', 'VALUE'], sort=False)['COUNT'].sum().reset_index()
+              for attr in MODE_ATTRIBUTES}
+    return {'users': users, 'counts': counts}
+
+
+def finalize(partial):
+    """
+    The per-user aggregates the features need (see aggregate_users) from a partial.
+    """
+
+    users = partial['users']
+    res = pd.DataFrame({attr: mode_from_counts(partial['counts'][attr], users.index) for attr in MODE_ATTRIBUTES},
+                       index=users.index)
+    for c in ['FIRST_STATE', 'FIRST_AMOUNT_USD', 'AMOUNT_USD', 'N_TRANSACTIONS']:
+        res[c] = users[c]
+    return res
+
+
+def aggregate_users(df_transactions, fx_index):
+    """
+    Every per-user transaction aggregate the features need, computed in one scan over the transactions:
+    the most frequent MERCHANT_COUNTRY, SOURCE and TYPE, the state and USD amount of the first transaction,
+    the largest USD amount and the number of transactions. Indexed by USER_ID; users without transactions are absent.
+    """
+
+    return finalize(partial_aggregates(df_transactions, fx_index))
+
+
+def aggregate_chunks(chunks, fx_index, transform=None, merge_every=16):
+    """
+    aggregate_users over an iterable of transaction chunks (e.g. pd.read_csv with chunksize) without ever holding
+    more than one chunk. Partials are folded together every merge_every chunks to keep their memory bounded too.
+    """
+
+    partials = []
+    for chunk in chunks:
+        if transform is not None:
+            chunk = transform(chunk)
+        partials.append(partial_aggregates(chunk, fx_index))
+        if len(partials) >= merge_every:
+            partials = [merge_partials(partials)]
+    return finalize(merge_partials(partials))
@@ -0,0 +1,237 @@
+import argparse
+import datetime
+import json
+import os
+import pickle
+import platform
+import subprocess
+import sys
+import tempfile
+from time import perf_counter
+
+import numpy as np
+import pandas as pd
+import sklearn
+from sklearn.ensemble import RandomForestClassifier
+
+from aggregates import aggregate_users
+from fx import FxRateIndex
+from generate_features import generate_features
+from instrumentation import rss, peak_rss, reset_peak_rss
+from synthetic import synthetic_tables, write_tables
+from transformations import (transform_part1, query2, countries_match, is_MINOS, TRANSACTION_TYPE, ID_CHECK,
+                             KYC_transform, date_to_numerical, terms_version_boolean)
+
+
+RESULTS_DIR = 'benchmarks'
+SIZES = [10000, 100000, 1000000, 10000000]
+
+
+def measure(fn):
+    """
+    Runs fn and returns its result with the wall time, the peak RSS during the call and the RSS it left behind.
+    """
+
+    per_stage = reset_peak_rss()
+    before = rss()
+    start = perf_counter()
+    out = fn()
+    seconds = perf_counter() - start
+    after = rss()
+    stats = {'seconds': seconds, 'peak_rss_mb': peak_rss() / 2 ** 20, 'peak_rss_per_stage': per_stage}
+    if before is not None and after is not None:
+        stats['rss_delta_mb'] = (after - before) / 2 ** 20
+    return out, stats
+
+
+def load_classifier(X, y):
+    """
+    The shipped random forest, or a stand-in trained on the synthetic features when it cannot be unpickled with the
+    installed scikit-learn (the timings of predict_proba are what matters here, not the predictions).
+    """
+
+    try:
+        with open('models/rf_clf.pkl', 'rb') as f:
+            return pickle.load(f), 'models/rf_clf.pkl'
+    except Exception:
+        clf = RandomForestClassifier(n_estimators=100, random_state=0, n_jobs=-1)
+        return clf.fit(X, y), 'stand-in RandomForestClassifier(n_estimators=100)'
+
+
+def run_size(n_transactions, seed, stages, directory):
+    """
+    Generates one synthetic data set and times every stage of the pipeline on it. Stages that fail are recorded with
+    their error and the others still run.
+    """
+
+    raw = synthetic_tables(n_transactions, seed=seed)
+    files = write_tables(raw, directory)
+    ctx = {}
+
+    def read_csv():
+        return (pd.read_csv(files['transactions'], index_col=0), pd.read_csv(files['users'], index_col=0),
+                pd.read_csv(files['fraudsters'], index_col=0), pd.read_csv(files['countries'], index_col=False),
+                pd.read_csv(files['fx'], index_col=False), pd.read_csv(files['currency'], index_col=False))
+
+    def part1():
+        r = ctx['raw']
+        ctx['tables'] = transform_part1(r['transactions'], r['users'], r['countries'], r['fx'], r['currency'],
+                                        df_f=r['fraudsters'], test_time=False)
+
+    def generate():
+        df_t, df_u, df_fx, df_c = ctx['tables']
+        ctx['X'], ctx['y'] = generate_features(df_t, df_u.copy(), df_fx, df_c, test_time=False)
+
+    def classifier():
+        if 'clf' not in ctx:
+            ctx['clf'], ctx['model'] = load_classifier(ctx['X'], ctx['y'])
+
+    # Untimed setup giving the stages that modify their inputs fresh copies.
+    raw_copy = lambda: ctx.update(raw={table: df.copy() for table, df in raw.items()})
+    users_copy = lambda: ctx.update(u=ctx['tables'][1].copy())
+    t = lambda: ctx['tables'][0]
+    fx_index = lambda: FxRateIndex.from_frames(ctx['tables'][2], ctx['tables'][3])
+
+    pipeline = [
+        ('read_csv', None, read_csv),
+        ('transform_part1', raw_copy, part1),
+        ('query2', users_copy, lambda: query2(ctx['u'], t(), ctx['tables'][2], ctx['tables'][3])),
+        ('countries_match', users_copy, lambda: countries_match(ctx['u'], t())),
+        ('is_MINOS', users_copy, lambda: is_MINOS(ctx['u'], t())),
+        ('TRANSACTION_TYPE', users_copy, lambda: TRANSACTION_TYPE(ctx['u'], t())),
+        ('ID_CHECK', users_copy, lambda: ID_CHECK(ctx['u'], t())),
+        ('KYC_transform', users_copy, lambda: KYC_transform(ctx['u'])),
+        ('date_to_numerical', users_copy, lambda: date_to_numerical(ctx['u'])),
+        ('terms_version_boolean', users_copy, lambda: terms_version_boolean(ctx['u'])),
+        ('aggregate_users', None, lambda: aggregate_users(t(), fx_index())),
+        ('generate_features', None, generate),
+        ('predict_proba', classifier, lambda: ctx['clf'].predict_proba(ctx['X'])),
+    ]
+
+    results = {}
+    for name, setup, fn in pipeline:
+        selected = not stages or name in stages
+        # The later stages still need the tables and the features, so those two run untimed when not selected.
+        if not selected and name not in ('transform_part1', 'generate_features'):
+            continue
+        try:
+            if setup is not None:
+                setup()
+            if not selected:
+                fn()
+                continue
+            _, results[name] = measure(fn)
+        except Exception as e:
+            results[name] = {'error': '{}: {}'.format(type(e).__name__, e)}
+        if name in results:
+            print('  {:<22} {}'.format(name, format_stage(results[name])), flush=True)
+
+    return {'n_transactions': n_transactions,
+            'n_users': len(raw['users']),
+            'model': ctx.get('model'),
+            'stages': results}
+
+
+def format_stage(stats):
+    if 'error' in stats:
+        return 'failed: ' + stats['error']
+    return '{:9.3f} s {:9.1f} MB peak'.format(stats['seconds'], stats['peak_rss_mb'])
+
+
+def scaling(runs):
+    """
+    Slope of log(time) against log(rows) per stage between consecutive sizes: ~1 is linear, ~2 quadratic.
+    """
+
+    res = {}
+    for name in runs[0]['stages']:
+        points = [(r['n_transactions'], r['stages'][name]['seconds']) for r in runs
+                  if 'seconds' in r['stages'].get(name, {})]
+        res[name] = [np.log(t2 / t1) / np.log(n2 / n1) if t1 > 0 else None
+                     for (n1, t1), (n2, t2) in zip(points, points[1:])]
+    return res
+
+
+def git_commit():
+    """
+    Short hash of the checked out commit of this repository, marked dirty when tracked files have local changes.
+    """
+
+    repo = os.path.dirname(os.path.abspath(__file__))
+    try:
+        out = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=repo, capture_output=True, text=True,
+                             check=True)
+        dirty = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=repo,
+                               capture_output=True, text=True).stdout.strip()
+        return out.stdout.strip() + ('-dirty' if dirty else '')
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def compare(old_path, new_path, threshold=1.2):
+    """
+    Prints the time ratio new/old for every size and stage both result files have, flagging the ones slower by more
+    than threshold. Returns the number of flagged stages.
+    """
+
+    with open(old_path) as f:
+        old = json.load(f)
+    with open(new_path) as f:
+        new = json.load(f)
+    print('{} -> {}'.format(old['commit'], new['commit']))
+
+    old_runs = {r['n_transactions']: r['stages'] for r in old['runs']}
+    regressions = 0
+    for run in new['runs']:
+        n = run['n_transactions']
+        if n not in old_runs:
+            continue
+        for name, stats in run['stages'].items():
+            before = old_runs[n].get(name, {})
+            if 'seconds' not in stats or 'seconds' not in before:
+                continue
+            ratio = stats['seconds'] / before['seconds'] if before['seconds'] else float('inf')
+            flag = ' <-- slower' if ratio > threshold else ''
+            regressions += ratio > threshold
+            print('{:>10} {:<22} {:9.3f} s -> {:9.3f} s  x{:.2f}{}'.format(n, name, before['seconds'],
+                                                                        stats['seconds'], ratio, flag))
+    return regressions
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Times every stage of the pipeline on synthetic data of growing size.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=SIZES, help='numbers of transactions')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--stages', nargs='+', default=None, help='only run these stages')
+    parser.add_argument('--output', default=None, help='results file (default benchmarks/<commit>.json)')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'), default=None,
+                        help='compare two results files instead of running')
+    parser.add_argument('--threshold', type=float, default=1.2, help='slowdown ratio flagged by --compare')
+    args = parser.parse_args()
+
+    if args.compare:
+        sys.exit(1 if compare(*args.compare, threshold=args.threshold) else 0)
+
+    commit = git_commit()
+    runs = []
+    for n in args.sizes:
+        print('{} transactions'.format(n), flush=True)
+        with tempfile.TemporaryDirectory() as directory:
+            runs.append(run_size(n, args.seed, args.stages, directory))
+
+    results = {'commit': commit,
+               'date': datetime.datetime.now().isoformat(timespec='seconds'),
+               'seed': args.seed,
+               'machine': {'platform': platform.platform(), 'processor': platform.processor(),
+                           'cpus': os.cpu_count()},
+               'versions': {'python': platform.python_version(), 'numpy': np.__version__, 'pandas': pd.__version__,
+                            'sklearn': sklearn.__version__},
+               'runs': runs,
+               'scaling': scaling(runs)}
+
+    output = args.output or os.path.join(RESULTS_DIR, commit + '.json')
+    os.makedirs(os.path.dirname(output) or '.', exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=1)
+    print('Results written to ' + output)
@@ -0,0 +1,194 @@
+import contextlib
+import hashlib
+import json
+import os
+import shutil
+
+import numpy as np
+import pandas as pd
+
+import fx
+import transformations
+from fx import to_timestamps
+from transformations import transform_part1, compact_transactions, compact_users, uuid_halves
+
+
+CACHE_DIR = 'cache'
+TABLES = ['transactions', 'users', 'fx', 'currency']
+
+# Marker file of a directory written by written_directory.
+COMPLETE = 'complete'
+
+# Timestamp columns are stored as datetime64 instead of strings.
+DATETIME_COLUMNS = {'transactions': ['CREATED_DATE'], 'users': ['CREATED_DATE'], 'fx': ['TS']}
+
+# Columns loaded as their 128 bits in compact mode (see transformations.compact_transactions).
+UUID_COLUMNS = {'transactions': ['ID']}
+
+TRAIN_FILES = {'transactions': 'train/train_transactions.csv',
+               'users': 'train/train_users.csv',
+               'fraudsters': 'train/train_fraudsters.csv',
+               'countries': 'train/countries.csv',
+               'fx': 'train/fx_rates.csv',
+               'currency': 'train/currency_details.csv'}
+
+TEST_FILES = {'transactions': 'test_transactions.csv',
+              'users': 'test_users.csv',
+              'countries': 'train/countries.csv',
+              'fx': 'train/fx_rates.csv',
+              'currency': 'train/currency_details.csv'}
+
+
+def source_key(files, test_time, modules=(transformations.__file__, fx.__file__, __file__)):
+    """
+    Hash of the source files' contents, the mode and the modules the tables are built with (transformations.py, fx.py
+    and this one), so editing any of them invalidates the cache.
+    """
+
+    h = hashlib.sha256(str(test_time).encode())
+    for path in sorted(files.values()) + list(modules):
+        h.update(path.encode())
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                h.update(block)
+    return h.hexdigest()[:16]
+
+
+@contextlib.contextmanager
+def written_directory(directory):
+    """
+    Yields a temporary directory to write the contents of directory into. When the block finishes, a COMPLETE marker
+    is written last and the temporary directory replaces directory, so a reader checking is_complete never sees a
+    partly written directory and an interrupted write leaves the previous contents in place.
+    """
+
+    tmp = directory + '.tmp'
+    if os.path.exists(tmp):
+        shutil.rmtree(tmp)
+    os.makedirs(tmp)
+    yield tmp
+    open(os.path.join(tmp, COMPLETE), 'w').close()
+
+    if os.path.exists(directory):
+        os.rename(directory, directory + '.old')
+    os.rename(tmp, directory)
+    if os.path.exists(directory + '.old'):
+        shutil.rmtree(directory + '.old')
+
+
+def is_complete(directory):
+    return os.path.exists(os.path.join(directory, COMPLETE))
+
+
+def save_table(df, directory):
+    """
+    One .npy file per column. Numeric, boolean and datetime columns are stored as they are; string columns as int32
+    codes plus a fixed-width unicode array of the distinct values, so nothing needs unpickling.
+    """
+
+    os.makedirs(directory)
+    columns = []
+    for i, name in enumerate(df.columns):
+        base = os.path.join(directory, str(i))
+        if df[name].dtype == object:
+            codes, uniques = pd.factorize(df[name])
+            np.save(base + '.codes.npy', codes.astype('int32'))
+            np.save(base + '.uniques.npy', np.asarray(uniques, dtype=str))
+            columns.append({'name': name, 'kind': 'string'})
+        else:
+            np.save(base + '.npy', df[name].values)
+            columns.append({'name': name, 'kind': 'array', 'dtype': str(df[name].dtype)})
+    with open(os.path.join(directory, 'columns.json'), 'w') as f:
+        json.dump(columns, f)
+
+
+def read_blocks(path, rows=1 << 16):
+    """
+    The array of a .npy file in blocks of rows, read one at a time.
+    """
+
+    with open(path, 'rb') as f:
+        version = np.lib.format.read_magic(f)
+        read_header = np.lib.format.read_array_header_1_0 if version == (1, 0) else np.lib.format.read_array_header_2_0
+        shape, _, dtype = read_header(f)
+        for start in range(0, shape[0], rows):
+            yield np.fromfile(f, dtype=dtype, count=min(rows, shape[0] - start))
+
+
+def load_table(directory, compact=False, uuids=()):
+    """
+    Reads a table written by save_table. Array columns are memory-mapped, string columns are rebuilt from their codes,
+    or with compact become categoricals of those codes without building a string per row. With compact the uuids
+    columns are decoded to their <name>_HI and <name>_LO halves instead (see transformations.uuid_halves).
+    """
+
+    with open(os.path.join(directory, 'columns.json')) as f:
+        columns = json.load(f)
+
+    data = {}
+    for i, column in enumerate(columns):
+        base = os.path.join(directory, str(i))
+        if column['kind'] == 'string' and compact:
+            codes = np.load(base + '.codes.npy', mmap_mode='r')
+            halves = None
+            if column['name'] in uuids and not (codes < 0).any():
+                # Decoded block by block, so the strings are never all in memory at once. Ids that are not all UUIDs
+                # stay a categorical.
+                try:
+                    halves = [uuid_halves(block) for block in read_blocks(base + '.uniques.npy')]
+                except ValueError:
+                    pass
+            if halves is not None:
+                hi, lo = [np.concatenate([h[k] for h in halves] or [np.zeros(0, dtype='uint64')]) for k in (0, 1)]
+                data[column['name'] + '_HI'], data[column['name'] + '_LO'] = hi[codes], lo[codes]
+            else:
+                uniques = np.load(base + '.uniques.npy').astype(object)
+                data[column['name']] = pd.Categorical.from_codes(codes, uniques)
+        elif column['kind'] == 'string':
+            codes = np.load(base + '.codes.npy', mmap_mode='r')
+            # The trailing NaN is picked up by the -1 code of missing values.
+            uniques = np.append(np.load(base + '.uniques.npy').astype(object), np.nan)
+            data[column['name']] = uniques[codes]
+        else:
+            data[column['name']] = np.load(base + '.npy', mmap_mode='r')
+    return pd.DataFrame(data, columns=list(data), copy=False)
+
+
+def read_tables(files, test_time):
+    df_t = pd.read_csv(files['transactions'], index_col=0)
+    df_u = pd.read_csv(files['users'], index_col=0)
+    df_f = None if test_time else pd.read_csv(files['fraudsters'], index_col=0)
+    df_countries = pd.read_csv(files['countries'], index_col=False)
+    df_fx = pd.read_csv(files['fx'], index_col=False)
+    df_c = pd.read_csv(files['currency'], index_col=False)
+
+    tables = transform_part1(df_t, df_u, df_countries, df_fx, df_c, df_f=df_f, test_time=test_time)
+    tables = {table: df.reset_index(drop=True) for table, df in zip(TABLES, tables)}
+    for table, names in DATETIME_COLUMNS.items():
+        for name in names:
+            tables[table][name] = to_timestamps(tables[table][name]).view('datetime64[ns]')
+    return tables
+
+
+def load_tables(files=TEST_FILES, test_time=True, cache_dir=CACHE_DIR, compact=False):
+    """
+    The transactions, users, fx and currency tables after transform_part1, cached on disk keyed by source_key.
+    The first run parses and transforms the csvs; later runs with the same inputs load the cache instead.
+    With compact the transactions and users are in the compact mode of transformations.compact_frame.
+    """
+
+    directory = os.path.join(cache_dir, source_key(files, test_time))
+    if is_complete(directory):
+        tables = {table: load_table(os.path.join(directory, table), compact=compact, uuids=UUID_COLUMNS.get(table, ()))
+                  for table in TABLES}
+        return compact_tables(tables) if compact else tuple(tables[table] for table in TABLES)
+
+    tables = read_tables(files, test_time)
+    with written_directory(directory) as tmp:
+        for table in TABLES:
+            save_table(tables[table], os.path.join(tmp, table))
+    return compact_tables(tables) if compact else tuple(tables[table] for table in TABLES)
+
+
+def compact_tables(tables):
+    return compact_transactions(tables['transactions']), compact_users(tables['users']), tables['fx'], tables['currency']
@@ -0,0 +1,71 @@
+import pickle
+
+import numpy as np
+
+from action import action_codes, DECISIONS
+from compiled_model import load_compiled
+
+
+LR_PATH = 'models/LogisticRegressionClassifierFullTrain.pkl'
+
+# Logistic confidences inside this band go on to the random forest; below it the user is left alone, above it the
+# logistic decision stands.
+CASCADE_BAND = (0.1, 0.95)
+
+
+def load_logistic(path=LR_PATH):
+    """
+    The first stage model, its compiled copy (see compiled_model.load_compiled) when there is one.
+    """
+
+    compiled = load_compiled(path)
+    if compiled is not None:
+        return compiled
+    with open(path, 'rb') as f:
+        return pickle.load(f)
+
+
+def predict_with_proba(clf, X):
+    if hasattr(clf, 'predict_with_proba'):
+        predictions, probabilities = clf.predict_with_proba(X)
+        return predictions, probabilities[:, 1]
+    return clf.predict(X), clf.predict_proba(X)[:, 1]
+
+
+def cascade_predict(lr, rf, X, band=CASCADE_BAND):
+    """
+    Predictions and confidences with lr for every row and rf only for the rows whose lr confidence is within band
+    (inclusive). Also returns the mask of the escalated rows.
+    """
+
+    predictions, probabilities = predict_with_proba(lr, X)
+    escalated = (probabilities >= band[0]) & (probabilities <= band[1])
+    if escalated.any():
+        rf_predictions, rf_probabilities = predict_with_proba(rf, X[escalated])
+        predictions = predictions.astype(np.result_type(predictions, rf_predictions))
+        predictions[escalated], probabilities[escalated] = rf_predictions, rf_probabilities
+    return predictions, probabilities, escalated
+
+
+def compare_decisions(confidences, reference):
+    """
+    How the actions of confidences differ from the ones of reference: the number of changed decisions and the matrix
+    of reference action (rows) against cascade action (columns), in the order of DECISIONS.
+    """
+
+    codes, reference_codes = action_codes(confidences), action_codes(reference)
+    matrix = np.zeros((len(DECISIONS), len(DECISIONS)), dtype='int64')
+    np.add.at(matrix, (reference_codes, codes), 1)
+    return {'changed': int((codes != reference_codes).sum()), 'matrix': matrix.tolist()}
+
+
+def format_report(escalated, comparison=None):
+    lines = ['Cascade: {} of {} users escalated to the random forest ({:.1%})'.format(
+        int(escalated.sum()), len(escalated), escalated.mean() if len(escalated) else 0.)]
+    if comparison is not None:
+        lines.append('{} decisions differ from random forest only scoring'.format(comparison['changed']))
+        names = [d.split(':')[0] for d in DECISIONS]
+        lines.append('{:>22} '.format('forest \\ cascade') + ' '.join('{:>21}'.format(n) for n in names))
+        for name, row in zip(names, comparison['matrix']):
+            lines.append('{:>22} '.format(name) + ' '.join('{:>21}'.format(v) for v in row))
+    return '\n'.join(lines)
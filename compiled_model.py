@@ -0,0 +1,261 @@
+import hashlib
+import os
+import pickle
+import sys
+
+import numpy as np
+from scipy.special import expit
+
+from pipeline import PIPELINE_PATH, CLF_PATH
+
+
+# Rows per traversal batch: rows x trees node ids are held at once, so this bounds the memory of a forest evaluation.
+BATCH_NODES = 2 ** 20
+
+
+class CompiledForest:
+    """
+    A random forest (or a single decision tree) flattened into contiguous arrays: all trees share one node table, and
+    a leaf points to itself, so every row walks every tree in lockstep for depth steps without branching.
+    Probabilities are the ones of scikit-learn: X is compared as float32 against the thresholds, every tree gives
+    the normalised class counts of its leaf and the trees are averaged in order.
+    """
+
+    kind = 'forest'
+
+    def __init__(self, classes, roots, feature, threshold, children, value, depth, n_features):
+        self.classes_ = classes
+        self.roots = roots
+        self.feature = feature
+        self.threshold = threshold
+        self.children = children
+        self.value = value
+        self.depth = int(depth)
+        self.n_features_in_ = int(n_features)
+
+    @classmethod
+    def from_sklearn(cls, clf):
+        trees = [est.tree_ for est in getattr(clf, 'estimators_', [clf])]
+        if trees[0].n_outputs != 1:
+            raise ValueError('Only single output forests can be compiled')
+
+        roots, feature, threshold, children, value = [], [], [], [], []
+        offset = 0
+        for tree in trees:
+            n = tree.node_count
+            nodes = np.arange(offset, offset + n)
+            leaf = tree.children_left == -1
+            left = np.where(leaf, nodes, tree.children_left + offset)
+            right = np.where(leaf, nodes, tree.children_right + offset)
+
+            # Same normalisation as DecisionTreeClassifier.predict_proba, done once per node instead of per row.
+            counts = tree.value[:, 0, :].astype('float64')
+            normalizer = counts.sum(axis=1)[:, np.newaxis]
+            normalizer[normalizer == 0.0] = 1.0
+
+            roots.append(offset)
+            feature.append(np.where(leaf, 0, tree.feature))
+            threshold.append(np.where(leaf, 0., tree.threshold))
+            children.append(np.column_stack([left, right]))
+            value.append(counts / normalizer)
+            offset += n
+
+        return cls(classes=np.asarray(clf.classes_),
+                   roots=np.asarray(roots, dtype='int64'),
+                   feature=np.concatenate(feature).astype('int32'),
+                   threshold=np.concatenate(threshold).astype('float64'),
+                   children=np.concatenate(children).astype('int64'),
+                   value=np.concatenate(value),
+                   depth=max(tree.max_depth for tree in trees),
+                   n_features=clf.n_features_in_ if hasattr(clf, 'n_features_in_') else clf.n_features_)
+
+    def arrays(self):
+        return {'classes': self.classes_, 'roots': self.roots, 'feature': self.feature, 'threshold': self.threshold,
+                'children': self.children, 'value': self.value, 'depth': self.depth,
+                'n_features': self.n_features_in_}
+
+    def apply(self, X):
+        """
+        Leaf node (in the shared node table) of every row in every tree, shape (rows, trees).
+        """
+
+        n, d = X.shape
+        X = X.ravel()
+        children = self.children.ravel()
+        leaves = np.repeat(self.roots[np.newaxis, :], n, axis=0).ravel()
+
+        # Walks flat (row, tree) pairs, dropping the ones that reached their leaf so deep trees only cost the rows
+        # still inside them.
+        pairs = np.arange(len(leaves))
+        offsets = np.repeat(np.arange(n) * d, len(self.roots))
+        nodes = leaves
+        for _ in range(self.depth):
+            # Not "X > threshold": NaN goes right, as in scikit-learn.
+            go_right = ~(X.take(offsets + self.feature.take(nodes)) <= self.threshold.take(nodes))
+            moved = children.take(2 * nodes + go_right)
+            inside = moved != nodes
+            leaves[pairs] = moved
+            pairs, nodes, offsets = pairs[inside], moved[inside], offsets[inside]
+            if not len(pairs):
+                break
+        return leaves.reshape(n, len(self.roots))
+
+    def predict_with_proba(self, X):
+        """
+        Classes and class probabilities of the rows of X in one traversal.
+        """
+
+        X = check_features(X, self.n_features_in_, 'float32')
+        proba = np.empty((len(X), len(self.classes_)))
+        batch = max(1, BATCH_NODES // len(self.roots))
+        for start in range(0, len(X), batch):
+            leaves = self.apply(X[start:start + batch])
+            # Summed tree by tree like ForestClassifier.predict_proba, so the floats come out identical.
+            res = self.value[leaves[:, 0]].copy()
+            for t in range(1, leaves.shape[1]):
+                res += self.value[leaves[:, t]]
+            proba[start:start + batch] = res / len(self.roots)
+        return self.classes_[proba.argmax(axis=1)], proba
+
+    def predict_proba(self, X):
+        return self.predict_with_proba(X)[1]
+
+    def predict(self, X):
+        return self.predict_with_proba(X)[0]
+
+
+class CompiledLogistic:
+    """
+    A binary logistic regression as its coefficients, with the decision rule and probabilities of scikit-learn's
+    LogisticRegression.
+    """
+
+    kind = 'logistic'
+
+    def __init__(self, classes, coef, intercept, n_features):
+        self.classes_ = classes
+        self.coef = coef
+        self.intercept = intercept
+        self.n_features_in_ = int(n_features)
+
+    @classmethod
+    def from_sklearn(cls, clf):
+        if clf.coef_.shape[0] != 1:
+            raise ValueError('Only binary logistic regressions can be compiled')
+        return cls(classes=np.asarray(clf.classes_),
+                   coef=np.asarray(clf.coef_, dtype='float64'),
+                   intercept=np.asarray(clf.intercept_, dtype='float64'),
+                   n_features=clf.coef_.shape[1])
+
+    def arrays(self):
+        return {'classes': self.classes_, 'coef': self.coef, 'intercept': self.intercept,
+                'n_features': self.n_features_in_}
+
+    def predict_with_proba(self, X):
+        X = check_features(X, self.n_features_in_, 'float64')
+        scores = (X @ self.coef.T + self.intercept).ravel()
+        p = expit(scores)
+        return self.classes_[(scores > 0).astype(int)], np.column_stack([1 - p, p])
+
+    def predict_proba(self, X):
+        return self.predict_with_proba(X)[1]
+
+    def predict(self, X):
+        return self.predict_with_proba(X)[0]
+
+
+KINDS = {cls.kind: cls for cls in [CompiledForest, CompiledLogistic]}
+
+
+def check_features(X, n_features, dtype):
+    X = np.asarray(X, dtype=dtype)
+    if X.ndim != 2 or X.shape[1] != n_features:
+        raise ValueError('X has {} features, the model expects {}'.format(
+            X.shape[1] if X.ndim == 2 else X.ndim, n_features))
+    return X
+
+
+def compile_model(clf):
+    """
+    The compiled equivalent of a fitted RandomForestClassifier, DecisionTreeClassifier or LogisticRegression.
+    Raises ValueError for any other model.
+    """
+
+    if hasattr(clf, 'tree_') or (hasattr(clf, 'estimators_') and hasattr(clf.estimators_[0], 'tree_')):
+        return CompiledForest.from_sklearn(clf)
+    if hasattr(clf, 'coef_') and hasattr(clf, 'predict_proba'):
+        return CompiledLogistic.from_sklearn(clf)
+    raise ValueError('Cannot compile a {}'.format(type(clf).__name__))
+
+
+def compiled_path(source):
+    """
+    Where the compiled copy of the classifier pickled at source goes: next to it, with the same name.
+    """
+
+    return os.path.splitext(source)[0] + '.npz'
+
+
+def file_digest(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def export_model(clf, path, source=None):
+    """
+    Writes the compiled clf to an uncompressed .npz file (string classes as unicode, so nothing needs unpickling).
+    With source, the pickle clf was loaded from, the digest of that file is recorded for load_compiled.
+    """
+
+    model = compile_model(clf)
+    arrays = model.arrays()
+    if arrays['classes'].dtype == object:
+        arrays['classes'] = arrays['classes'].astype(str)
+    if source is not None:
+        arrays['source'] = file_digest(source)
+    np.savez(path, kind=model.kind, **arrays)
+    return model
+
+
+def read_model(path):
+    with np.load(path, allow_pickle=False) as f:
+        return {name: f[name] for name in f.files}
+
+
+def load_model(path):
+    arrays = read_model(path)
+    arrays.pop('source', None)
+    return KINDS[str(arrays.pop('kind'))](**arrays)
+
+
+def load_compiled(source):
+    """
+    The compiled copy of the classifier (or FeaturePipeline) pickled at source, or None when there is none or it was
+    compiled from another version of that file, so a left-over copy never stands in for a different model.
+    """
+
+    path = compiled_path(source)
+    if not os.path.exists(path):
+        return None
+    arrays = read_model(path)
+    if str(arrays.pop('source', '')) != file_digest(source):
+        return None
+    return KINDS[str(arrays.pop('kind'))](**arrays)
+
+
+if __name__ == '__main__':
+
+    # Compiles a pickled classifier or FeaturePipeline, by default the one test.py would load, next to it.
+    source = sys.argv[1] if len(sys.argv) > 1 else PIPELINE_PATH
+    if len(sys.argv) < 2 and not os.path.exists(source):
+        source = CLF_PATH
+
+    with open(source, 'rb') as f:
+        clf = pickle.load(f)
+    clf = getattr(clf, 'clf', clf)
+    path = compiled_path(source)
+    export_model(clf, path, source=source)
+    print('{} compiled to {}'.format(source, path))
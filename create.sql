@@ -43,11 +43,38 @@ CREATE TABLE currency_details(
 		exponent INTEGER,
 		is_crypto BOOLEAN NOT NULL
 		);
-		
 
 
+-- Newest created_date / ts loaded into each table by part1.py --incremental, and the rows its last run changed.
+CREATE TABLE etl_watermarks(
+		table_name VARCHAR(30) PRIMARY KEY,
+		watermark TIMESTAMP,
+		rows BIGINT,
+		updated_at TIMESTAMP NOT NULL
+		);
+		
+
 
+-- Secondary indexes: transactions per user in time order, fx rates per currency pair in time order (as-of lookups).
+CREATE INDEX transactions_user_id_created_date_idx ON transactions (user_id, created_date);
 
+CREATE INDEX fx_rates_base_ccy_ccy_ts_idx ON fx_rates (base_ccy, ccy, ts);
 
 
+-- First transaction of every user with its amount in USD at the latest rate before it (see sql_features.py).
+-- Refresh with REFRESH MATERIALIZED VIEW CONCURRENTLY first_transactions after loading new transactions.
+CREATE MATERIALIZED VIEW first_transactions AS
+SELECT t.user_id, t.id, t.created_date, t.state,
+		t.amount * 10::float8 ^ -(CASE WHEN c.exponent >= 0 THEN c.exponent ELSE 0 END) * COALESCE(fx.rate, 1) AS amount_usd
+FROM (
+		SELECT DISTINCT ON (user_id) * FROM transactions ORDER BY user_id, created_date, id
+		) t
+LEFT JOIN currency_details c ON c.ccy = t.currency
+LEFT JOIN LATERAL (
+		SELECT f.base_ccy, f.ccy, f.rate FROM fx_rates f
+		WHERE (f.base_ccy, f.ccy, f.ts) <= ('USD', t.currency::text, t.created_date) AND f.rate IS NOT NULL
+		ORDER BY f.base_ccy DESC, f.ccy DESC, f.ts DESC
+		LIMIT 1
+		) fx ON fx.base_ccy = 'USD' AND fx.ccy = t.currency::text AND fx.ccy <> 'USD';
 
+CREATE UNIQUE INDEX first_transactions_user_id_idx ON first_transactions (user_id);
@@ -0,0 +1,104 @@
+import mmap
+import struct
+
+
+# Layout: 8 byte magic, uint64 record count n, then n sorted 16 byte UUIDs, n uint8 action codes, padding to a multiple
+# of 4 and n float32 confidences. Everything little endian.
+MAGIC = b'FRDIDX01'
+HEADER = struct.Struct('<8sQ')
+
+
+def write_decision_index(path, ids, codes, confidences):
+    """
+    Writes the binary decision index read by DecisionIndex. ids are UUID strings, codes the action codes of action.py.
+    """
+
+    import numpy as np
+
+    ids = [str(i) for i in ids]
+    keys = np.frombuffer(bytes.fromhex(''.join(ids).replace('-', '')), dtype='>u8').reshape(-1, 2)
+    order = np.lexsort((keys[:, 1], keys[:, 0]))
+    n = len(order)
+
+    with open(path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, n))
+        f.write(keys[order].tobytes())
+        f.write(np.asarray(codes, dtype='uint8')[order].tobytes())
+        f.write(b'\0' * (-n % 4))
+        f.write(np.asarray(confidences, dtype='<f4')[order].tobytes())
+
+
+def update_decision_index(path, ids, codes, confidences):
+    """
+    Overwrites the action codes and confidences of ids in the decision index at path, in place: only their records
+    are written, and readers that have the file mapped see the new values. Returns False without changing anything
+    when one of ids is not in the index, which then has to be rewritten by write_decision_index.
+    """
+
+    import numpy as np
+
+    with open(path, 'r+b') as f:
+        magic, n = HEADER.unpack(f.read(HEADER.size))
+        if magic != MAGIC:
+            raise ValueError(path + ' is not a decision index')
+        if not n:
+            return not len(ids)
+        # As S16 the keys compare like the bytes the index is sorted by.
+        keys = np.memmap(f, dtype='S16', mode='r', offset=HEADER.size, shape=(n,))
+        new = np.frombuffer(bytes.fromhex(''.join(str(i) for i in ids).replace('-', '')), dtype='S16')
+        rows = np.minimum(np.searchsorted(keys, new), n - 1)
+        if not (keys[rows] == new).all():
+            return False
+
+        codes_offset = HEADER.size + 16 * n
+        mapped_codes = np.memmap(f, dtype='uint8', mode='r+', offset=codes_offset, shape=(n,))
+        mapped_codes[rows] = codes
+        mapped_codes.flush()
+        mapped_confidences = np.memmap(f, dtype='<f4', mode='r+', offset=codes_offset + n + (-n % 4), shape=(n,))
+        mapped_confidences[rows] = confidences
+        mapped_confidences.flush()
+    return True
+
+
+class DecisionIndex:
+    """
+    Read-only view of a decision index through mmap. A lookup is a binary search over the sorted UUIDs, so opening is
+    instant and memory does not grow with the number of users.
+    """
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.n = HEADER.unpack_from(self.mm, 0)
+        if magic != MAGIC:
+            raise ValueError(path + ' is not a decision index')
+        self.codes_offset = HEADER.size + 16 * self.n
+        self.confidences_offset = self.codes_offset + self.n + (-self.n % 4)
+
+    def __len__(self):
+        return self.n
+
+    def lookup(self, user_id):
+        """
+        (action code, confidence) for user_id, or None when the user is not in the index. Raises ValueError when
+        user_id is not a hex string.
+        """
+
+        try:
+            key = bytes.fromhex(user_id.replace('-', ''))
+        except (AttributeError, ValueError):
+            raise ValueError('invalid user id {!r}'.format(user_id)) from None
+        lo, hi = 0, self.n
+        while lo < hi:
+            mid = (lo + hi) // 2
+            start = HEADER.size + 16 * mid
+            if self.mm[start:start + 16] < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo == self.n or self.mm[HEADER.size + 16 * lo:HEADER.size + 16 * lo + 16] != key:
+            return None
+        return self.mm[self.codes_offset + lo], struct.unpack_from('<f', self.mm, self.confidences_offset + 4 * lo)[0]
+
+    def close(self):
+        self.mm.close()
@@ -0,0 +1,278 @@
+import argparse
+import datetime
+import json
+import os
+import pickle
+import shutil
+import sys
+from time import time
+
+import numpy as np
+import pandas as pd
+
+from action import action_codes, INDEX_PATH
+from aggregates import MODE_ATTRIBUTES, partial_aggregates, merge_partials, finalize
+from cache import save_table, load_table, written_directory, is_complete
+from compiled_model import compiled_path, export_model, load_compiled
+from decision_index import write_decision_index, update_decision_index
+from fx import FxRateIndex, to_timestamps, NAT
+from generate_features import user_frame
+from pipeline import FeaturePipeline, PIPELINE_PATH, CLF_PATH
+from transformations import transform_part1, transform_transactions, country_code_lookup
+
+
+STORE_DIR = 'feature_store'
+PREDICTIONS_PATH = 'predictions.csv'
+
+
+def empty_partial():
+    users = pd.DataFrame({'FIRST_TS': np.zeros(0, dtype='int64'), 'FIRST_STATE': np.zeros(0, dtype=object),
+                          'FIRST_AMOUNT_USD': np.zeros(0), 'AMOUNT_USD': np.zeros(0),
+                          'N_TRANSACTIONS': np.zeros(0, dtype='int64')},
+                         index=pd.Index([], dtype=object, name='USER_ID'))
+    counts = {attr: pd.DataFrame({'USER_ID': np.zeros(0, dtype=object), 'VALUE': np.zeros(0, dtype=object),
+                                  'COUNT': np.zeros(0, dtype='int64')}) for attr in MODE_ATTRIBUTES}
+    return {'users': users, 'counts': counts}
+
+
+def load_store(directory=STORE_DIR):
+    """
+    The stored partial aggregates (see aggregates.partial_aggregates) and state, or None when there is no store.
+    """
+
+    if not is_complete(directory):
+        return None
+    with open(os.path.join(directory, 'state.json')) as f:
+        state = json.load(f)
+    users = load_table(os.path.join(directory, 'users')).set_index('USER_ID')
+    counts = {attr: load_table(os.path.join(directory, 'counts', attr)) for attr in MODE_ATTRIBUTES}
+    return {'users': users, 'counts': counts}, state
+
+
+def save_store(partial, state, directory=STORE_DIR, pipeline=None):
+    """
+    Writes the store through cache.written_directory, so an interrupted save leaves the previous store intact.
+    """
+
+    with written_directory(directory) as tmp:
+        save_table(partial['users'].reset_index(), os.path.join(tmp, 'users'))
+        for attr in MODE_ATTRIBUTES:
+            save_table(partial['counts'][attr], os.path.join(tmp, 'counts', attr))
+        pipeline_path = os.path.join(tmp, 'pipeline.pkl')
+        if pipeline is not None:
+            pipeline.save(pipeline_path)
+            # With its compiled copy, as load_compiled finds it.
+            try:
+                export_model(pipeline.clf, compiled_path(pipeline_path), source=pipeline_path)
+            except ValueError:
+                pass
+        else:
+            for name in ['pipeline.pkl', os.path.basename(compiled_path(pipeline_path))]:
+                if os.path.exists(os.path.join(directory, name)):
+                    shutil.copy(os.path.join(directory, name), os.path.join(tmp, name))
+        with open(os.path.join(tmp, 'state.json'), 'w') as f:
+            json.dump(state, f, indent=1)
+
+
+def split_partial(partial, user_ids):
+    """
+    The partial aggregates of user_ids and of all the other users.
+    """
+
+    users = partial['users']
+    inside = users.index.isin(user_ids)
+    selected, rest = {'users': users[inside], 'counts': {}}, {'users': users[~inside], 'counts': {}}
+    for attr, counts in partial['counts'].items():
+        mask = counts['USER_ID'].isin(user_ids).values
+        selected['counts'][attr], rest['counts'][attr] = counts[mask], counts[~mask]
+    return selected, rest
+
+
+def new_transactions(chunks, state):
+    """
+    The transactions of chunks after the watermark of state, with their timestamps, and the number of transactions
+    before the watermark. As in the incremental mode of part1.py, transactions arrive in time order: older ones are
+    taken as processed, so a transaction that arrives after newer ones were processed is skipped and only shows in
+    that count. Transactions at the watermark itself are new unless their ID was already processed, so a delta cut
+    in the middle of one timestamp still counts every transaction once.
+    """
+
+    watermark = state['watermark'] if state else NAT
+    seen = set(state['watermark_ids']) if state else set()
+    delta = []
+    skipped = 0
+    for df in chunks:
+        ts = to_timestamps(df['CREATED_DATE'])
+        keep = ts > watermark
+        # NaT is the smallest timestamp: transactions without one are only taken by the first refresh.
+        skipped += int((ts < watermark).sum())
+        at = np.flatnonzero(ts == watermark)
+        if len(at):
+            keep[at] = ~df['ID'].iloc[at].isin(seen).values
+        delta.append(df[keep].assign(TS=ts[keep]))
+    delta = pd.concat(delta, ignore_index=True) if delta else pd.DataFrame(columns=['USER_ID', 'ID', 'TS'])
+    return delta.drop(columns='TS'), delta['TS'].values.astype('int64'), skipped
+
+
+def advance(state, delta, ts):
+    """
+    The state after processing delta: the latest timestamp seen and the IDs of the transactions at it.
+    """
+
+    watermark = state['watermark'] if state else NAT
+    seen = state['watermark_ids'] if state else []
+    valid = ts != NAT
+    if valid.any() and ts[valid].max() >= watermark:
+        latest = ts[valid].max()
+        ids = [str(i) for i in delta['ID'].values[ts == latest]]
+        seen = (seen if latest == watermark else []) + ids
+        watermark = int(latest)
+    return {'watermark': int(watermark),
+            'watermark_time': str(pd.Timestamp(watermark)) if watermark != NAT else None,
+            'watermark_ids': seen,
+            'transactions': (state['transactions'] if state else 0) + len(delta),
+            'updated_at': datetime.datetime.now().isoformat(timespec='seconds')}
+
+
+def score(pipeline, clf, df_users, aggregates):
+    """
+    Predictions and confidences of the users as test.py makes them, LOCKED users included.
+    """
+
+    X = pipeline.transform(user_frame(df_users.copy(), aggregates))
+    if hasattr(clf, 'predict_with_proba'):
+        predictions, probabilities = clf.predict_with_proba(X)
+        probabilities = probabilities[:, 1]
+    else:
+        predictions = clf.predict(X)
+        probabilities = clf.predict_proba(X)[:, 1]
+
+    locked = df_users['STATE'].values == 'LOCKED'
+    predictions = np.asarray(predictions, dtype=object)
+    predictions[locked] = 1
+    return predictions, np.where(locked, 1, probabilities)
+
+
+def update_predictions(ids, predictions, confidences, path=PREDICTIONS_PATH, index_path=INDEX_PATH):
+    """
+    Replaces the rows of ids in the predictions file, appending the users it did not have yet, and updates the
+    decision index of action.py. The csv is read and rewritten whole, so that part costs O(all users) per refresh;
+    the index is patched in place, proportional to len(ids), unless it has to grow (see update_decision_index).
+    """
+
+    new = pd.DataFrame({'Prediction': predictions, 'Confidence': confidences}, index=pd.Index(ids, name='ID'))
+    patched = False
+    if os.path.exists(path):
+        # Users already in the file keep their row.
+        df = pd.read_csv(path, index_col=0, float_precision='round_trip').set_index('ID')
+        known = new.index.isin(df.index)
+        for c in ['Prediction', 'Confidence']:
+            df.loc[new.index[known], c] = new[c].values[known]
+        df = pd.concat([df, new[~known]])
+        patched = known.all() and os.path.exists(index_path) and update_decision_index(
+            index_path, ids, action_codes(confidences), confidences)
+    else:
+        df = new
+    df = df.reset_index()[['ID', 'Prediction', 'Confidence']]
+    df.to_csv(path)
+    if not patched:
+        write_decision_index(index_path, df['ID'], action_codes(df['Confidence'].values), df['Confidence'].values)
+    return df
+
+
+def refresh(chunks, df_users, df_fx, df_currency, directory=STORE_DIR, predictions_path=PREDICTIONS_PATH,
+            index_path=INDEX_PATH):
+    """
+    Brings the feature store and the predictions up to date with the transactions of chunks (transformed, e.g.
+    transform_transactions per chunk), which may hold the whole history or only the new part of it. Only the
+    transactions after the store's watermark are aggregated, merged into the stored aggregates of their users, and
+    only those users (and users the predictions do not have yet) are rescored. Without a store everything is built
+    and every user scored, with models/pipeline.pkl or, like test.py, the encoders and scaler fitted on this batch
+    (kept in the store for the next refreshes). Returns the number of new transactions, of rescored users and of
+    transactions skipped as older than the watermark: when chunks only hold new transactions, those arrived late
+    and are not in the aggregates.
+    """
+
+    fx_index = FxRateIndex.from_frames(df_fx, df_currency)
+    stored = load_store(directory)
+    partial, state = stored if stored is not None else (empty_partial(), None)
+
+    delta, ts, skipped = new_transactions(chunks, state)
+    fitted = None
+    if os.path.exists(os.path.join(directory, 'pipeline.pkl')):
+        source = os.path.join(directory, 'pipeline.pkl')
+        pipeline = FeaturePipeline.load(source)
+    elif os.path.exists(PIPELINE_PATH):
+        source = PIPELINE_PATH
+        pipeline = FeaturePipeline.load()
+    else:
+        source = CLF_PATH
+        with open(CLF_PATH, 'rb') as f:
+            pipeline = fitted = FeaturePipeline(clf=pickle.load(f))
+    if pipeline.velocity:
+        raise ValueError('The feature store does not keep the velocity features')
+    compiled = load_compiled(source)
+    clf = compiled if compiled is not None else pipeline.clf
+
+    # Merge the delta into the stored aggregates of its users only.
+    if len(delta):
+        affected = pd.unique(delta['USER_ID'].values)
+        selected, rest = split_partial(partial, affected)
+        merged = merge_partials([selected, partial_aggregates(delta, fx_index)])
+        partial = {'users': pd.concat([rest['users'], merged['users']]),
+                   'counts': {attr: pd.concat([rest['counts'][attr], merged['counts'][attr]], ignore_index=True)
+                              for attr in MODE_ATTRIBUTES}}
+    else:
+        affected = np.zeros(0, dtype=object)
+
+    if fitted is not None:
+        fitted.fit(user_frame(df_users.copy(), finalize(partial)))
+
+    scored = set()
+    if stored is not None and os.path.exists(predictions_path):
+        scored = set(pd.read_csv(predictions_path, index_col=0, usecols=[0, 1])['ID'].values)
+    rescore = df_users['ID'].isin(affected).values | ~df_users['ID'].isin(scored).values
+    df_rescore = df_users[rescore].reset_index(drop=True)
+
+    if len(df_rescore):
+        selected, _ = split_partial(partial, df_rescore['ID'].values)
+        predictions, confidences = score(pipeline, clf, df_rescore, finalize(selected))
+        if stored is None and os.path.exists(predictions_path):
+            os.remove(predictions_path)
+        update_predictions(df_rescore['ID'].values, predictions, confidences, predictions_path, index_path)
+
+    save_store(partial, advance(state, delta, ts), directory, pipeline=fitted)
+    return len(delta), len(df_rescore), skipped
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Updates the feature store and predictions.csv with the transactions '
+                                                 'added since the last run.')
+    parser.add_argument('transactions', nargs='?', default='test_transactions.csv',
+                        help='transactions csv, the whole history or only the new part of it')
+    parser.add_argument('--users', default='test_users.csv')
+    parser.add_argument('--store', default=STORE_DIR)
+    parser.add_argument('--chunksize', type=int, default=10 ** 6, help='rows of the transactions csv read at a time')
+    parser.add_argument('--rebuild', action='store_true', help='drop the store and rebuild it from the transactions')
+    args = parser.parse_args()
+
+    t = time()
+    try:
+        df_countries = pd.read_csv('train/countries.csv', index_col=False)
+        _, df_users, df_fx, df_currency = transform_part1(None, pd.read_csv(args.users, index_col=0), df_countries,
+                                                          pd.read_csv('train/fx_rates.csv', index_col=False),
+                                                          pd.read_csv('train/currency_details.csv', index_col=False))
+        code_lookup = country_code_lookup(df_countries)
+        chunks = (transform_transactions(df, code_lookup)
+                  for df in pd.read_csv(args.transactions, index_col=0, chunksize=args.chunksize))
+
+        if args.rebuild and os.path.exists(args.store):
+            shutil.rmtree(args.store)
+        n_new, n_scored, n_skipped = refresh(chunks, df_users, df_fx, df_currency, directory=args.store)
+    except OSError:
+        print('There was an issue importing the files. Please see the README and try again.')
+        sys.exit()
+    print('{} new transactions, {} users rescored ({:.1f} s)'.format(n_new, n_scored, time() - t))
+    if n_skipped:
+        print('{} transactions older than the watermark were skipped: already processed, or late'.format(n_skipped))
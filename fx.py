@@ -0,0 +1,99 @@
+import numpy as np
+import pandas as pd
+
+
+NAT = np.iinfo('int64').min
+
+
+def to_timestamps(values):
+    """
+    Parses 'YYYY-MM-DD HH:MM:SS[.fff]' strings (or datetimes) into int64 nanoseconds. Missing values become NaT.
+    The whole seconds are parsed with a fixed format and the fraction separately, which keeps this vectorized
+    even though only some of the timestamps carry fractional seconds.
+    """
+
+    values = pd.Series(values)
+    if pd.api.types.is_datetime64_any_dtype(values):
+        return values.to_numpy(dtype='datetime64[ns]').view('int64')
+
+    seconds = pd.to_datetime(values.str.slice(0, 19), format='%Y-%m-%d %H:%M:%S', errors='coerce')
+    seconds = seconds.to_numpy(dtype='datetime64[ns]').view('int64')
+    fraction = pd.to_numeric('0' + values.str.slice(19), errors='coerce').fillna(0).values
+    return np.where(seconds == NAT, NAT, seconds + np.round(fraction * 1e9).astype('int64'))
+
+
+class FxRateIndex:
+    """
+    As-of fx rate lookup built once from the long form fx_rates (see transform_part1) and currency_details.
+
+    rates maps (BASE_CCY, CCY) to a pair of sorted int64 timestamps and float64 rates, exponents maps a currency to
+    the number of minor units in AMOUNT. Conversion follows query2: AMOUNT_USD = AMOUNT / 10**exponent * RATE, with
+    RATE the latest USD/CCY rate at or before the transaction timestamp.
+    """
+
+    def __init__(self, rates, exponents, base='USD'):
+        self.rates = rates
+        self.exponents = exponents
+        self.base = base
+
+    @classmethod
+    def from_frames(cls, df_fx, df_currency, base='USD'):
+        fx = pd.DataFrame({'BASE_CCY': df_fx['BASE_CCY'].values,
+                           'CCY': df_fx['CCY'].values,
+                           'TS': to_timestamps(df_fx['TS'].values),
+                           'RATE': df_fx['RATE'].values.astype('float64')})
+        fx = fx[fx['RATE'].notna() & (fx['TS'] != NAT)]
+        fx = fx.sort_values(['BASE_CCY', 'CCY', 'TS'], kind='mergesort')
+
+        ts, rate = fx['TS'].values, fx['RATE'].values
+        rates = {pair: (ts[idx], rate[idx]) for pair, idx in fx.groupby(['BASE_CCY', 'CCY'], sort=False).indices.items()}
+
+        df_currency = df_currency[df_currency['exponent'] != -1]
+        exponents = dict(zip(df_currency['currency'], df_currency['exponent'].astype(int)))
+        return cls(rates, exponents, base=base)
+
+    def to_cash(self, amounts, currencies):
+        """
+        Scales AMOUNT from minor units to cash. Currencies without a known exponent are left as they are.
+        """
+
+        codes, uniques = pd.factorize(pd.Series(currencies).values)
+        # The extra trailing entry is picked up by the -1 code of missing currencies.
+        scale = np.array([10. ** -self.exponents.get(c, 0) for c in uniques] + [1.])
+        return np.asarray(amounts, dtype='float64') * scale[codes]
+
+    def rate_asof(self, currencies, timestamps):
+        """
+        Latest BASE/CCY rate at or before each timestamp. 1 for the base currency itself and NaN when there is no such
+        rate (unknown pair or a transaction before the first quote).
+        """
+
+        codes, uniques = pd.factorize(pd.Series(currencies).values)
+        ts = to_timestamps(timestamps)
+        rate = np.full(len(codes), np.nan)
+
+        # Group rows by currency once, then one searchsorted per currency.
+        order = np.argsort(codes, kind='stable')
+        bounds = np.searchsorted(codes[order], np.arange(len(uniques) + 1))
+        for k, ccy in enumerate(uniques):
+            rows = order[bounds[k]:bounds[k + 1]]
+            if ccy == self.base:
+                rate[rows] = 1.
+                continue
+            if (self.base, ccy) not in self.rates:
+                continue
+            pair_ts, pair_rate = self.rates[(self.base, ccy)]
+            idx = np.searchsorted(pair_ts, ts[rows], side='right') - 1
+            found = idx >= 0
+            rate[rows[found]] = pair_rate[idx[found]]
+        return rate
+
+    def to_usd(self, amounts, currencies, timestamps):
+        """
+        Converts raw AMOUNT values to USD in one vectorized pass. Where no rate is available the cash amount is kept,
+        which is what query2 has always done.
+        """
+
+        cash = self.to_cash(amounts, currencies)
+        usd = cash * self.rate_asof(currencies, timestamps)
+        return np.where(np.isnan(usd), cash, usd)
@@ -1,61 +1,195 @@
 from transformations import *
+from aggregates import aggregate_users, aggregate_chunks
+from parallel import aggregate_users_parallel
+from sql_features import sql_aggregates
+from instrumentation import NULL_RECORDER
+from pipeline import FeaturePipeline
+from velocity import velocity_features, add_velocity
 
 
-def generate_features(df_transactions, df_users, df_fx, df_currency, df_countries=None, test_time = True, save=False):
+def user_frame(df_users, aggregates):
     """
-    Just having one place to do all of the above in one go. Note this assumes transform_part1 is already complete.
+    The per-user columns the FeaturePipeline encodes and scales, from the users and the per-user transaction
+    aggregates (see aggregates.py). Needs no fitted state, so it works on any subset of users.
     """
-    
-    if test_time:
-        df_transactions, df_users, df_fx, df_currency = transform_part1(df_transactions, df_users, df_countries, df_fx, df_currency)
-            
-    # KYC transform
-    df_users = KYC_transform(df_users)
-    
+
     # Birth year - no transform needed.
-    
+
     # Country Transform
-    df_users['COUNTRY_ISGB'] = df_users['COUNTRY'] == 'GB'
-    df_users['COUNTRY_ISGB'] = df_users['COUNTRY_ISGB'].apply(lambda x: int(x))
-    
+    df_users['COUNTRY_ISGB'] = (df_users['COUNTRY'] == 'GB').astype(int)
+
     # Created date transformation
     # df_users = date_to_numerical(df_users)
-    
-    # Terms version transformation
-    df_users = terms_version_boolean(df_users)
-    
-    # First Success Transform
-    df_users, _ = query2(df_users, df_transactions, df_fx, df_currency)
-    
-    # Countries_match transformation
-    df_users = countries_match(df_users, df_transactions)
-    
-    # is_MINOS feature:
-    df_users = is_MINOS(df_users, df_transactions)
-    
-    # transaction type feature:
-    df_users = TRANSACTION_TYPE(df_users, df_transactions)
-    
-    # ID_CHECK
-    
-    df_users = ID_CHECK(df_users, df_transactions)
-    
-    X = df_users[['F1', 'F2', 'F3', 'F4', 'BIRTH_YEAR', 'COUNTRY_ISGB', 
-                  'G1', 'G2', 'G3', 'G4', 'G5', 'G6', 'TERMS_VERSION', 'ID_CHECK',
-                  'AMOUNT_USD', 'FIRST_SUCCESS', 'COUNTRIES_MATCH']]
-    
+
+    # Transaction features from the aggregates, which replace query2, countries_match, is_MINOS, the TYPE extraction
+    # and ID_CHECK.
+    return transaction_features(df_users, aggregates)
+
+
+def generate_features(df_transactions, df_users, df_fx, df_currency, df_countries=None, test_time = True, save=False,
+                      pipeline=None, preprocessed=False, n_jobs=None, backend='pandas', db=None,
+                      instrument=None, compact=False, velocity=False, memoize=False, source=None):
+    """
+    Just having one place to do all of the above in one go. Note this assumes transform_part1 is already complete
+    unless test_time (set preprocessed for test tables that already went through it, e.g. from cache.load_tables).
+
+    The KYC and TYPE one-hot encodings, the newest terms version and the scaler come from pipeline (see pipeline.py).
+    An unfitted pipeline is fitted on this batch, so pass one in to keep the fitted state; without one the batch is
+    used as before.
+
+    With n_jobs the transaction aggregates are computed in that many worker processes (see parallel.py); the result
+    is the same as the serial one.
+
+    With backend='sql' the transaction aggregates are computed inside PostgreSQL from the tables part1.py loaded into
+    db (an sqlalchemy engine, see sql_features.py); df_transactions, df_fx and df_currency are not used.
+
+    Pass an instrumentation.Recorder as instrument to record the wall time, rows and memory of every stage.
+
+    With compact the users and (unless streamed) the transactions are converted to the compact mode of
+    transformations.compact_frame, a no-op for tables from cache.load_tables(compact=True), and the features are
+    returned as float32. The features are the same as without it.
+
+    With velocity, or a pipeline made with velocity, the velocity features of velocity.py are added. They need the
+    transactions as one DataFrame, so neither streaming nor the sql backend support them.
+
+    With memoize every stage after transform_part1 is cached on disk keyed by its code and inputs (see stages.py), so
+    only stages whose code or inputs changed are recomputed. Pass the files dict of cache.load_tables as source to key
+    the tables by their files instead of their contents. Needs the transactions as one DataFrame as well.
+    """
+
+    rec = instrument or NULL_RECORDER
+
+    if velocity and pipeline is None:
+        pipeline = FeaturePipeline(velocity=True)
+    elif velocity and not pipeline.velocity:
+        if pipeline.fitted:
+            raise ValueError('The pipeline was fitted without the velocity features')
+        pipeline.velocity = True
+    velocity = pipeline is not None and pipeline.velocity
+    if (velocity or memoize) and (backend == 'sql' or not isinstance(df_transactions, pd.DataFrame)):
+        raise ValueError('The {} features need the transactions as one DataFrame'.format(
+            'velocity' if velocity else 'memoized'))
+
+    if backend == 'sql':
+        if test_time and not preprocessed:
+            with rec.stage('transform_part1', rows_in=len(df_users)):
+                df_users = transform_users(df_users).reset_index(drop=True)
+        with rec.stage('aggregates', rows_in=None, backend=backend) as s:
+            aggregates = sql_aggregates(db, user_ids=df_users['ID'])
+            s.rows_out = len(aggregates)
+        if compact:
+            df_users = compact_users(df_users)
+        return finish_features(df_users, aggregates, test_time, save, pipeline, rec, compact)
+
+    # df_transactions can also be an iterable of chunks (e.g. pd.read_csv with chunksize), in which case only one
+    # chunk is in memory at a time.
+    streaming = not isinstance(df_transactions, pd.DataFrame)
+    n_transactions = None if streaming else len(df_transactions)
+    
+    if test_time and not preprocessed:
+        with rec.stage('transform_part1', rows_in=n_transactions):
+            transactions, df_users, df_fx, df_currency = transform_part1(None if streaming else df_transactions, df_users, df_countries, df_fx, df_currency)
+        if not streaming:
+            df_transactions = transactions
+
+    if compact:
+        with rec.stage('compact', rows_in=n_transactions):
+            df_users = compact_users(df_users)
+            if not streaming:
+                df_transactions = compact_transactions(df_transactions)
+
+    if memoize:
+        from stages import memoized_features
+        if pipeline is None:
+            pipeline = FeaturePipeline()
+        with rec.stage('memoized_features', rows_in=n_transactions) as s:
+            X_scaled, graph = memoized_features(df_transactions, df_users, df_fx, df_currency, pipeline, source=source,
+                                                test_time=test_time)
+            s.rows_out = len(X_scaled)
+        for name, status, seconds in graph.log:
+            rec.record(name, status=status, seconds=seconds)
+        y = None if test_time else df_users['IS_FRAUDSTER'].astype(int)
+        return save_features(X_scaled.astype('float32') if compact else X_scaled, y, test_time, save)
+
+    with rec.stage('fx_index', rows_in=len(df_fx)):
+        fx_index = FxRateIndex.from_frames(df_fx, df_currency)
+
+    with rec.stage('aggregates', rows_in=n_transactions, backend=backend, streaming=streaming, n_jobs=n_jobs) as s:
+        if streaming:
+            transform = None
+            if test_time and not preprocessed:
+                code_lookup = country_code_lookup(df_countries)
+                transform = lambda df: transform_transactions(df, code_lookup)
+            aggregates = aggregate_chunks(df_transactions, fx_index, transform=transform)
+        elif n_jobs:
+            aggregates = aggregate_users_parallel(df_transactions, fx_index, n_shards=n_jobs, max_workers=n_jobs)
+        else:
+            aggregates = aggregate_users(df_transactions, fx_index)
+        s.rows_out = len(aggregates)
+
+    if velocity:
+        with rec.stage('velocity', rows_in=n_transactions) as s:
+            df_users = add_velocity(df_users, velocity_features(df_transactions, df_users, fx_index))
+            s.rows_out = len(df_users)
+    return finish_features(df_users, aggregates, test_time, save, pipeline, rec, compact)
+
+
+def finish_features(df_users, aggregates, test_time, save, pipeline, rec=NULL_RECORDER, compact=False):
+    """
+    The rest of generate_features once the transaction aggregates are there, whichever backend computed them.
+    """
+
+    with rec.stage('user_features', rows_in=len(df_users)) as s:
+        df_users = user_frame(df_users, aggregates)
+        s.rows_out = len(df_users)
+
+    if pipeline is None:
+        pipeline = FeaturePipeline()
+    if not pipeline.fitted:
+        with rec.stage('fit', rows_in=len(df_users)):
+            pipeline.fit(df_users)
+    with rec.stage('transform', rows_in=len(df_users)) as s:
+        X_scaled = pipeline.transform(df_users)
+        if compact:
+            X_scaled = X_scaled.astype('float32')
+        s.rows_out = len(X_scaled)
+
+    y = None
     if not test_time:
-        df_users['IS_FRAUDSTER'] = df_users['IS_FRAUDSTER'].apply(lambda x: int(x))
+        df_users['IS_FRAUDSTER'] = df_users['IS_FRAUDSTER'].astype(int)
         y = df_users['IS_FRAUDSTER']
-    
-    # Standard scaler subtracts the mean and scales to unit variance. This will help for SVM and LR classifiers which are
-    # senstive to scale. Won't make much difference for tree-based methods (Decision Trees, Random Forests, etc.)
-    # Empirically, this has helped the accuracy. 
-    scaler = StandardScaler() 
-    X_scaled = scaler.fit_transform(X)
-    
+    return save_features(X_scaled, y, test_time, save)
+
+
+def write_features(chunks, df_users, df_fx, df_currency, path, pipeline=None, batch_size=1 << 16):
+    """
+    The features of generate_features for transactions streamed in chunks (already transformed, e.g. by
+    transform_transactions), written to a .npy file at path batch_size users at a time, so neither the transactions
+    nor the whole matrix are ever in memory. An unfitted pipeline is fitted on these users first, its scaler batch by
+    batch. Returns the memory-mapped matrix.
+    """
+
+    if pipeline is None:
+        pipeline = FeaturePipeline()
+    if pipeline.velocity:
+        raise ValueError('The velocity features need the transactions as one DataFrame')
+
+    fx_index = FxRateIndex.from_frames(df_fx, df_currency)
+    df_users = user_frame(df_users, aggregate_chunks(chunks, fx_index))
+    if not pipeline.fitted:
+        pipeline.fit(df_users, batch_size=batch_size)
+
+    X_scaled = np.lib.format.open_memmap(path, mode='w+', shape=(len(df_users), len(pipeline.columns)))
+    for start in range(0, len(df_users), batch_size):
+        X_scaled[start:start + batch_size] = pipeline.transform(df_users.iloc[start:start + batch_size])
+    X_scaled.flush()
+    return X_scaled
+
+
+def save_features(X_scaled, y, test_time, save):
+
     # Save features statically:
-    
+
     if test_time:
         if save:
             np.save('test_features.npy', X_scaled)
@@ -64,4 +198,4 @@ def generate_features(df_transactions, df_users, df_fx, df_currency, df_countrie
         if save:
             np.save('train_features.npy', X_scaled)
             np.save('train_labels.npy', y)
-        return X_scaled, y
\ No newline at end of file
+        return X_scaled, y
@@ -0,0 +1,146 @@
+import json
+import resource
+import sys
+import time
+from time import perf_counter
+
+
+def proc_status(field):
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith(field + ':'):
+                return int(line.split()[1]) * 1024
+
+
+def rss():
+    """
+    Resident set size of this process in bytes, or None where /proc is not available.
+    """
+
+    try:
+        return proc_status('VmRSS')
+    except OSError:
+        return None
+
+
+def reset_peak_rss():
+    """
+    Resets the kernel's peak RSS (VmHWM) of this process so the next peak_rss covers what follows only. Only Linux
+    supports it; elsewhere peak_rss stays the peak of the whole process.
+    """
+
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def peak_rss():
+    try:
+        return proc_status('VmHWM')
+    except OSError:
+        # ru_maxrss is in kilobytes on Linux and in bytes on macOS.
+        scale = 1 if sys.platform == 'darwin' else 1024
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+
+
+class Stage:
+    """
+    Times one block of work for a Recorder. Set rows_out inside the block when it produces rows.
+    """
+
+    def __init__(self, recorder, name, rows_in, fields):
+        self.recorder = recorder
+        self.name = name
+        self.rows_in = rows_in
+        self.rows_out = None
+        self.fields = fields
+
+    def __enter__(self):
+        self.rss = rss() if self.recorder.memory else None
+        self.start = perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        seconds = perf_counter() - self.start
+        record = {'stage': self.name, 'seconds': seconds, 'rows_in': self.rows_in, 'rows_out': self.rows_out}
+        if self.rows_in is not None and seconds > 0:
+            record['rows_per_sec'] = self.rows_in / seconds
+        if self.rss is not None:
+            record['rss_delta_mb'] = (rss() - self.rss) / 2 ** 20
+        if exc[0] is not None:
+            record['error'] = exc[0].__name__
+        record.update(self.fields)
+        self.recorder.emit(record)
+        return False
+
+
+class Recorder:
+    """
+    Collects one record per instrumented stage (wall time, rows in and out, rows/sec and RSS delta) in records, and
+    also appends it as a JSON line to path and/or passes it to callback.
+
+        rec = Recorder(path='run.jsonl')
+        with rec.stage('aggregates', rows_in=len(df)) as s:
+            aggregates = aggregate_users(df, fx_index)
+            s.rows_out = len(aggregates)
+    """
+
+    enabled = True
+
+    def __init__(self, path=None, callback=None, memory=True):
+        self.path = path
+        self.callback = callback
+        self.memory = memory
+        self.records = []
+
+    def stage(self, name, rows_in=None, **fields):
+        return Stage(self, name, rows_in, fields)
+
+    def record(self, name, **fields):
+        """
+        Adds a record measured elsewhere, e.g. a table load that reports its own rows/sec.
+        """
+
+        self.emit(dict({'stage': name}, **fields))
+
+    def emit(self, record):
+        record['time'] = time.time()
+        self.records.append(record)
+        if self.path is not None:
+            with open(self.path, 'a') as f:
+                f.write(json.dumps(record) + '\n')
+        if self.callback is not None:
+            self.callback(record)
+
+
+class NullStage:
+    rows_out = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+class NullRecorder:
+    """
+    The default when instrumentation is off: stage hands out one shared no-op context manager, so an instrumented
+    block costs a method call and nothing is timed or stored.
+    """
+
+    enabled = False
+    records = []
+
+    def stage(self, name, rows_in=None, **fields):
+        return NULL_STAGE
+
+    def record(self, name, **fields):
+        pass
+
+
+NULL_STAGE = NullStage()
+NULL_RECORDER = NullRecorder()
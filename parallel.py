@@ -0,0 +1,155 @@
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+import numpy as np
+import pandas as pd
+
+from aggregates import MODE_ATTRIBUTES, factorize_sorted, group_starts, top_counts
+from fx import to_timestamps
+
+
+# Columns shared with the workers, set once per worker process by _attach, and the shared memory blocks behind them.
+_shared = {}
+_blocks = []
+
+# The string columns the workers read, as integer codes plus their (few) distinct values.
+CODE_COLUMNS = ['CURRENCY'] + MODE_ATTRIBUTES
+
+
+def _share(arrays):
+    """
+    Copies arrays into new shared memory blocks. Returns the blocks, to be unlinked by the caller, and the
+    (block name, shape, dtype) of every array for _attach.
+    """
+
+    blocks, specs = [], {}
+    try:
+        for name, a in arrays.items():
+            a = np.ascontiguousarray(a)
+            block = shared_memory.SharedMemory(create=True, size=max(a.nbytes, 1))
+            blocks.append(block)
+            np.ndarray(a.shape, dtype=a.dtype, buffer=block.buf)[...] = a
+            specs[name] = (block.name, a.shape, a.dtype.str)
+    except BaseException:
+        _release(blocks)
+        raise
+    return blocks, specs
+
+
+def _release(blocks):
+    for block in blocks:
+        block.close()
+        block.unlink()
+
+
+def _attach(specs, values):
+    """
+    Maps the shared arrays of specs into this worker, without copying them; values, the distinct values of the
+    CODE_COLUMNS and the fx index, are small enough to be passed as they are.
+    """
+
+    for name, (block_name, shape, dtype) in specs.items():
+        block = shared_memory.SharedMemory(name=block_name)
+        _blocks.append(block)
+        _shared[name] = np.ndarray(shape, dtype=dtype, buffer=block.buf)
+    _shared.update(values)
+
+
+def _aggregate_shard(bounds):
+    """
+    The per-user aggregates of aggregates.partial_aggregates for the rows of one shard, order[lo:hi]. The USD amounts
+    and value counts of those rows are computed here, so the parent does no per-row work but the sort and the codes.
+    """
+
+    a = _shared
+    lo, hi = bounds
+    rows = a['order'][lo:hi]
+    if not len(rows):
+        return None
+    users = a['user_codes'][rows]
+    ts = a['ts'][rows]
+    currency = pd.Categorical.from_codes(a['CURRENCY'][rows], a['CURRENCY_values'])
+    amount_usd = a['fx_index'].to_usd(a['AMOUNT'][rows], currency, ts.view('datetime64[ns]'))
+
+    # rows is in file order, so on equal timestamps the first transaction is the first one in the file.
+    order = np.lexsort((ts, users))
+    starts = group_starts(users[order])
+    first = order[starts]
+    res = {'users': users[first],
+           'first_row': rows[first],
+           'first_amount_usd': amount_usd[first],
+           'amount_usd': np.fmax.reduceat(amount_usd[order], starts),
+           'n_transactions': np.diff(np.r_[starts, len(order)])}
+
+    for attr in MODE_ATTRIBUTES:
+        # Codes in value order, so ties still go to the smallest value.
+        codes, uniques = a[attr][rows], a[attr + '_values']
+        n_values = max(len(uniques), 1)
+        valid = codes >= 0
+        keys, counts = np.unique(users[valid].astype('int64') * n_values + codes[valid], return_counts=True)
+        top_users, vals = top_counts(keys // n_values, keys % n_values, counts)
+        res[attr] = top_users, uniques[vals]
+    return res
+
+
+def aggregate_users_parallel(df_transactions, fx_index, n_shards=None, max_workers=None, start_method=None):
+    """
+    aggregate_users with the users hash-partitioned by USER_ID into n_shards, each shard aggregated in a worker
+    process. The parent factorizes USER_ID and the string columns, takes the timestamps and sorts the rows by shard
+    once, with a stable radix sort, so every shard is one slice of row positions in file order; the workers convert
+    the amounts and count the values of their own rows. The shards are scattered back by user code, so the result is
+    identical to aggregate_users whatever the number of shards.
+
+    The columns reach the workers through shared memory as numbers and integer codes, so whatever the start method
+    (start_method, the platform default when None) no worker gets a pickled copy of them. Timestamps that are still
+    strings are parsed in the parent; datetime64 ones, as from cache.load_tables, are only viewed as integers.
+    """
+
+    n_shards = n_shards or os.cpu_count()
+    user_codes, user_ids = pd.factorize(df_transactions['USER_ID'])
+    shards = pd.util.hash_array(np.asarray(user_ids, dtype=object)) % n_shards
+    row_shards = shards.astype('int16' if n_shards <= np.iinfo('int16').max else 'int64')[user_codes]
+    order = np.argsort(row_shards, kind='stable')
+    bounds = np.r_[0, np.cumsum(np.bincount(row_shards, minlength=n_shards))]
+
+    arrays = {'user_codes': user_codes, 'order': order, 'ts': to_timestamps(df_transactions['CREATED_DATE']),
+              'AMOUNT': df_transactions['AMOUNT'].values}
+    values = {'fx_index': fx_index}
+    for c in CODE_COLUMNS:
+        codes, uniques = factorize_sorted(df_transactions[c].values)
+        arrays[c] = codes.astype('int32')
+        values[c + '_values'] = uniques
+
+    n_users = len(user_ids)
+    first_row = np.zeros(n_users, dtype='int64')
+    first_amount = np.zeros(n_users)
+    max_amount = np.zeros(n_users)
+    n_transactions = np.zeros(n_users, dtype='int64')
+    modes = {attr: np.full(n_users, np.nan, dtype=object) for attr in MODE_ATTRIBUTES}
+
+    context = multiprocessing.get_context(start_method)
+    blocks, specs = _share(arrays)
+    try:
+        with ProcessPoolExecutor(max_workers=max_workers, mp_context=context, initializer=_attach,
+                                 initargs=(specs, values)) as executor:
+            for res in executor.map(_aggregate_shard, zip(bounds[:-1], bounds[1:])):
+                if res is None:
+                    continue
+                first_row[res['users']] = res['first_row']
+                first_amount[res['users']] = res['first_amount_usd']
+                max_amount[res['users']] = res['amount_usd']
+                n_transactions[res['users']] = res['n_transactions']
+                for attr in MODE_ATTRIBUTES:
+                    users, vals = res[attr]
+                    modes[attr][users] = vals
+    finally:
+        _release(blocks)
+
+    res = pd.DataFrame(modes, index=pd.Index(user_ids, name='USER_ID'))
+    res['FIRST_STATE'] = df_transactions['STATE'].values[first_row]
+    res['FIRST_AMOUNT_USD'] = first_amount
+    res['AMOUNT_USD'] = max_amount
+    res['N_TRANSACTIONS'] = n_transactions
+    return res
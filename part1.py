@@ -1,7 +1,9 @@
 import numpy as np
 import pandas as pd
 from time import time
+import io
 import sys
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from sqlalchemy import create_engine
 from sqlalchemy import Column
@@ -12,7 +14,10 @@ from sqlalchemy.schema import MetaData
 import warnings
 warnings.filterwarnings("ignore")
 
-from transformations import transform_part1
+from cache import load_tables
+from sql_features import create_feature_views, refresh_first_transactions
+from instrumentation import Recorder, NULL_RECORDER
+from transformations import transform_part1, country_code_lookup, transform_transactions, transform_users, transform_fx, transform_currency
 
 
 def load_data(file_name, index_col=0):
@@ -72,18 +77,289 @@ class currency_details(Base):
     exponent = Column('exponent', INTEGER)
     is_crypto = Column('is_crypto', BOOLEAN, nullable=False)
 
+
+class etl_watermarks(Base):
+    __tablename__ = 'etl_watermarks'
+    table_name = Column('table_name', VARCHAR(30), primary_key=True)
+    watermark = Column('watermark', TIMESTAMP)
+    rows = Column('rows', BIGINT)
+    updated_at = Column('updated_at', TIMESTAMP, nullable=False)
+
+
+# Bulk loading. Each table is described by its (dataframe column, table column) pairs and its
+# integer columns, which pandas reads back as floats whenever they contain NaN.
+BULK_TABLES = {
+    'transactions': {
+        'columns': [('CURRENCY', 'currency'), ('AMOUNT', 'amount'), ('STATE', 'state'), ('CREATED_DATE', 'created_date'),
+                    ('MERCHANT_CATEGORY', 'merchant_category'), ('MERCHANT_COUNTRY', 'merchant_country'),
+                    ('ENTRY_METHOD', 'entry_method'), ('USER_ID', 'user_id'), ('TYPE', 'type'), ('SOURCE', 'source'),
+                    ('ID', 'id')],
+        'integers': ['AMOUNT'],
+    },
+    'users': {
+        'columns': [('ID', 'id'), ('HAS_EMAIL', 'has_email'), ('PHONE_COUNTRY', 'phone_country'),
+                    ('IS_FRAUDSTER', 'is_fraudster'), ('TERMS_VERSION', 'terms_version'), ('CREATED_DATE', 'created_date'),
+                    ('STATE', 'state'), ('COUNTRY', 'country'), ('BIRTH_YEAR', 'birth_year'), ('KYC', 'kyc'),
+                    ('FAILED_SIGN_IN_ATTEMPTS', 'failed_sign_in_attempts')],
+        'integers': ['BIRTH_YEAR', 'FAILED_SIGN_IN_ATTEMPTS'],
+    },
+    'fx_rates': {
+        'columns': [('TS', 'ts'), ('BASE_CCY', 'base_ccy'), ('CCY', 'ccy'), ('RATE', 'rate')],
+        'integers': [],
+    },
+    'currency_details': {
+        'columns': [('currency', 'ccy'), ('iso_code', 'iso_code'), ('exponent', 'exponent'), ('is_crypto', 'is_crypto')],
+        'integers': ['iso_code', 'exponent'],
+    },
+}
+
+
+# Incremental loading: the primary key of each table, and the column whose newest loaded value is its watermark. Rows
+# older than the watermark are skipped, except for the tables that are upserted in full: users (state, KYC and
+# is_fraudster change) and currency_details (a few rows).
+INCREMENTAL_TABLES = {
+    'transactions': {'key': ['id'], 'watermark': ('CREATED_DATE', 'created_date'), 'upsert': False},
+    'users': {'key': ['id'], 'watermark': ('CREATED_DATE', 'created_date'), 'upsert': True},
+    'fx_rates': {'key': ['ts', 'base_ccy', 'ccy'], 'watermark': ('TS', 'ts'), 'upsert': False},
+    'currency_details': {'key': ['ccy'], 'watermark': None, 'upsert': True},
+}
+
+
+def record_load(rec, table, rows, start, **fields):
+    """
+    Records the rows/sec of a table load that started at start with an instrumentation.Recorder. rows is what was
+    committed, 0 for a load that was rolled back (recorded with error=True).
+    """
+    
+    seconds = time() - start
+    rec.record('load.' + table, rows_in=rows, seconds=seconds, rows_per_sec=rows / seconds if seconds else 0., **fields)
+
+
+def read_chunks(file_name, transform, chunksize, index_col=0):
+    """
+    Streams a csv in chunks of chunksize rows, applying transform to each chunk.
+    """
+    
+    for chunk in pd.read_csv(file_name, index_col=index_col, chunksize=chunksize):
+        yield transform(chunk)
+
+
+def copy_chunk(conn, table, df, target=None):
+    """
+    Writes one chunk with COPY FROM STDIN, into target (a staging table) instead of table when given. Falls back to a
+    batched executemany when the driver has no COPY support.
+    """
+    
+    spec = BULK_TABLES[table]
+    df = df[[c for c, _ in spec['columns']]].copy()
+    for c in spec['integers']:
+        df[c] = df[c].astype('Int64')
+    columns = ', '.join(col for _, col in spec['columns'])
+    target = target or table
+    
+    cur = conn.cursor()
+    try:
+        if hasattr(cur, 'copy_expert'):
+            buf = io.StringIO()
+            df.to_csv(buf, index=False, header=False) # Empty unquoted fields are read back as NULL.
+            buf.seek(0)
+            cur.copy_expert('COPY {} ({}) FROM STDIN WITH (FORMAT csv)'.format(target, columns), buf)
+        else:
+            rows = df.astype(object).where(df.notna(), None).values.tolist()
+            placeholders = ', '.join(['%s'] * len(spec['columns']))
+            cur.executemany('INSERT INTO {} ({}) VALUES ({})'.format(target, columns, placeholders), rows)
+    finally:
+        cur.close()
+
+
+def csv_sources(files, chunksize):
+    """
+    A function per table returning its transformed chunks, read from the csvs in files.
+    """
+    
+    code_lookup = country_code_lookup(load_data(files['countries'], index_col=False))
+    df_f = load_data(files['fraudsters'])
+    
+    return {
+        'transactions': lambda: read_chunks(files['transactions'],
+                                            lambda df: transform_transactions(df, code_lookup), chunksize),
+        'users': lambda: read_chunks(files['users'], lambda df: transform_users(df, df_f=df_f), chunksize),
+        'fx_rates': lambda: read_chunks(files['fx'], transform_fx, chunksize, index_col=False),
+        'currency_details': lambda: read_chunks(files['currency'], transform_currency, chunksize, index_col=False),
+    }
+
+
+def bulk_load_table(db, table, chunks):
+    """
+    Loads the chunks of one table over its own connection. Every chunk is committed on its own so a bad chunk is
+    rolled back and reported without losing the chunks around it.
+    """
+    
+    t = time()
+    loaded, errors = 0, []
+    conn = db.raw_connection()
+    try:
+        for i, chunk in enumerate(chunks):
+            try:
+                copy_chunk(conn, table, chunk)
+                conn.commit()
+                loaded += len(chunk)
+            except Exception as e:
+                conn.rollback()
+                errors.append((i, len(chunk), str(e).strip()))
+    finally:
+        conn.close()
+    
+    elapsed = time() - t
+    return {'table': table, 'rows': loaded, 'seconds': elapsed, 'rows_per_sec': loaded / elapsed if elapsed else 0.,
+            'errors': errors}
+
+
+def bulk_load(db, files, chunksize=100000, max_workers=4, instrument=None):
+    """
+    Streams the four csvs into their tables concurrently, one connection per table, and prints rows/sec per table
+    (also recorded by instrument, an instrumentation.Recorder). files holds the same paths as the ORM path in __main__.
+    """
+    
+    sources = csv_sources(files, chunksize)
+    
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(bulk_load_table, db, table, source()) for table, source in sources.items()]
+        reports = [f.result() for f in futures]
+    
+    rec = instrument or NULL_RECORDER
+    for r in reports:
+        rec.record('load.' + r['table'], rows_in=r['rows'], seconds=r['seconds'], rows_per_sec=r['rows_per_sec'],
+                   errors=len(r['errors']))
+        print('{}: {} rows in {:.1f} s ({:.0f} rows/sec)'.format(r['table'], r['rows'], r['seconds'], r['rows_per_sec']))
+        for i, n, err in r['errors']:
+            print('    chunk {} ({} rows) failed and was rolled back: {}'.format(i, n, err))
+    return reports
+
+
+def merge_sql(table, staging):
+    """
+    Moves the rows of staging into table: new keys are inserted, existing ones are skipped, or updated for the upserted
+    tables when a column changed (unchanged rows are not rewritten).
+    """
+    
+    spec = INCREMENTAL_TABLES[table]
+    columns = [col for _, col in BULK_TABLES[table]['columns']]
+    sql = 'INSERT INTO {table} ({columns}) SELECT {columns} FROM {staging} ON CONFLICT ({key}) '.format(
+        table=table, columns=', '.join(columns), staging=staging, key=', '.join(spec['key']))
+    if not spec['upsert']:
+        return sql + 'DO NOTHING'
+    
+    values = [col for col in columns if col not in spec['key']]
+    return sql + 'DO UPDATE SET {} WHERE ({}) IS DISTINCT FROM ({})'.format(
+        ', '.join('{0} = EXCLUDED.{0}'.format(col) for col in values),
+        ', '.join('{}.{}'.format(table, col) for col in values),
+        ', '.join('EXCLUDED.' + col for col in values))
+
+
+def incremental_load_table(db, table, chunks):
+    """
+    Loads the rows of one table that are new since its watermark. Every chunk is copied into a temporary staging table
+    and merged with merge_sql in its own transaction. The watermark only moves once every chunk went in, so an
+    interrupted or failed run is simply run again: rows it already loaded are skipped by their keys.
+    """
+    
+    t = time()
+    spec = INCREMENTAL_TABLES[table]
+    staging = 'staging_' + table
+    read, changed, errors, newest = 0, 0, [], None
+    conn = db.raw_connection()
+    try:
+        cur = conn.cursor()
+        cur.execute('SELECT watermark FROM etl_watermarks WHERE table_name = %s', (table,))
+        found = cur.fetchone()
+        watermark = found[0] if found else None
+        cur.execute('CREATE TEMPORARY TABLE IF NOT EXISTS {} (LIKE {}) ON COMMIT DELETE ROWS'.format(staging, table))
+        conn.commit()
+        
+        for i, chunk in enumerate(chunks):
+            read += len(chunk)
+            if spec['watermark'] is not None:
+                dates = pd.to_datetime(chunk[spec['watermark'][0]])
+                if len(dates):
+                    newest = max(newest, dates.max()) if newest is not None else dates.max()
+                # Rows at the watermark itself are kept: more of them may have arrived after the last run.
+                if watermark is not None and not spec['upsert']:
+                    chunk = chunk[(dates >= watermark).values]
+            if not len(chunk):
+                continue
+            try:
+                copy_chunk(conn, table, chunk, target=staging)
+                cur.execute(merge_sql(table, staging))
+                changed += cur.rowcount
+                conn.commit()
+            except Exception as e:
+                conn.rollback()
+                errors.append((i, len(chunk), str(e).strip()))
+        
+        if not errors:
+            cur.execute("""
+                INSERT INTO etl_watermarks (table_name, watermark, rows, updated_at) VALUES (%s, %s, %s, now())
+                ON CONFLICT (table_name) DO UPDATE SET
+                    watermark = GREATEST(etl_watermarks.watermark, EXCLUDED.watermark),
+                    rows = EXCLUDED.rows, updated_at = EXCLUDED.updated_at
+            """, (table, newest.to_pydatetime() if newest is not None else None, changed))
+            conn.commit()
+    finally:
+        conn.close()
+    
+    elapsed = time() - t
+    return {'table': table, 'rows': changed, 'read': read, 'seconds': elapsed,
+            'rows_per_sec': read / elapsed if elapsed else 0., 'errors': errors, 'watermark': watermark}
+
+
+def incremental_load(db, files, chunksize=100000, max_workers=4, instrument=None):
+    """
+    Incremental version of bulk_load for an existing database: only transactions and fx rates newer than the last
+    load are written, users and currencies are upserted, and first_transactions is refreshed when anything changed.
+    Running it twice on the same files changes nothing the second time.
+    """
+    
+    sources = csv_sources(files, chunksize)
+    
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(incremental_load_table, db, table, source()) for table, source in sources.items()]
+        reports = [f.result() for f in futures]
+    
+    rec = instrument or NULL_RECORDER
+    for r in reports:
+        rec.record('load.' + r['table'], rows_in=r['read'], rows_out=r['rows'], seconds=r['seconds'],
+                   rows_per_sec=r['rows_per_sec'], errors=len(r['errors']))
+        print('{}: {} new or changed rows of {} read in {:.1f} s (previous watermark {})'.format(
+            r['table'], r['rows'], r['read'], r['seconds'], r['watermark']))
+        for i, n, err in r['errors']:
+            print('    chunk {} ({} rows) failed and was rolled back, the watermark was kept: {}'.format(i, n, err))
+    
+    # Indexes and the view are created on the first run; afterwards the view only needs refreshing.
+    create_feature_views(db)
+    if any(r['rows'] for r in reports if r['table'] != 'users'):
+        refresh_first_transactions(db, concurrently=True)
+    return reports
+
     
 if __name__ == "__main__":
     
     t = time()
     
+    # Optional JSON lines log of the rows/sec of every table load: --log FILE
+    rec = Recorder(path=sys.argv[sys.argv.index('--log') + 1]) if '--log' in sys.argv else NULL_RECORDER
+    
+    # Incremental mode keeps an existing database and only loads what is new: --incremental
+    incremental = '--incremental' in sys.argv
+    
     try:
         db = create_engine("postgres://postgres@/postgres")
         conn = db.connect()
         conn.execute("commit")
-        conn.execute("DROP DATABASE IF EXISTS fraud")
-        conn.execute("commit")
-        conn.execute("CREATE DATABASE fraud")
+        if not (incremental and conn.execute("SELECT 1 FROM pg_database WHERE datname = 'fraud'").first()):
+            conn.execute("DROP DATABASE IF EXISTS fraud")
+            conn.execute("commit")
+            conn.execute("CREATE DATABASE fraud")
         conn.close()
         db = create_engine("postgres://postgres@/fraud")   
     except:
@@ -101,21 +377,35 @@ if __name__ == "__main__":
     file_name_fx = 'train/fx_rates.csv'
     file_name_currency = 'train/currency_details.csv'
     
-    # Store data in pandas dataframes so we can do the required transformations before inserting into database.
-    df_t = load_data(file_name_transactions)
-    df_u = load_data(file_name_users)
-    df_f = load_data(file_name_fraudsters)
-    df_countries = load_data(file_name_countries, index_col=False)
-    df_fx = load_data(file_name_fx, index_col=False)
-    df_c = load_data(file_name_currency, index_col=False)
+    files = {'transactions': file_name_transactions,
+             'countries': file_name_countries,
+             'users': file_name_users,
+             'fraudsters': file_name_fraudsters,
+             'fx': file_name_fx,
+             'currency': file_name_currency}
+    
+    if incremental:
+        incremental_load(db, files, instrument=rec)
+        print('Database has been updated successfully. Time Elapsed: ' + str(time()-t) + ' s.')
+        sys.exit()
     
-    # Please see transformation.py to see the details.
-    df_t, df_u, df_fx, df_c = transform_part1(df_t, df_u, df_countries, df_fx, df_c, df_f=df_f, test_time=False)
+    # Bulk mode: stream every csv in chunks with COPY, all four tables at once.
+    if '--bulk' in sys.argv:
+        bulk_load(db, files, instrument=rec)
+        create_feature_views(db)
+        print('Database has been loaded successfully. Time Elapsed: ' + str(time()-t) + ' s.')
+        sys.exit()
+    
+    # Store data in pandas dataframes so we can do the required transformations before inserting into database.
+    # Please see transformation.py to see the details. The transformed tables are cached, see cache.py.
+    with rec.stage('load_tables', rows_in=None):
+        df_t, df_u, df_fx, df_c = load_tables(files, test_time=False)
     
     print('Tables instantiated and data ready. Now loading the tables with the data (this may take a while...')
 
     # Insert into transactions table
     s = create_session(db)
+    start = time()
  
     try:
         for _, row in df_t.iterrows():
@@ -134,9 +424,11 @@ if __name__ == "__main__":
             })
             s.add(record)
         s.commit()
+        record_load(rec, 'transactions', len(df_t), start)
     except:
         print('Error inserting into transactions table. Rolling back...')
         s.rollback() 
+        record_load(rec, 'transactions', 0, start, error=True)
 
     finally:
         print('Transactions table successfully loaded...')
@@ -145,6 +437,7 @@ if __name__ == "__main__":
         
     # Insert into Users table    
     s = create_session(db)
+    start = time()
     
     try:
         for _, row in df_u.iterrows():
@@ -163,15 +456,18 @@ if __name__ == "__main__":
             })
             s.add(record)
         s.commit()
+        record_load(rec, 'users', len(df_u), start)
     except:
         print('Error inserting into users table. Rolling back...')
         s.rollback()
+        record_load(rec, 'users', 0, start, error=True)
     finally:
         print('Users table successfully loaded...')
         s.close()
     
     # Insert into fx_rates table    
     s = create_session(db)
+    start = time()
     
     try:
         for _, row in df_fx.iterrows():
@@ -183,9 +479,11 @@ if __name__ == "__main__":
             })
             s.add(record)
         s.commit()
+        record_load(rec, 'fx_rates', len(df_fx), start)
     except:
         print('Error inserting into fx_rates table. Rolling back...')
         s.rollback()
+        record_load(rec, 'fx_rates', 0, start, error=True)
     finally:
         print('fx_rates table successfully loaded...')
         s.close()
@@ -194,6 +492,7 @@ if __name__ == "__main__":
     # Insert into currency_details table
 
     s = create_session(db)
+    start = time()
 
     for _, row in df_c.iterrows():
         record = currency_details(**{
@@ -204,9 +503,13 @@ if __name__ == "__main__":
         })
         s.add(record)
     s.commit()
+    record_load(rec, 'currency_details', len(df_c), start)
 
     print('Currency table successfully loaded...')
     
+    # Indexes and the first_transactions view used by generate_features(backend='sql')
+    create_feature_views(db)
+    
     print('Database has been loaded successfully. Time Elapsed: ' + str(time()-t) + ' s.')
     
     
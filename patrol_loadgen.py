@@ -0,0 +1,71 @@
+import argparse
+import asyncio
+import collections
+import csv
+import json
+import random
+import time
+
+import numpy as np
+
+
+async def client(host, port, ids, deadline, in_flight, latencies):
+    """
+    One connection keeping in_flight requests pipelined until the deadline.
+    """
+
+    reader, writer = await asyncio.open_connection(host, port)
+    sent = collections.deque()
+
+    async def send():
+        writer.write((json.dumps({'user_id': random.choice(ids)}) + '\n').encode())
+        sent.append(time.perf_counter())
+        await writer.drain()
+
+    for _ in range(in_flight):
+        await send()
+    while sent:
+        line = await reader.readline()
+        if not line:
+            break
+        latencies.append(time.perf_counter() - sent.popleft())
+        if time.perf_counter() < deadline:
+            await send()
+    writer.close()
+
+
+async def stats(host, port):
+    reader, writer = await asyncio.open_connection(host, port)
+    writer.write(b'{"stats": true}\n')
+    await writer.drain()
+    response = json.loads(await reader.readline())
+    writer.close()
+    return response
+
+
+async def main(args):
+    with open(args.users) as f:
+        ids = [row['ID'] for row in csv.DictReader(f)]
+
+    latencies = []
+    start = time.perf_counter()
+    await asyncio.gather(*[client(args.host, args.port, ids, start + args.duration, args.in_flight, latencies)
+                           for _ in range(args.connections)])
+    elapsed = time.perf_counter() - start
+
+    latencies = np.array(latencies) * 1000
+    print('{} requests in {:.1f} s: {:.0f} requests/sec'.format(len(latencies), elapsed, len(latencies) / elapsed))
+    print('client latency p50 {:.2f} ms, p99 {:.2f} ms'.format(np.percentile(latencies, 50), np.percentile(latencies, 99)))
+    print('server', await stats(args.host, args.port))
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Load generator for patrol_server.py.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--users', default='test_users.csv', help='csv with an ID column to draw user ids from')
+    parser.add_argument('--connections', type=int, default=16)
+    parser.add_argument('--in-flight', type=int, default=4, help='pipelined requests per connection')
+    parser.add_argument('--duration', type=float, default=10.)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,197 @@
+import argparse
+import asyncio
+import collections
+import json
+import os
+import pickle
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+from action import DECISIONS, action_code
+from aggregates import aggregate_users
+from compiled_model import load_compiled
+from generate_features import user_frame
+from pipeline import FeaturePipeline, PIPELINE_PATH, CLF_PATH
+from scoring import UserScorer
+from transformations import transform_part1
+
+
+def load_data(file_name, index_col=0):
+    df = pd.read_csv(file_name, index_col=index_col)
+    return df
+
+
+def build_scorer(file_name_users, file_name_transactions, file_name_countries, file_name_fx, file_name_currency):
+    """
+    Loads the tables once and keeps them indexed in a UserScorer. Without models/pipeline.pkl the preprocessing is
+    fitted on the loaded users, like test.py does; the compiled copy of the model (see compiled_model.load_compiled)
+    scores when there is one.
+    """
+
+    df_t, df_u, df_fx, df_c = transform_part1(load_data(file_name_transactions),
+                                              load_data(file_name_users),
+                                              load_data(file_name_countries, index_col=False),
+                                              load_data(file_name_fx, index_col=False),
+                                              load_data(file_name_currency, index_col=False))
+    if os.path.exists(PIPELINE_PATH):
+        scorer = UserScorer.load(df_u, df_t, df_fx, df_c)
+        source = PIPELINE_PATH
+    else:
+        with open(CLF_PATH, 'rb') as f:
+            pipeline = FeaturePipeline(clf=pickle.load(f))
+        scorer = UserScorer(pipeline, df_u, df_t, df_fx, df_c)
+        pipeline.fit(user_frame(df_u.copy(), aggregate_users(df_t, scorer.fx_index)))
+        source = CLF_PATH
+
+    # Single users and small batches are scored much faster by the compiled model (see compiled_model.py).
+    compiled = load_compiled(source)
+    if compiled is not None:
+        scorer.pipeline.clf = compiled
+    return scorer
+
+
+class MicroBatcher:
+    """
+    Coalesces concurrent requests: the first request of a batch waits max_wait seconds for others to arrive, then
+    up to max_batch users are scored with a single predict_proba call in a worker thread.
+    """
+
+    def __init__(self, score, max_batch=256, max_wait=0.002, window=10000):
+        self.score = score
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.queue = asyncio.Queue()
+        self.latencies = collections.deque(maxlen=window)
+        self.batch_sizes = collections.Counter()
+        self.requests = 0
+
+    async def submit(self, user_id):
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((user_id, future, time.perf_counter()))
+        return await future
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            await asyncio.sleep(self.max_wait)
+            while len(batch) < self.max_batch and not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+
+            try:
+                confidences = await loop.run_in_executor(None, self.score, [user_id for user_id, _, _ in batch])
+            except Exception as e:
+                for _, future, _ in batch:
+                    future.set_exception(e)
+                continue
+
+            done = time.perf_counter()
+            for (_, future, start), c in zip(batch, confidences):
+                future.set_result(float(c))
+                self.latencies.append(done - start)
+            self.batch_sizes[len(batch)] += 1
+            self.requests += len(batch)
+
+    def stats(self):
+        latencies = np.array(self.latencies) * 1000
+        batches = sum(self.batch_sizes.values())
+        return {'requests': self.requests,
+                'batches': batches,
+                'mean_batch_size': self.requests / batches if batches else 0.,
+                'max_batch_size': max(self.batch_sizes) if batches else 0,
+                'p50_ms': float(np.percentile(latencies, 50)) if len(latencies) else None,
+                'p99_ms': float(np.percentile(latencies, 99)) if len(latencies) else None}
+
+
+class PatrolServer:
+    """
+    Line-delimited JSON over TCP. {"user_id": ...} returns the user's confidence and decision, {"stats": true} the
+    latency and batch size counters.
+    """
+
+    def __init__(self, scorer, max_batch=256, max_wait=0.002):
+        self.scorer = scorer
+        self.batcher = MicroBatcher(scorer.score_users, max_batch=max_batch, max_wait=max_wait)
+
+    async def respond(self, line):
+        try:
+            request = json.loads(line)
+        except ValueError:
+            return {'error': 'invalid json'}
+
+        if not isinstance(request, dict):
+            return {'error': 'invalid request'}
+        if request.get('stats'):
+            return self.batcher.stats()
+
+        user_id = request.get('user_id')
+        try:
+            known = user_id in self.scorer.users.index
+        except TypeError:
+            # Lists and objects cannot be user ids.
+            return {'user_id': user_id, 'error': 'invalid user id'}
+        if not known:
+            return {'user_id': user_id, 'error': 'unknown user'}
+        try:
+            confidence = await self.batcher.submit(user_id)
+        except Exception as e:
+            return {'user_id': user_id, 'error': str(e)}
+        return {'user_id': user_id, 'confidence': confidence, 'decision': DECISIONS[action_code(confidence)]}
+
+    async def handle(self, reader, writer):
+        pending = set()
+        lock = asyncio.Lock()
+
+        async def reply(line):
+            response = await self.respond(line)
+            async with lock:
+                writer.write((json.dumps(response) + '\n').encode())
+                await writer.drain()
+
+        # Requests on one connection are answered as they complete, so a client can pipeline them.
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            task = asyncio.ensure_future(reply(line))
+            pending.add(task)
+            task.add_done_callback(pending.discard)
+
+        if pending:
+            await asyncio.wait(pending)
+        writer.close()
+
+    async def serve(self, host, port):
+        batcher = asyncio.ensure_future(self.batcher.run())
+        server = await asyncio.start_server(self.handle, host, port)
+        print('Patrol service listening on {}:{}'.format(host, port))
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            batcher.cancel()
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Long-running patrol scoring service.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--max-batch', type=int, default=256)
+    parser.add_argument('--max-wait-ms', type=float, default=2.)
+    parser.add_argument('--users', default='test_users.csv')
+    parser.add_argument('--transactions', default='test_transactions.csv')
+    args = parser.parse_args()
+
+    try:
+        scorer = build_scorer(args.users, args.transactions, 'train/countries.csv', 'train/fx_rates.csv',
+                              'train/currency_details.csv')
+    except OSError:
+        print('There was an issue importing the files. Please see the README and try again.')
+        sys.exit()
+
+    server = PatrolServer(scorer, max_batch=args.max_batch, max_wait=args.max_wait_ms / 1000)
+    asyncio.run(server.serve(args.host, args.port))
@@ -0,0 +1,115 @@
+import pickle
+import numpy as np
+import pandas as pd
+
+from sklearn.preprocessing import StandardScaler
+
+from velocity import VELOCITY_COLUMNS
+
+
+PIPELINE_PATH = 'models/pipeline.pkl'
+
+# The classifier scored with when there is no pipeline, the preprocessing then being fitted on the batch.
+CLF_PATH = 'models/rf_clf.pkl'
+
+
+def one_hot(values, classes):
+    """
+    One-hot encodes values against a fixed, sorted list of classes (the same columns LabelEncoder + OneHotEncoder
+    give when fitted on those classes). Values outside the classes get an all-zero row.
+    """
+
+    codes = pd.Categorical(values, categories=classes).codes
+    encoded = np.zeros((len(codes), len(classes)))
+    known = codes >= 0
+    encoded[np.flatnonzero(known), codes[known]] = 1
+    return encoded
+
+
+class FeaturePipeline:
+    """
+    The preprocessing of generate_features with its fitted state kept, so that any batch (down to one user) is
+    transformed exactly like the training set: the KYC classes behind F1..F4, the TYPE classes behind G1..G6, the
+    newest terms version and the StandardScaler. With clf set it is the one artifact needed for scoring.
+    With velocity the VELOCITY_COLUMNS of velocity.py follow the other features.
+    """
+
+    # Class level so pipelines pickled before the velocity features load without them.
+    velocity = False
+
+    def __init__(self, clf=None, velocity=False):
+        self.kyc_classes = None
+        self.type_classes = None
+        self.newest_terms = None
+        self.scaler = None
+        self.clf = clf
+        self.velocity = velocity
+
+    @property
+    def fitted(self):
+        return self.scaler is not None
+
+    @property
+    def columns(self):
+        return (['F' + str(i + 1) for i in range(len(self.kyc_classes))] + ['BIRTH_YEAR', 'COUNTRY_ISGB'] +
+                ['G' + str(i + 1) for i in range(len(self.type_classes))] +
+                ['TERMS_VERSION', 'ID_CHECK', 'AMOUNT_USD', 'FIRST_SUCCESS', 'COUNTRIES_MATCH'] +
+                (VELOCITY_COLUMNS if self.velocity else []))
+
+    def fit(self, df_users, batch_size=None):
+        """
+        Fits on the user frame built by generate_features.user_frame. With batch_size the scaler is fitted that many
+        users at a time, so the unscaled matrix is never built whole.
+        """
+
+        self.kyc_classes = np.unique(df_users['KYC'].values)
+        self.type_classes = np.unique(df_users['TYPE'].fillna('NaN').values)
+        self.newest_terms = df_users['TERMS_VERSION'].max()
+
+        # Standard scaler subtracts the mean and scales to unit variance. This will help for SVM and LR classifiers
+        # which are senstive to scale. Won't make much difference for tree-based methods (Decision Trees, Random
+        # Forests, etc.) Empirically, this has helped the accuracy.
+        if batch_size is None:
+            self.scaler = StandardScaler().fit(self.unscaled(df_users))
+        else:
+            self.scaler = StandardScaler()
+            for start in range(0, len(df_users), batch_size):
+                self.scaler.partial_fit(self.unscaled(df_users.iloc[start:start + batch_size]))
+        return self
+
+    def unscaled(self, df_users):
+        """
+        The feature matrix before scaling, columns in the order of self.columns.
+        """
+
+        return np.column_stack([one_hot(df_users['KYC'].values, self.kyc_classes),
+                                df_users['BIRTH_YEAR'].values,
+                                df_users['COUNTRY_ISGB'].values,
+                                one_hot(df_users['TYPE'].fillna('NaN').values, self.type_classes),
+                                (df_users['TERMS_VERSION'].values == self.newest_terms).astype(int),
+                                df_users['ID_CHECK'].values,
+                                df_users['AMOUNT_USD'].values,
+                                df_users['FIRST_SUCCESS'].values,
+                                df_users['COUNTRIES_MATCH'].values] +
+                               [df_users[c].values for c in (VELOCITY_COLUMNS if self.velocity else [])]
+                               ).astype('float64')
+
+    def transform(self, df_users):
+        return self.scaler.transform(self.unscaled(df_users))
+
+    def predict_proba(self, df_users):
+        """
+        Fraud probability per user, with the LOCKED override of test.py (locked users are fraudsters).
+        """
+
+        probabilities = self.clf.predict_proba(self.transform(df_users))[:, 1]
+        return np.where(df_users['STATE'].values == 'LOCKED', 1., probabilities)
+
+    def save(self, path=PIPELINE_PATH):
+        with open(path, 'wb') as f:
+            pickle.dump(self, f)
+
+    @staticmethod
+    def load(path=PIPELINE_PATH):
+        with open(path, 'rb') as f:
+            return pickle.load(f)
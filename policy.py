@@ -0,0 +1,145 @@
+import argparse
+import sys
+from time import perf_counter
+
+import numpy as np
+import pandas as pd
+
+from action import ALERT_THRESHOLD, LOCK_THRESHOLD
+
+
+# Cost of every outcome of a policy, in the same (arbitrary) unit. The bank pays for every alert an agent reviews and
+# for fraudsters it does not lock (less when an agent was at least alerted); customers pay when they are locked out
+# without being fraudsters.
+DEFAULT_COSTS = {'review': 1.,
+                 'missed_fraud': 100.,
+                 'alerted_fraud': 30.,
+                 'locked_customer': 20.}
+
+
+def counts_above(sorted_values, thresholds, strict):
+    """
+    Number of sorted_values above each threshold (at or above it unless strict).
+    """
+
+    return len(sorted_values) - np.searchsorted(sorted_values, thresholds, side='right' if strict else 'left')
+
+
+def simulate(confidences, labels, alerts, locks, costs=DEFAULT_COSTS):
+    """
+    Outcome of every (alert, lock) threshold pair under the rule of action.action_codes: a user is alerted above the
+    alert threshold and locked as well from the lock threshold on. Sorted confidences give, by binary search, the
+    number of users and of fraudsters past every threshold, and the pairs combine those by broadcasting, so the
+    cost is O(n log n + pairs) whatever the number of users. Returns one row per pair, lock varying fastest.
+    """
+
+    confidences = np.asarray(confidences, dtype='float64')
+    labels = np.asarray(labels, dtype=bool)
+    # Sorting all the confidences and those of the fraudsters separately is cheaper than an argsort.
+    everyone, fraud = np.sort(confidences), np.sort(confidences[labels])
+    n, positives = len(everyone), len(fraud)
+
+    alerts = np.asarray(alerts, dtype='float64')[:, np.newaxis]
+    locks = np.asarray(locks, dtype='float64')[np.newaxis, :]
+    flagged, flagged_fraud = counts_above(everyone, alerts, True), counts_above(fraud, alerts, True)
+    locked, locked_fraud = counts_above(everyone, locks, False), counts_above(fraud, locks, False)
+    # Only alerted users are locked: a lock threshold at or below the alert one locks every alerted user.
+    lock_all = locks <= alerts
+    locked = np.where(lock_all, flagged, locked)
+    locked_fraud = np.where(lock_all, flagged_fraud, locked_fraud)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        res = pd.DataFrame({'alert': np.broadcast_to(alerts, locked.shape).ravel(),
+                            'lock': np.broadcast_to(locks, locked.shape).ravel(),
+                            'alerts': (flagged - locked).ravel(),
+                            'locks': locked.ravel(),
+                            'precision': np.broadcast_to(flagged_fraud / flagged, locked.shape).ravel(),
+                            'recall': np.broadcast_to(flagged_fraud / positives, locked.shape).ravel(),
+                            'lock_precision': (locked_fraud / locked).ravel(),
+                            'lock_recall': (locked_fraud / positives).ravel()})
+
+    res['cost'] = (costs['review'] * np.broadcast_to(flagged, locked.shape)
+                   + costs['missed_fraud'] * (positives - np.broadcast_to(flagged_fraud, locked.shape))
+                   + costs['alerted_fraud'] * (flagged_fraud - locked_fraud)
+                   + costs['locked_customer'] * (locked - locked_fraud)).ravel()
+    res.attrs.update(users=n, fraudsters=positives)
+    return res
+
+
+def best_policy(sweep):
+    """
+    The row of the cheapest pair. Ties go to the highest thresholds, the ones that bother the fewest users.
+    """
+
+    cheapest = sweep[sweep['cost'] == sweep['cost'].min()]
+    return cheapest.sort_values(['alert', 'lock'], ascending=False).iloc[0]
+
+
+def load_scores(predictions_path, fraudsters_path):
+    """
+    Confidences of predictions.csv and whether each user is in the fraudsters file. Raises ValueError when no scored
+    user is, which means the labels are not the ones of the scored users (e.g. training labels for test predictions).
+    """
+
+    df = pd.read_csv(predictions_path, index_col=0, float_precision='round_trip')
+    fraudsters = pd.read_csv(fraudsters_path, index_col=0)
+    labels = df['ID'].isin(fraudsters['user_id']).values
+    if not labels.any():
+        raise ValueError('None of the {} users of {} is in {}: the labels do not belong to these predictions'.format(
+            len(df), predictions_path, fraudsters_path))
+    return df['Confidence'].values, labels
+
+
+def parse_costs(items):
+    costs = dict(DEFAULT_COSTS)
+    for item in items:
+        key, _, value = item.partition('=')
+        if key not in costs:
+            raise ValueError('Unknown cost {}, expected one of {}'.format(key, ', '.join(costs)))
+        costs[key] = float(value)
+    return costs
+
+
+def format_policy(row):
+    return ('alert > {:.3f}, lock >= {:.3f}: {:.0f} alerts, {:.0f} locks, precision {:.3f}, recall {:.3f}, '
+            'lock precision {:.3f}, cost {:.1f}').format(row['alert'], row['lock'], row['alerts'], row['locks'],
+                                                         row['precision'], row['recall'], row['lock_precision'],
+                                                         row['cost'])
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Sweeps the ALERT and LOCK thresholds of action.py over scored, '
+                                                 'labelled users and picks the cheapest pair.')
+    parser.add_argument('--predictions', default='predictions.csv', help='scores as written by test.py')
+    parser.add_argument('--fraudsters', default='test_fraudsters.csv',
+                        help='labels, the known fraudsters among the users of --predictions (for predictions of the '
+                             'training users, train/train_fraudsters.csv)')
+    parser.add_argument('--steps', type=int, default=101, help='thresholds per axis, evenly spaced over [0, 1]')
+    parser.add_argument('--cost', nargs='*', default=[], metavar='NAME=VALUE',
+                        help='override costs: ' + ', '.join('{}={:g}'.format(k, v) for k, v in DEFAULT_COSTS.items()))
+    parser.add_argument('--output', default=None, help='write the whole sweep to this csv')
+    args = parser.parse_args()
+
+    try:
+        confidences, labels = load_scores(args.predictions, args.fraudsters)
+    except OSError:
+        print('{} or {} not found. Please generate the predictions first via test.py'.format(args.predictions,
+                                                                                         args.fraudsters))
+        sys.exit(1)
+    except ValueError as e:
+        print(e)
+        sys.exit(1)
+
+    thresholds = np.linspace(0, 1, args.steps)
+    start = perf_counter()
+    sweep = simulate(confidences, labels, thresholds, thresholds, parse_costs(args.cost))
+    seconds = perf_counter() - start
+
+    current = simulate(confidences, labels, [ALERT_THRESHOLD], [LOCK_THRESHOLD], parse_costs(args.cost)).iloc[0]
+    print('{} users, {} fraudsters, {} pairs in {:.3f} s'.format(sweep.attrs['users'], sweep.attrs['fraudsters'],
+                                                                len(sweep), seconds))
+    print('Current: ' + format_policy(current))
+    print('Best:    ' + format_policy(best_policy(sweep)))
+    if args.output:
+        sweep.to_csv(args.output, index=False)
@@ -0,0 +1,50 @@
+import numpy as np
+import pandas as pd
+
+from aggregates import aggregate_users
+from fx import FxRateIndex
+from generate_features import user_frame
+from pipeline import FeaturePipeline, PIPELINE_PATH
+from velocity import velocity_features, add_velocity
+
+
+class UserScorer:
+    """
+    On-demand scoring with a fitted FeaturePipeline. Users and transactions (after transform_part1) are indexed once
+    by user id, so score_users only builds feature rows for the users asked for.
+    """
+
+    def __init__(self, pipeline, df_users, df_transactions, df_fx, df_currency):
+        self.pipeline = pipeline
+        self.fx_index = FxRateIndex.from_frames(df_fx, df_currency)
+        self.users = df_users.set_index('ID', drop=False)
+
+        # Transactions sorted by user: a user's transactions are the slice between two searchsorted bounds.
+        self.transactions = df_transactions.sort_values('USER_ID', kind='mergesort').reset_index(drop=True)
+        self.transaction_users = self.transactions['USER_ID'].values
+
+    @classmethod
+    def load(cls, df_users, df_transactions, df_fx, df_currency, path=PIPELINE_PATH):
+        return cls(FeaturePipeline.load(path), df_users, df_transactions, df_fx, df_currency)
+
+    def user_transactions(self, user_ids):
+        left = np.searchsorted(self.transaction_users, user_ids, side='left')
+        right = np.searchsorted(self.transaction_users, user_ids, side='right')
+        rows = np.concatenate([np.arange(l, r) for l, r in zip(left, right)] or [np.arange(0)])
+        return self.transactions.iloc[rows]
+
+    def features(self, user_ids):
+        user_ids = np.asarray(user_ids, dtype=object)
+        df_users = self.users.loc[user_ids].reset_index(drop=True)
+        df_transactions = self.user_transactions(user_ids)
+        if self.pipeline.velocity:
+            df_users = add_velocity(df_users, velocity_features(df_transactions, df_users, self.fx_index))
+        return user_frame(df_users, aggregate_users(df_transactions, self.fx_index))
+
+    def score_users(self, user_ids):
+        """
+        Fraud probabilities for user_ids, in the same order. Raises KeyError for unknown users.
+        """
+
+        unique, inverse = np.unique(np.asarray(user_ids, dtype=object), return_inverse=True)
+        return self.pipeline.predict_proba(self.features(unique))[inverse]
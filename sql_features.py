@@ -0,0 +1,150 @@
+import pandas as pd
+
+
+# Secondary indexes for the queries below: transactions per user in time order, and fx rates per currency pair in time
+# order for the as-of lookup (the primary key of fx_rates starts with ts, so it cannot serve it).
+INDEXES = [
+    'CREATE INDEX IF NOT EXISTS transactions_user_id_created_date_idx ON transactions (user_id, created_date)',
+    'CREATE INDEX IF NOT EXISTS fx_rates_base_ccy_ccy_ts_idx ON fx_rates (base_ccy, ccy, ts)',
+]
+
+# Joins that give every transaction t its currency exponent c.exponent and the latest USD rate fx.rate at or before it
+# (none for USD itself, whose rate is 1 as in FxRateIndex). The row comparison and the ORDER BY on all three columns
+# make it a single backward seek on fx_rates (base_ccy, ccy, ts); with equality conditions the planner tends to pick
+# the primary key instead, which starts with ts and has to scan past every other pair. A seek that lands on another
+# pair means there is no rate, which the ON condition turns into NULL.
+FX_JOINS = '''
+    LEFT JOIN currency_details c ON c.ccy = t.currency
+    LEFT JOIN LATERAL (
+        SELECT f.base_ccy, f.ccy, f.rate FROM fx_rates f
+        WHERE (f.base_ccy, f.ccy, f.ts) <= ('USD', t.currency::text, t.created_date) AND f.rate IS NOT NULL
+        ORDER BY f.base_ccy DESC, f.ccy DESC, f.ts DESC
+        LIMIT 1
+    ) fx ON fx.base_ccy = 'USD' AND fx.ccy = t.currency::text AND fx.ccy <> 'USD'
+'''
+
+# Same conversion as FxRateIndex.to_usd: minor units to cash (exponent 0 when unknown, stored as -1 by
+# transform_currency), times the rate, or the cash amount when there is no rate. Same operations in the same order,
+# so the doubles match the pandas path exactly.
+AMOUNT_USD = 't.amount * 10::float8 ^ -(CASE WHEN c.exponent >= 0 THEN c.exponent ELSE 0 END) * COALESCE(fx.rate, 1)'
+
+# The first transaction of every user with its USD amount. Ties on created_date go to the smallest id, where the pandas
+# path keeps the first one in file order.
+FIRST_TRANSACTIONS_VIEW = '''
+CREATE MATERIALIZED VIEW IF NOT EXISTS first_transactions AS
+SELECT t.user_id, t.id, t.created_date, t.state, {amount_usd} AS amount_usd
+FROM (
+    SELECT DISTINCT ON (user_id) * FROM transactions ORDER BY user_id, created_date, id
+) t
+{fx_joins}
+'''.format(amount_usd=AMOUNT_USD, fx_joins=FX_JOINS)
+
+FEATURE_VIEWS = INDEXES + [
+    FIRST_TRANSACTIONS_VIEW,
+    # A unique index lets the view be refreshed concurrently.
+    'CREATE UNIQUE INDEX IF NOT EXISTS first_transactions_user_id_idx ON first_transactions (user_id)',
+]
+
+# The aggregates of aggregates.aggregate_users. mode() keeps the first of the most frequent values in sort order, so
+# with the C collation ties go to the smallest value like in the pandas path. The first transactions are computed here
+# as in FIRST_TRANSACTIONS_VIEW rather than read from it: the view is only as recent as its last refresh, and a user
+# missing from it would lose every feature.
+AGGREGATES_QUERY = '''
+WITH totals AS (
+    SELECT t.user_id,
+           mode() WITHIN GROUP (ORDER BY t.merchant_country COLLATE "C") AS merchant_country,
+           mode() WITHIN GROUP (ORDER BY t.source COLLATE "C") AS source,
+           mode() WITHIN GROUP (ORDER BY t.type COLLATE "C") AS type,
+           MAX({amount_usd}) AS amount_usd,
+           COUNT(*) AS n_transactions
+    FROM transactions t
+    {fx_joins}
+    {where}
+    GROUP BY t.user_id
+), firsts AS (
+    SELECT t.user_id, t.state, {amount_usd} AS amount_usd
+    FROM (
+        SELECT DISTINCT ON (t.user_id) t.* FROM transactions t {where} ORDER BY t.user_id, t.created_date, t.id
+    ) t
+    {fx_joins}
+)
+SELECT totals.user_id::text, totals.merchant_country, totals.source, totals.type, f.state, f.amount_usd,
+       totals.amount_usd, totals.n_transactions
+FROM totals
+LEFT JOIN firsts f ON f.user_id = totals.user_id
+'''
+
+AGGREGATES_COLUMNS = ['USER_ID', 'MERCHANT_COUNTRY', 'SOURCE', 'TYPE', 'FIRST_STATE', 'FIRST_AMOUNT_USD', 'AMOUNT_USD',
+                      'N_TRANSACTIONS']
+
+# Query 2: the users whose first transaction went through and was worth at least $10.
+FIRST_SUCCESS_QUERY = '''
+SELECT user_id::text FROM first_transactions WHERE state = 'COMPLETED' AND amount_usd >= 10
+'''
+
+
+def execute(db, statements):
+    """
+    Runs the statements in one transaction over a raw DBAPI connection, like part1.bulk_load_table.
+    """
+
+    conn = db.raw_connection()
+    try:
+        cur = conn.cursor()
+        for statement in statements:
+            cur.execute(statement)
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def fetch(db, query, params=None):
+    conn = db.raw_connection()
+    try:
+        cur = conn.cursor()
+        cur.execute(query, params)
+        return cur.fetchall()
+    finally:
+        conn.close()
+
+
+def create_feature_views(db):
+    """
+    Creates the indexes and the first_transactions view. Run it once the tables are loaded (see part1.py).
+    """
+
+    execute(db, FEATURE_VIEWS)
+
+
+def refresh_first_transactions(db, concurrently=False):
+    """
+    Recomputes first_transactions after new transactions were loaded. Concurrently keeps the view readable meanwhile.
+    """
+
+    execute(db, ['REFRESH MATERIALIZED VIEW {}first_transactions'.format('CONCURRENTLY ' if concurrently else '')])
+
+
+def sql_aggregates(db, user_ids=None):
+    """
+    aggregate_users computed inside PostgreSQL from the transactions, fx_rates and currency_details tables, for the
+    given users only when user_ids is passed.
+    """
+
+    where, params = '', None
+    if user_ids is not None:
+        where, params = 'WHERE t.user_id = ANY(%(user_ids)s::uuid[])', {'user_ids': list(user_ids)}
+    rows = fetch(db, AGGREGATES_QUERY.format(amount_usd=AMOUNT_USD, fx_joins=FX_JOINS, where=where), params)
+
+    res = pd.DataFrame(rows, columns=AGGREGATES_COLUMNS).set_index('USER_ID')
+    res['FIRST_AMOUNT_USD'] = res['FIRST_AMOUNT_USD'].astype('float64')
+    res['AMOUNT_USD'] = res['AMOUNT_USD'].astype('float64')
+    res['N_TRANSACTIONS'] = res['N_TRANSACTIONS'].astype('int64')
+    return res
+
+
+def first_success_users(db):
+    """
+    Query 2 of part 2 in SQL: the ids of the users whose first transaction was COMPLETED and at least $10.
+    """
+
+    return [user_id for user_id, in fetch(db, FIRST_SUCCESS_QUERY)]
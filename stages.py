@@ -0,0 +1,360 @@
+import argparse
+import copy
+import hashlib
+import inspect
+import json
+import os
+import pickle
+import shutil
+import sys
+import types
+from time import perf_counter
+
+import numpy as np
+import pandas as pd
+
+from aggregates import aggregate_users
+from cache import save_table, load_table, load_tables, source_key, written_directory, is_complete, COMPLETE, CACHE_DIR
+from fx import FxRateIndex
+from generate_features import user_frame
+from pipeline import FeaturePipeline
+from velocity import velocity_features, add_velocity
+
+
+STAGES_DIR = os.path.join(CACHE_DIR, 'stages')
+
+# Modules in this directory count as code the stages depend on; library code does not.
+PROJECT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Module-level constants of these types are part of the code of the functions that read them.
+CONSTANT_TYPES = (bool, int, float, complex, str, bytes, tuple, list, dict, set, frozenset, type(None))
+
+
+class Stage:
+    """
+    One step of a StageGraph: fn is called with the values of inputs (stages or graph inputs) in order and must not
+    modify them. Its code is fn with everything it references in this repository (see dependencies), so that
+    editing any of it invalidates the output. With persist False the output is only kept in memory, for stages
+    cheaper to rerun than to load.
+    """
+
+    def __init__(self, name, fn, inputs, persist=True):
+        self.name = name
+        self.fn = fn
+        self.inputs = inputs
+        self.persist = persist
+
+    def code_hash(self):
+        return code_hash([self.fn])
+
+
+def in_project(obj):
+    """
+    Whether obj is a module, or a function or class defined in a module, of this repository.
+    """
+
+    module = obj if isinstance(obj, types.ModuleType) else sys.modules.get(getattr(obj, '__module__', None) or '')
+    path = getattr(module, '__file__', None)
+    return path is not None and os.path.dirname(os.path.abspath(path)) == PROJECT_DIR
+
+
+def referenced_names(code):
+    """
+    The global and attribute names a code object and the functions, lambdas and comprehensions nested in it use.
+    """
+
+    names = set(code.co_names)
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            names |= referenced_names(const)
+    return names
+
+
+def dependencies(objs):
+    """
+    objs and, recursively, every function, class and module of this repository and every module-level constant they
+    reference by name, as {label: object}. A class brings in all its methods and the class of a bound method comes
+    with it. Code reached only through an argument's methods is not found: the graph inputs account for it (see
+    input_key), stage outputs through the key of the stage that made them.
+    """
+
+    deps, stack = {}, list(objs)
+    while stack:
+        obj = stack.pop()
+        if isinstance(obj, (staticmethod, classmethod)):
+            obj = obj.__func__
+        elif isinstance(obj, property):
+            stack.extend(f for f in [obj.fget, obj.fset, obj.fdel] if f is not None)
+            continue
+        elif inspect.ismethod(obj):
+            stack.extend([obj.__func__, obj.__self__ if inspect.isclass(obj.__self__) else type(obj.__self__)])
+            continue
+        if not isinstance(obj, (types.ModuleType, types.FunctionType, type)):
+            # Class attributes that are not methods.
+            continue
+
+        if isinstance(obj, types.ModuleType):
+            label = obj.__name__
+        else:
+            label = '{}.{}'.format(obj.__module__, obj.__qualname__)
+        if label in deps or not in_project(obj):
+            continue
+        deps[label] = obj
+
+        if inspect.isclass(obj):
+            stack.extend(vars(obj).values())
+        elif inspect.isfunction(obj):
+            for name in referenced_names(obj.__code__):
+                if name not in obj.__globals__:
+                    # A builtin or an attribute name.
+                    continue
+                value = obj.__globals__[name]
+                if isinstance(value, CONSTANT_TYPES):
+                    deps['{}.{}'.format(obj.__module__, name)] = value
+                elif isinstance(value, (types.ModuleType, types.FunctionType, type)):
+                    stack.append(value)
+    return deps
+
+
+def code_hash(objs):
+    """
+    Hash of the source of objs and of all their dependencies, the repr of the constants among them.
+    """
+
+    h = hashlib.sha256()
+    for label, obj in sorted(dependencies(objs).items()):
+        if isinstance(obj, (types.ModuleType, types.FunctionType, type)):
+            source = inspect.getsource(obj)
+        else:
+            # The order of a set depends on the hash seed of the process.
+            source = repr(sorted(map(repr, obj)) if isinstance(obj, (set, frozenset)) else obj)
+        h.update(label.encode() + b'\0' + source.encode() + b'\0')
+    return h.hexdigest()
+
+
+class StageGraph:
+    """
+    Stages memoized on disk under cache_dir/<stage>/<key>. A stage's key hashes its code and the keys of its inputs,
+    and graph inputs are keyed by their content (see input_key), so after an edit only the edited stage and the
+    stages downstream of it are recomputed. log has one (stage, 'computed' or 'cached', seconds) entry per stage run.
+    """
+
+    def __init__(self, stages, cache_dir=STAGES_DIR):
+        self.stages = {stage.name: stage for stage in stages}
+        self.cache_dir = cache_dir
+        self.log = []
+
+    def run(self, targets, inputs, keys=None):
+        """
+        The values of the targets stages. inputs maps the graph inputs to their values, keys optionally to keys
+        already known for them (e.g. the source_key of cached tables), which saves hashing their content.
+        """
+
+        keys = dict(keys or {})
+        values = dict(inputs)
+
+        def key(name):
+            if name not in keys:
+                if name in self.stages:
+                    stage = self.stages[name]
+                    h = hashlib.sha256((name + stage.code_hash()).encode())
+                    for i in stage.inputs:
+                        h.update(key(i).encode())
+                    keys[name] = h.hexdigest()[:16]
+                else:
+                    keys[name] = input_key(values[name])
+            return keys[name]
+
+        def value(name):
+            if name not in values:
+                stage = self.stages[name]
+                directory = os.path.join(self.cache_dir, name, key(name))
+                if stage.persist and is_complete(directory):
+                    t = perf_counter()
+                    values[name] = load_value(directory)
+                    self.log.append((name, 'cached', perf_counter() - t))
+                    # Marks the output as used, for prune.
+                    os.utime(os.path.join(directory, COMPLETE))
+                else:
+                    args = [value(i) for i in stage.inputs]
+                    t = perf_counter()
+                    values[name] = stage.fn(*args)
+                    self.log.append((name, 'computed', perf_counter() - t))
+                    if stage.persist:
+                        save_value(values[name], directory)
+            return values[name]
+
+        return [value(name) for name in targets]
+
+
+def input_key(value):
+    """
+    Content hash of a graph input, with the code of its class when it is one of this repository. Only the fitted
+    state of a FeaturePipeline counts, not its classifier.
+    """
+
+    h = hashlib.sha256()
+    if in_project(type(value)):
+        # The methods the stages call on it.
+        h.update(code_hash([type(value)]).encode())
+    if isinstance(value, pd.DataFrame):
+        h.update(json.dumps([[str(c), str(t)] for c, t in value.dtypes.items()]).encode())
+        h.update(pd.util.hash_pandas_object(value, index=False).values.tobytes())
+    elif isinstance(value, FeaturePipeline):
+        state = (value.velocity, value.kyc_classes, value.type_classes, value.newest_terms)
+        if value.fitted:
+            state += (value.scaler.mean_, value.scaler.scale_)
+        h.update(pickle.dumps(state))
+    else:
+        h.update(pickle.dumps(value))
+    return h.hexdigest()[:16]
+
+
+def is_table(df):
+    """
+    Whether save_table stores df as it is: every object column holds strings only.
+    """
+
+    return all(pd.api.types.infer_dtype(df[c], skipna=True) in ('string', 'empty')
+               for c in df.columns if df[c].dtype == object)
+
+
+def save_value(value, directory):
+    """
+    DataFrames with string columns as cache.save_table tables, arrays as .npy and anything else pickled. Written
+    through cache.written_directory, so a partly written value is never loaded.
+    """
+
+    with written_directory(directory) as tmp:
+        if isinstance(value, pd.DataFrame) and is_table(value) and value.index.nlevels == 1:
+            index = value.index.name or 'index'
+            save_table(value.rename_axis(index).reset_index(), os.path.join(tmp, 'table'))
+            meta = {'kind': 'table', 'index': index, 'index_name': value.index.name}
+        elif isinstance(value, np.ndarray) and value.dtype != object:
+            np.save(os.path.join(tmp, 'array.npy'), value)
+            meta = {'kind': 'array'}
+        else:
+            with open(os.path.join(tmp, 'value.pkl'), 'wb') as f:
+                pickle.dump(value, f)
+            meta = {'kind': 'pickle'}
+        with open(os.path.join(tmp, 'meta.json'), 'w') as f:
+            json.dump(meta, f)
+
+
+def load_value(directory):
+    with open(os.path.join(directory, 'meta.json')) as f:
+        meta = json.load(f)
+    if meta['kind'] == 'table':
+        df = load_table(os.path.join(directory, 'table')).set_index(meta['index'])
+        df.index.name = meta['index_name']
+        return df
+    if meta['kind'] == 'array':
+        return np.load(os.path.join(directory, 'array.npy'))
+    with open(os.path.join(directory, 'value.pkl'), 'rb') as f:
+        return pickle.load(f)
+
+
+def user_features(df_users, aggregates, velocity=None):
+    """
+    user_frame on a copy of the users, with the velocity features when given.
+    """
+
+    df_users = df_users.copy()
+    if velocity is not None:
+        df_users = add_velocity(df_users, velocity)
+    return user_frame(df_users, aggregates)
+
+
+def fit_pipeline(pipeline, frame):
+    """
+    The preprocessing state of pipeline, fitted on frame unless it already is. The classifier is left out.
+    """
+
+    fitted = copy.copy(pipeline)
+    fitted.clf = None
+    if not fitted.fitted:
+        fitted.fit(frame)
+    return fitted
+
+
+def transform(pipeline, frame):
+    return pipeline.transform(frame)
+
+
+def feature_stages(velocity=False):
+    """
+    The stages of generate_features after transform_part1, on the graph inputs transactions, users, fx, currency and
+    pipeline.
+    """
+
+    stages = [Stage('fx_index', FxRateIndex.from_frames, ['fx', 'currency'], persist=False),
+              Stage('aggregates', aggregate_users, ['transactions', 'fx_index']),
+              Stage('user_frame', user_features, ['users', 'aggregates'] + (['velocity'] if velocity else []),
+                    persist=False),
+              Stage('fitted_pipeline', fit_pipeline, ['pipeline', 'user_frame']),
+              Stage('features', transform, ['fitted_pipeline', 'user_frame'])]
+    if velocity:
+        stages.append(Stage('velocity', velocity_features, ['transactions', 'users', 'fx_index']))
+    return stages
+
+
+def memoized_features(df_transactions, df_users, df_fx, df_currency, pipeline, source=None, test_time=True,
+                      cache_dir=STAGES_DIR):
+    """
+    The feature matrix of generate_features through a StageGraph of feature_stages, for tables that went through
+    transform_part1. An unfitted pipeline is fitted in place. source, the files dict the tables were loaded from with
+    cache.load_tables, keys the transactions, fx and currency tables by their files and the code of load_tables
+    instead of hashing their contents (so editing another function of transformations.py keeps them).
+    Returns the features and the graph, whose log shows which stages were recomputed.
+
+    Every new input (e.g. each unseeded random_undersample of the users) adds entries under cache_dir; prune removes
+    the ones not used lately.
+    """
+
+    graph = StageGraph(feature_stages(pipeline.velocity), cache_dir)
+    keys = {}
+    if source is not None:
+        key = source_key(source, test_time, modules=()) + code_hash([load_tables])[:16]
+        keys = {table: key + table for table in ['transactions', 'fx', 'currency']}
+    inputs = {'transactions': df_transactions, 'users': df_users, 'fx': df_fx, 'currency': df_currency,
+              'pipeline': pipeline}
+    X, fitted = graph.run(['features', 'fitted_pipeline'], inputs, keys)
+    if not pipeline.fitted:
+        clf = pipeline.clf
+        pipeline.__dict__.update(fitted.__dict__)
+        pipeline.clf = clf
+    return X, graph
+
+
+def prune(cache_dir=STAGES_DIR, keep=2):
+    """
+    Removes all but the keep most recently used outputs of every stage, and any partly written one. Returns the
+    number of outputs removed.
+    """
+
+    removed = 0
+    if not os.path.isdir(cache_dir):
+        return removed
+    for stage in os.listdir(cache_dir):
+        directory = os.path.join(cache_dir, stage)
+        entries = []
+        for key in os.listdir(directory):
+            complete = os.path.join(directory, key, COMPLETE)
+            if os.path.exists(complete):
+                entries.append((os.path.getmtime(complete), key))
+            else:
+                shutil.rmtree(os.path.join(directory, key))
+                removed += 1
+        for _, key in sorted(entries, reverse=True)[keep:]:
+            shutil.rmtree(os.path.join(directory, key))
+            removed += 1
+    return removed
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Prunes the memoized feature stages.')
+    parser.add_argument('--cache-dir', default=STAGES_DIR)
+    parser.add_argument('--keep', type=int, default=2, help='outputs kept per stage, the most recently used')
+    args = parser.parse_args()
+    print('{} stage outputs removed'.format(prune(args.cache_dir, args.keep)))
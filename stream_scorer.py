@@ -0,0 +1,410 @@
+import argparse
+import bisect
+import datetime
+import json
+import os
+import pickle
+import select
+import stat
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+from action import DECISIONS, action_codes
+from aggregates import MODE_ATTRIBUTES, partial_aggregates, finalize
+from cache import load_tables
+from compiled_model import load_compiled
+from fx import FxRateIndex, NAT
+from generate_features import user_frame
+from pipeline import FeaturePipeline, PIPELINE_PATH, CLF_PATH
+from transformations import transform_part1, country_code_lookup
+
+
+EPOCH = datetime.date(1970, 1, 1)
+AGGREGATE_COLUMNS = MODE_ATTRIBUTES + ['FIRST_STATE', 'FIRST_AMOUNT_USD', 'AMOUNT_USD', 'N_TRANSACTIONS']
+
+
+class UserState:
+    """
+    Running aggregates of one user, the streaming counterpart of aggregates.partial_aggregates. The most frequent value
+    of every MODE_ATTRIBUTES column is kept up to date with its counter: a count only grows, so after each increment the
+    mode is either the old one or the incremented value (ties go to the smallest value, as in mode_from_counts).
+    """
+
+    __slots__ = ['row', 'counts', 'modes', 'mode_counts', 'first_ts', 'first_state', 'first_usd', 'max_usd', 'n',
+                 'features']
+
+    def __init__(self, row):
+        self.row = row
+        self.counts = [{} for _ in MODE_ATTRIBUTES]
+        self.modes = [None] * len(MODE_ATTRIBUTES)
+        self.mode_counts = [0] * len(MODE_ATTRIBUTES)
+        self.first_ts = None
+        self.first_state = None
+        self.first_usd = float('nan')
+        self.max_usd = float('nan')
+        self.n = 0
+        self.features = None
+
+    def count(self, k, value, n=1):
+        if value is None or value != value:
+            return
+        c = self.counts[k].get(value, 0) + n
+        self.counts[k][value] = c
+        if c > self.mode_counts[k] or (c == self.mode_counts[k] and value < self.modes[k]):
+            self.modes[k], self.mode_counts[k] = value, c
+
+    def add(self, ts, state, usd, values):
+        """
+        One transaction. On equal timestamps the earlier transaction stays the first one.
+        """
+
+        if self.first_ts is None or ts < self.first_ts:
+            self.first_ts, self.first_state, self.first_usd = ts, state, usd
+        # As np.fmax: a NaN amount never replaces a number.
+        if usd > self.max_usd or self.max_usd != self.max_usd:
+            self.max_usd = usd
+        self.n += 1
+        for k, value in enumerate(values):
+            self.count(k, value)
+
+
+class StreamScorer:
+    """
+    Scores users as their transaction events arrive. add_event updates the user's running state (see UserState) and
+    the transaction features that depend on it; users whose features changed are rescored together by flush, which
+    returns the users whose action (see action.py) changed.
+
+    Features, scaling and model are the ones of the batch path, so after the same transactions a user gets exactly
+    the confidence test.py gives.
+    """
+
+    def __init__(self, pipeline, clf, df_users, fx_index, code_lookup):
+        if pipeline.velocity:
+            raise ValueError('The velocity features cannot be kept up to date event by event')
+        self.pipeline = pipeline
+        self.clf = clf
+        self.code_lookup = code_lookup
+
+        # The feature rows of every user without transactions; a user's transaction features are overwritten in place.
+        self.users = df_users.reset_index(drop=True)
+        empty = pd.DataFrame(columns=AGGREGATE_COLUMNS, index=pd.Index([], name='USER_ID'))
+        self.unscaled = pipeline.unscaled(user_frame(self.users.copy(), empty))
+        self.locked = self.users['STATE'].values == 'LOCKED'
+        self.country = self.users['COUNTRY'].values
+        self.rows = dict(zip(self.users['ID'].values, range(len(self.users))))
+        self.states = {}
+        self.dirty = {}
+
+        columns = pipeline.columns
+        self.type_slice = slice(columns.index('G1'), columns.index('G1') + len(pipeline.type_classes))
+        self.type_index = {t: i for i, t in enumerate(pipeline.type_classes)}
+        self.dynamic = [columns.index(c) for c in ['ID_CHECK', 'AMOUNT_USD', 'FIRST_SUCCESS', 'COUNTRIES_MATCH']]
+
+        # As-of rates per currency as lists for bisect, and the minor unit scale of fx.FxRateIndex.to_cash.
+        self.rates = {ccy: (list(ts), list(rate)) for (base, ccy), (ts, rate) in fx_index.rates.items()
+                      if base == fx_index.base}
+        self.base = fx_index.base
+        self.scales = {}
+        self.exponents = fx_index.exponents
+        self.days = {}
+
+    @classmethod
+    def load(cls, df_users, df_fx, df_currency, df_countries, df_history=None, path=PIPELINE_PATH):
+        """
+        A scorer for the transformed users with the fitted pipeline (or models/rf_clf.pkl, fitted on these users and
+        df_history like patrol_server does) and the compiled model when there is one. df_history, transformed
+        transactions that already happened, seeds the running state.
+        """
+
+        fx_index = FxRateIndex.from_frames(df_fx, df_currency)
+        partial = partial_aggregates(df_history, fx_index) if df_history is not None and len(df_history) else None
+        if os.path.exists(path):
+            pipeline = FeaturePipeline.load(path)
+            source = path
+        else:
+            with open(CLF_PATH, 'rb') as f:
+                pipeline = FeaturePipeline(clf=pickle.load(f))
+            aggregates = finalize(partial) if partial is not None else pd.DataFrame(columns=AGGREGATE_COLUMNS)
+            pipeline.fit(user_frame(df_users.copy(), aggregates))
+            source = CLF_PATH
+        compiled = load_compiled(source)
+        clf = compiled if compiled is not None else pipeline.clf
+
+        scorer = cls(pipeline, clf, df_users, fx_index, country_code_lookup(df_countries))
+        if partial is not None:
+            scorer.seed(partial)
+        scorer.score_all()
+        return scorer
+
+    def seed(self, partial):
+        """
+        Running state from the partial aggregates of past transactions (see aggregates.partial_aggregates).
+        """
+
+        users = partial['users']
+        for user_id, ts, state, first_usd, max_usd, n in zip(users.index, users['FIRST_TS'].values,
+                                                              users['FIRST_STATE'].values,
+                                                              users['FIRST_AMOUNT_USD'].values,
+                                                              users['AMOUNT_USD'].values,
+                                                              users['N_TRANSACTIONS'].values):
+            s = self.state(user_id)
+            if s is None:
+                continue
+            s.first_ts, s.first_state, s.first_usd, s.max_usd, s.n = int(ts), state, float(first_usd), \
+                float(max_usd), int(n)
+        for k, attr in enumerate(MODE_ATTRIBUTES):
+            counts = partial['counts'][attr]
+            for user_id, value, n in zip(counts['USER_ID'].values, counts['VALUE'].values, counts['COUNT'].values):
+                s = self.states.get(user_id)
+                if s is not None:
+                    s.count(k, value, int(n))
+        for s in self.states.values():
+            self.update_features(s)
+        self.dirty = {}
+
+    def state(self, user_id):
+        s = self.states.get(user_id)
+        if s is None:
+            row = self.rows.get(user_id)
+            if row is None:
+                return None
+            s = self.states[user_id] = UserState(row)
+        return s
+
+    def timestamp(self, value):
+        """
+        fx.to_timestamps for one 'YYYY-MM-DD HH:MM:SS[.ffffff]' string, with a cache of the dates.
+        """
+
+        try:
+            days = self.days.get(value[:10])
+            if days is None:
+                days = self.days[value[:10]] = (datetime.date.fromisoformat(value[:10]) - EPOCH).days
+            seconds = days * 86400 + int(value[11:13]) * 3600 + int(value[14:16]) * 60 + int(value[17:19])
+        except (TypeError, ValueError):
+            return NAT
+        try:
+            fraction = float('0' + value[19:]) if len(value) > 19 else 0.
+        except ValueError:
+            fraction = 0.
+        return seconds * 10 ** 9 + round(fraction * 1e9)
+
+    def to_usd(self, amount, currency, ts):
+        """
+        fx.FxRateIndex.to_usd for one transaction.
+        """
+
+        scale = self.scales.get(currency)
+        if scale is None:
+            scale = self.scales[currency] = 10. ** -self.exponents.get(currency, 0)
+        cash = float(amount) * scale
+        if currency == self.base:
+            return cash * 1.
+        pair = self.rates.get(currency)
+        if pair is None:
+            return cash
+        i = bisect.bisect_right(pair[0], ts) - 1
+        usd = cash * pair[1][i] if i >= 0 else float('nan')
+        return cash if usd != usd else usd
+
+    def merchant_country(self, value):
+        """
+        transform_transactions for one MERCHANT_COUNTRY.
+        """
+
+        if value is None or value != value:
+            return None
+        if isinstance(value, str) and len(value) > 3:
+            value = 'UNK'
+        return self.code_lookup.get(value, value)
+
+    def add_event(self, event):
+        """
+        Updates the state of the event's user, a transaction as a dict with the columns of the transactions table
+        (lower or upper case). Returns False for users that are not known.
+        """
+
+        get = event.get
+        s = self.state(get('user_id', get('USER_ID')))
+        if s is None:
+            return False
+
+        ts = self.timestamp(get('created_date', get('CREATED_DATE')))
+        currency = get('currency', get('CURRENCY'))
+        amount = get('amount', get('AMOUNT'))
+        usd = self.to_usd(amount if amount is not None else float('nan'), currency, ts)
+        s.add(ts, get('state', get('STATE')), usd,
+              (self.merchant_country(get('merchant_country', get('MERCHANT_COUNTRY'))),
+               get('source', get('SOURCE')), get('type', get('TYPE'))))
+        self.update_features(s, event)
+        return True
+
+    def update_features(self, s, event=None):
+        """
+        The transaction features of transaction_features from the running state. The user is marked for rescoring
+        when they changed.
+        """
+
+        amount = s.max_usd if s.max_usd < 5000 else 0.
+        first_success = int(s.first_state == 'COMPLETED' and s.first_usd >= 10)
+        match = int(s.modes[0] is not None and s.modes[0] == self.country[s.row])
+        features = (s.modes[2], int(s.n > 0), amount, first_success, match)
+        if features == s.features:
+            return
+        s.features = features
+
+        row = self.unscaled[s.row]
+        row[self.type_slice] = 0.
+        t = self.type_index.get(s.modes[2] if s.modes[2] is not None else 'NaN')
+        if t is not None:
+            row[self.type_slice.start + t] = 1.
+        row[self.dynamic] = features[1:]
+        self.dirty[s.row] = event
+
+    def score(self, rows):
+        """
+        Confidences of the users at rows, with the LOCKED override of test.py.
+        """
+
+        X = self.pipeline.scaler.transform(self.unscaled[rows])
+        return np.where(self.locked[rows], 1., self.clf.predict_proba(X)[:, 1])
+
+    def score_all(self):
+        """
+        The current action of every user, the baseline the changes are reported against.
+        """
+
+        rows = np.arange(len(self.users))
+        self.confidences = self.score(rows)
+        self.codes = action_codes(self.confidences)
+        self.dirty = {}
+
+    def flush(self):
+        """
+        Rescores the users whose features changed since the last flush in one batch. Returns a (user row, previous
+        code, new code, confidence, last event) tuple for every user whose action changed.
+        """
+
+        if not self.dirty:
+            return []
+        rows = np.fromiter(self.dirty, dtype='int64', count=len(self.dirty))
+        events = list(self.dirty.values())
+        self.dirty = {}
+
+        confidences = self.score(rows)
+        codes = action_codes(confidences)
+        previous = self.codes[rows]
+        self.confidences[rows], self.codes[rows] = confidences, codes
+
+        changed = np.flatnonzero(codes != previous)
+        return [(rows[i], previous[i], codes[i], confidences[i], events[i]) for i in changed]
+
+    def action(self, row, previous, code, confidence, event):
+        event = event or {}
+        return {'user_id': self.users['ID'].values[row],
+                'action': DECISIONS[code],
+                'previous_action': DECISIONS[previous],
+                'confidence': float(confidence),
+                'transaction_id': event.get('id', event.get('ID')),
+                'created_date': event.get('created_date', event.get('CREATED_DATE'))}
+
+
+def pending(f):
+    """
+    Whether more input can be read from f without waiting. Regular files, and streams without a file descriptor
+    (e.g. io.StringIO), always can.
+    """
+
+    try:
+        fd = f.fileno()
+    except (AttributeError, OSError):
+        # io.UnsupportedOperation is an OSError.
+        return lambda: True
+    if stat.S_ISREG(os.fstat(fd).st_mode):
+        return lambda: True
+    return lambda: bool(select.select([f], [], [], 0)[0])
+
+
+def run(scorer, events, out, max_batch=1024):
+    """
+    Feeds the JSON lines of events to scorer and writes one JSON line to out for every action change. Users are
+    rescored every max_batch events, or as soon as the input has nothing more to read.
+    """
+
+    more = pending(events)
+    stats = {'events': 0, 'unknown_users': 0, 'invalid': 0, 'rescored': 0, 'actions': 0}
+    start = time.perf_counter()
+    since_flush = 0
+
+    for line in events:
+        try:
+            event = json.loads(line)
+        except ValueError:
+            stats['invalid'] += line.strip() != ''
+            continue
+        stats['events'] += 1
+        if not scorer.add_event(event):
+            stats['unknown_users'] += 1
+        since_flush += 1
+        if since_flush >= max_batch or (scorer.dirty and not more()):
+            stats['rescored'] += len(scorer.dirty)
+            for change in scorer.flush():
+                out.write(json.dumps(scorer.action(*change)) + '\n')
+                stats['actions'] += 1
+            out.flush()
+            since_flush = 0
+
+    stats['rescored'] += len(scorer.dirty)
+    for change in scorer.flush():
+        out.write(json.dumps(scorer.action(*change)) + '\n')
+        stats['actions'] += 1
+    out.flush()
+
+    stats['seconds'] = time.perf_counter() - start
+    stats['events_per_sec'] = stats['events'] / stats['seconds'] if stats['seconds'] else 0.
+    return stats
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Rescores users as transaction events arrive and prints every action '
+                                                 'change as a JSON line.')
+    parser.add_argument('events', nargs='?', default='-', help='JSON lines of transactions, - for stdin')
+    parser.add_argument('--users', default='test_users.csv')
+    parser.add_argument('--history', default=None, help='transactions csv that already happened, seeds the state')
+    parser.add_argument('--output', default=None, help='actions file (default stdout)')
+    parser.add_argument('--max-batch', type=int, default=1024, help='events between two rescoring batches at most')
+    args = parser.parse_args()
+
+    try:
+        df_countries = pd.read_csv('train/countries.csv', index_col=False)
+        if args.history:
+            files = {'transactions': args.history,
+                     'users': args.users,
+                     'countries': 'train/countries.csv',
+                     'fx': 'train/fx_rates.csv',
+                     'currency': 'train/currency_details.csv'}
+            df_history, df_users, df_fx, df_currency = load_tables(files)
+        else:
+            # Without a history only the users, fx and currency tables are needed.
+            df_history = None
+            _, df_users, df_fx, df_currency = transform_part1(None, pd.read_csv(args.users, index_col=0), df_countries,
+                                                              pd.read_csv('train/fx_rates.csv', index_col=False),
+                                                              pd.read_csv('train/currency_details.csv', index_col=False))
+    except OSError:
+        print('There was an issue importing the files. Please see the README and try again.')
+        sys.exit()
+
+    scorer = StreamScorer.load(df_users, df_fx, df_currency, df_countries, df_history=df_history)
+
+    events = sys.stdin if args.events == '-' else open(args.events)
+    out = sys.stdout if args.output is None else open(args.output, 'w')
+    try:
+        stats = run(scorer, events, out, max_batch=args.max_batch)
+    finally:
+        if out is not sys.stdout:
+            out.close()
+    print(json.dumps(stats), file=sys.stderr)
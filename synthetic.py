@@ -0,0 +1,151 @@
+import binascii
+import os
+
+import numpy as np
+import pandas as pd
+
+
+# Category values and rough frequencies seen in the training data (see part3a_exploration.ipynb).
+KYC = (['PASSED', 'NONE', 'FAILED', 'PENDING'], [.70, .26, .03, .01])
+USER_STATES = (['ACTIVE', 'LOCKED'], [.97, .03])
+USER_COUNTRIES = (['GB', 'FR', 'PL', 'LT', 'IE', 'ES', 'GR', 'DE', 'RO', 'IT'],
+                  [.46, .13, .07, .05, .04, .04, .03, .03, .03, .12])
+TERMS_VERSIONS = ([None, '2017-01-16', '2018-01-01', '2018-01-13', '2018-03-20', '2018-05-25', '2018-09-20'],
+                  [.17, .02, .02, .04, .20, .34, .21])
+TRANSACTION_STATES = (['COMPLETED', 'DECLINED', 'REVERTED', 'FAILED', 'PENDING', 'CANCELLED', 'RECORDED'],
+                      [.85, .05, .04, .02, .02, .01, .01])
+TYPES = (['CARD_PAYMENT', 'TOPUP', 'ATM', 'BANK_TRANSFER', 'P2P'], [.65, .15, .05, .05, .10])
+SOURCES = (['GAIA', 'HERA', 'MINOS', 'INTERNAL', 'BRIZO', 'CRONUS', 'NYX', 'LIMOS', 'APOLLO'],
+           [.60, .12, .08, .07, .05, .03, .02, .02, .01])
+ENTRY_METHODS = (['chip', 'misc', 'cont', 'manu', 'mags', 'mcon'], [.45, .30, .15, .05, .04, .01])
+
+# (code, code3, currency, iso_code, exponent) of the countries and currencies the generator uses.
+COUNTRIES = [('GB', 'gbr', 'GBP', 826, 2), ('FR', 'fra', 'EUR', 978, 2), ('PL', 'pol', 'PLN', 985, 2),
+             ('LT', 'ltu', 'EUR', 978, 2), ('IE', 'irl', 'EUR', 978, 2), ('ES', 'esp', 'EUR', 978, 2),
+             ('GR', 'grc', 'EUR', 978, 2), ('DE', 'deu', 'EUR', 978, 2), ('RO', 'rou', 'RON', 946, 2),
+             ('IT', 'ita', 'EUR', 978, 2), ('US', 'usa', 'USD', 840, 2), ('CH', 'che', 'CHF', 756, 2),
+             ('JP', 'jpn', 'JPY', 392, 0), ('KW', 'kwt', 'KWD', 414, 3), ('SE', 'swe', 'SEK', 752, 2)]
+CRYPTO = ['BTC', 'ETH', 'LTC']
+
+START = np.datetime64('2017-01-01')
+END = np.datetime64('2019-01-01')
+
+
+def choice(r, values, n):
+    values, p = values
+    return np.asarray(values, dtype=object)[r.choice(len(values), n, p=p)]
+
+
+def uuids(r, n):
+    """
+    n random version 4 style uuid strings, built from one hexlified buffer instead of one uuid object per row.
+    """
+
+    hexes = np.frombuffer(binascii.hexlify(r.bytes(16 * n)), dtype='S1').reshape(n, 32)
+    hexes = np.insert(hexes, [8, 12, 16, 20], b'-', axis=1)
+    return np.ascontiguousarray(hexes).view('S36').ravel().astype(str).astype(object)
+
+
+def timestamps(r, n, start=START, end=END, fraction=True):
+    """
+    n random 'YYYY-MM-DD HH:MM:SS[.ffffff]' strings between start and end, the format of the csvs.
+    """
+
+    span = (end - start).astype('timedelta64[us]').astype('int64')
+    ts = start + r.randint(0, span, n).astype('timedelta64[us]')
+    res = pd.Series(np.datetime_as_string(ts, unit='us' if fraction else 's')).str.replace('T', ' ', regex=False)
+    return res.values
+
+
+def synthetic_tables(n_transactions, n_users=None, n_fraudsters=None, seed=0):
+    """
+    Seeded synthetic versions of the raw csvs (before transform_part1): transactions, users, fraudsters, countries,
+    the wide fx table and currency_details. Columns and formats follow create.sql and the csvs in train/, category
+    frequencies follow the training data; the values themselves carry no signal.
+    """
+
+    r = np.random.RandomState(seed)
+    n_users = n_users or max(100, n_transactions // 50)
+    n_fraudsters = n_fraudsters if n_fraudsters is not None else max(1, n_users * 3 // 100)
+    country_codes = [c[0] for c in COUNTRIES]
+
+    user_ids = uuids(r, n_users)
+    users = pd.DataFrame({
+        'ID': user_ids,
+        'HAS_EMAIL': (r.rand(n_users) < .94).astype(int),
+        'PHONE_COUNTRY': choice(r, USER_COUNTRIES, n_users),
+        'TERMS_VERSION': choice(r, TERMS_VERSIONS, n_users),
+        'CREATED_DATE': timestamps(r, n_users, end=np.datetime64('2018-07-01')),
+        'STATE': choice(r, USER_STATES, n_users),
+        'COUNTRY': choice(r, USER_COUNTRIES, n_users),
+        'BIRTH_YEAR': r.randint(1927, 2001, n_users),
+        'KYC': choice(r, KYC, n_users),
+        'FAILED_SIGN_IN_ATTEMPTS': np.minimum(r.geometric(.97, n_users) - 1, 6),
+    })
+    users.loc[users['PHONE_COUNTRY'] == 'GB', 'PHONE_COUNTRY'] = 'GB||JE||IM||GG'
+    fraudsters = pd.DataFrame({'user_id': r.choice(user_ids, n_fraudsters, replace=False)})
+
+    # Users transact at very different rates, a few users have no transactions at all.
+    weights = r.pareto(1.5, n_users) * (r.rand(n_users) > .05)
+    tx_users = user_ids[r.choice(n_users, n_transactions, p=weights / weights.sum())]
+
+    merchant_country = np.asarray([c[1].upper() for c in COUNTRIES] + ['LONDON', 'Vilnius'],
+                                  dtype=object)[r.randint(0, len(COUNTRIES) + 2, n_transactions)]
+    merchant_country[r.rand(n_transactions) < .3] = None
+    currency = np.asarray([c[2] for c in COUNTRIES] + CRYPTO, dtype=object)
+    transactions = pd.DataFrame({
+        'CURRENCY': currency[r.choice(len(currency), n_transactions)],
+        'AMOUNT': np.round(r.lognormal(7, 2, n_transactions)).astype('int64') + 1,
+        'STATE': choice(r, TRANSACTION_STATES, n_transactions),
+        'CREATED_DATE': timestamps(r, n_transactions),
+        'MERCHANT_CATEGORY': None,
+        'MERCHANT_COUNTRY': merchant_country,
+        'ENTRY_METHOD': choice(r, ENTRY_METHODS, n_transactions),
+        'USER_ID': tx_users,
+        'TYPE': choice(r, TYPES, n_transactions),
+        'SOURCE': choice(r, SOURCES, n_transactions),
+        'ID': uuids(r, n_transactions),
+    })
+
+    countries = pd.DataFrame({'code': country_codes, 'code3': [c[1] for c in COUNTRIES]})
+
+    currencies = sorted(set(c[2] for c in COUNTRIES))
+    currency_details = pd.DataFrame({
+        'currency': currencies + CRYPTO,
+        'iso_code': [next(c[3] for c in COUNTRIES if c[2] == ccy) for ccy in currencies] + [np.nan] * len(CRYPTO),
+        'exponent': [next(c[4] for c in COUNTRIES if c[2] == ccy) for ccy in currencies] + [np.nan] * len(CRYPTO),
+        'is_crypto': [False] * len(currencies) + [True] * len(CRYPTO),
+    })
+
+    # Hourly rates as a random walk per currency, quoted against USD and EUR like the real table.
+    hours = np.arange(START, END, np.timedelta64(1, 'h'))
+    fx = pd.DataFrame({'Unnamed: 0': pd.Series(np.datetime_as_string(hours, unit='s')).str.replace('T', ' ').values})
+    for base in ['USD', 'EUR']:
+        for ccy in currencies + CRYPTO:
+            walk = np.exp(np.cumsum(r.normal(0, .002, len(hours))))
+            fx[base + ccy] = np.where(r.rand(len(hours)) < .01, np.nan, r.uniform(.1, 5) * walk)
+
+    return {'transactions': transactions, 'users': users, 'fraudsters': fraudsters, 'countries': countries,
+            'fx': fx, 'currency': currency_details}
+
+
+def write_tables(tables, directory):
+    """
+    Writes synthetic_tables in the layout of cache.TRAIN_FILES under directory and returns the file names.
+    """
+
+    files = {'transactions': 'train/train_transactions.csv',
+             'users': 'train/train_users.csv',
+             'fraudsters': 'train/train_fraudsters.csv',
+             'countries': 'train/countries.csv',
+             'fx': 'train/fx_rates.csv',
+             'currency': 'train/currency_details.csv'}
+    files = {table: os.path.join(directory, name) for table, name in files.items()}
+    os.makedirs(os.path.join(directory, 'train'), exist_ok=True)
+
+    for table in ['transactions', 'users', 'fraudsters']:
+        tables[table].to_csv(files[table])
+    tables['countries'].to_csv(files['countries'], index=False)
+    tables['fx'].rename(columns={'Unnamed: 0': ''}).to_csv(files['fx'], index=False)
+    tables['currency'].to_csv(files['currency'], index=False)
+    return files
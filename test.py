@@ -2,8 +2,17 @@ import pandas as pd
 import numpy as np
 import csv
 import pickle
+import os
+import argparse
 
 from generate_features import generate_features
+from cache import load_tables
+from pipeline import FeaturePipeline, PIPELINE_PATH, CLF_PATH
+from action import action_codes, INDEX_PATH
+from compiled_model import load_compiled
+from decision_index import write_decision_index
+from cascade import load_logistic, cascade_predict, compare_decisions, format_report, predict_with_proba, CASCADE_BAND
+from instrumentation import Recorder, NULL_RECORDER
 import sys
 
 
@@ -16,6 +25,26 @@ def load_data(file_name, index_col=0):
 
 if __name__ == "__main__":
     
+    parser = argparse.ArgumentParser(description='Scores the test users.')
+    parser.add_argument('--chunksize', type=int, default=None,
+                        help='stream the transactions in chunks of this many rows to bound memory')
+    parser.add_argument('--n-jobs', type=int, default=None,
+                        help='aggregate the transactions in this many worker processes')
+    parser.add_argument('--log', default=None,
+                        help='append the time, rows and memory of every stage to this file as JSON lines')
+    parser.add_argument('--compact', action='store_true',
+                        help='keep the tables as categoricals, integer codes and float32 to cut memory')
+    parser.add_argument('--memoize', action='store_true',
+                        help='cache every feature stage on disk and only recompute the ones whose code or inputs changed')
+    parser.add_argument('--cascade', action='store_true',
+                        help='score with the logistic regression and only send its uncertain users to the forest')
+    parser.add_argument('--band', type=float, nargs=2, default=CASCADE_BAND, metavar=('LOW', 'HIGH'),
+                        help='logistic confidences escalated to the forest with --cascade')
+    parser.add_argument('--compare', action='store_true',
+                        help='with --cascade, also score everyone with the forest and report the differences')
+    args = parser.parse_args()
+    rec = Recorder(path=args.log) if args.log else NULL_RECORDER
+    
     # Load the test files
     try:
         file_name_transactions = 'test_transactions.csv'
@@ -30,17 +59,39 @@ if __name__ == "__main__":
         sys.exit()
         
     
-    # Load the model
-    with open('models/rf_clf.pkl', 'rb') as f:
-        clf = pickle.load(f)
+    # Load the model. models/pipeline.pkl (saved by train.py) also holds the preprocessing fitted on the training set;
+    # with only models/rf_clf.pkl the encoders and scaler are fitted on this batch.
+    if os.path.exists(PIPELINE_PATH):
+        pipeline = FeaturePipeline.load()
+        clf, source = pipeline.clf, PIPELINE_PATH
+    else:
+        pipeline = None
+        with open(CLF_PATH, 'rb') as f:
+            clf = pickle.load(f)
+        source = CLF_PATH
+    # The compiled copy of that model (see compiled_model.py) gives the same predictions faster.
+    compiled = load_compiled(source)
+    if compiled is not None:
+        clf = compiled
         
     
-    # Put into dataframes
-    df_transactions = load_data(file_name_transactions)
-    df_users = load_data(file_name_users)
-    df_countries = load_data(file_name_countries, index_col=False)
-    df_fx = load_data(file_name_fx, index_col=False)
-    df_currency = load_data(file_name_currency, index_col=False)
+    # Put into dataframes. Unless streaming, the transformed tables come from the cache (see cache.py), so repeat runs
+    # skip parsing the csvs.
+    if args.chunksize:
+        df_transactions = pd.read_csv(file_name_transactions, index_col=0, chunksize=args.chunksize)
+        df_users = load_data(file_name_users)
+        df_countries = load_data(file_name_countries, index_col=False)
+        df_fx = load_data(file_name_fx, index_col=False)
+        df_currency = load_data(file_name_currency, index_col=False)
+    else:
+        with rec.stage('load_tables'):
+            files = {'transactions': file_name_transactions,
+                     'users': file_name_users,
+                     'countries': file_name_countries,
+                     'fx': file_name_fx,
+                     'currency': file_name_currency}
+            df_transactions, df_users, df_fx, df_currency = load_tables(files, compact=args.compact)
+        df_countries = None
     
         
     # Generate the features for the model
@@ -50,12 +101,30 @@ if __name__ == "__main__":
                              df_currency=df_currency, 
                              df_countries=df_countries, 
                              test_time = True, 
-                             save=True)
+                             save=True,
+                             pipeline=pipeline,
+                             preprocessed=not args.chunksize,
+                             n_jobs=args.n_jobs,
+                             instrument=rec,
+                             compact=args.compact,
+                             memoize=args.memoize,
+                             source=None if args.chunksize or args.compact else files)
     
     # Make predictions
     ids = list(df_users['ID'])
-    predictions = clf.predict(X)
-    probabilities = clf.predict_proba(X)[:, 1]
+    if args.cascade:
+        with rec.stage('predict', rows_in=len(X), cascade=True) as s:
+            predictions, probabilities, escalated = cascade_predict(load_logistic(), clf, X, band=args.band)
+            s.rows_out = int(escalated.sum())
+        comparison = None
+        if args.compare:
+            locked = df_users['STATE'].values == 'LOCKED'
+            reference = predict_with_proba(clf, X)[1]
+            comparison = compare_decisions(np.where(locked, 1, probabilities), np.where(locked, 1, reference))
+        print(format_report(escalated, comparison))
+    else:
+        with rec.stage('predict', rows_in=len(X)):
+            predictions, probabilities = predict_with_proba(clf, X)
     
     
     
@@ -72,6 +141,9 @@ if __name__ == "__main__":
     # Save csv to disk
     df.to_csv('predictions.csv')
     
+    # Binary decision index for patrol in action.py
+    write_decision_index(INDEX_PATH, df['ID'], action_codes(df['Confidence'].values), df['Confidence'].values)
+    
     print('Predictions succesfully saved to disk')
     
     
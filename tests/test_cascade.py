@@ -0,0 +1,52 @@
+import numpy as np
+
+from cascade import cascade_predict, compare_decisions, CASCADE_BAND
+
+
+class FixedModel:
+    """
+    Scores row i of X with the confidence X[i, 0] and remembers the rows it was asked for.
+    """
+
+    def __init__(self, transform=lambda p: p):
+        self.transform = transform
+        self.seen = None
+
+    def predict_proba(self, X):
+        self.seen = X[:, 1].copy()
+        p = self.transform(X[:, 0])
+        return np.column_stack([1 - p, p])
+
+    def predict(self, X):
+        return (self.predict_proba(X)[:, 1] > .5).astype(int)
+
+
+def test_only_the_band_is_escalated():
+    low, high = CASCADE_BAND
+    confidences = np.array([0., low / 2, low, (low + high) / 2, high, (high + 1) / 2, 1.])
+    X = np.column_stack([confidences, np.arange(len(confidences))])
+    lr, rf = FixedModel(), FixedModel(lambda p: 1 - p)
+
+    predictions, probabilities, escalated = cascade_predict(lr, rf, X)
+
+    # The band is inclusive, and the forest sees nothing else.
+    inside = (confidences >= low) & (confidences <= high)
+    np.testing.assert_array_equal(escalated, inside)
+    np.testing.assert_array_equal(rf.seen, np.flatnonzero(inside))
+    np.testing.assert_array_equal(probabilities[inside], 1 - confidences[inside])
+    np.testing.assert_array_equal(probabilities[~inside], confidences[~inside])
+    np.testing.assert_array_equal(predictions, (probabilities > .5).astype(int))
+
+
+def test_nothing_escalated_skips_the_forest():
+    X = np.column_stack([[0., .01, .99, 1.], np.arange(4)])
+    rf = FixedModel()
+    _, probabilities, escalated = cascade_predict(FixedModel(), rf, X, band=(.1, .9))
+    assert not escalated.any() and rf.seen is None
+    np.testing.assert_array_equal(probabilities, X[:, 0])
+
+
+def test_compare_decisions():
+    comparison = compare_decisions(np.array([0., .5, 1.]), np.array([0., 1., 1.]))
+    # Rows are the reference action, columns the cascade one.
+    assert comparison == {'changed': 1, 'matrix': [[1, 0, 0], [0, 0, 0], [1, 0, 1]]}
@@ -0,0 +1,57 @@
+import pickle
+
+import numpy as np
+import pytest
+from sklearn.ensemble import RandomForestClassifier
+from sklearn.linear_model import LogisticRegression
+from sklearn.tree import DecisionTreeClassifier
+
+from compiled_model import compile_model, compiled_path, export_model, load_compiled, load_model
+
+
+@pytest.fixture(scope='module')
+def data():
+    r = np.random.RandomState(0)
+    # Rounded, so many rows sit exactly on a threshold.
+    X = np.round(r.randn(3000, 8), 1)
+    y = (X[:, 0] + X[:, 1] * X[:, 2] + r.randn(3000) > 0.5).astype(int)
+    return X[:2000], y[:2000], X[2000:]
+
+
+@pytest.mark.parametrize('clf', [RandomForestClassifier(n_estimators=30, random_state=0),
+                                 RandomForestClassifier(n_estimators=10, max_depth=3, random_state=1),
+                                 DecisionTreeClassifier(random_state=0),
+                                 LogisticRegression()])
+def test_compiled_matches_sklearn(data, clf):
+    X, y, X_test = data
+    clf.fit(X, y)
+    model = compile_model(clf)
+    predictions, probabilities = model.predict_with_proba(X_test)
+    np.testing.assert_array_equal(probabilities, clf.predict_proba(X_test))
+    np.testing.assert_array_equal(predictions, clf.predict(X_test))
+
+
+def test_export_keeps_string_classes(data, tmp_path):
+    X, y, X_test = data
+    clf = RandomForestClassifier(n_estimators=5, random_state=0).fit(X, np.where(y == 1, 'fraud', 'ok'))
+    export_model(clf, tmp_path / 'clf.npz')
+    model = load_model(tmp_path / 'clf.npz')
+    np.testing.assert_array_equal(model.predict(X_test), clf.predict(X_test))
+    np.testing.assert_array_equal(model.predict_proba(X_test), clf.predict_proba(X_test))
+
+
+def test_load_compiled_only_for_its_source(data, tmp_path):
+    X, y, X_test = data
+    source = str(tmp_path / 'clf.pkl')
+    forest = RandomForestClassifier(n_estimators=5, random_state=0).fit(X, y)
+    with open(source, 'wb') as f:
+        pickle.dump(forest, f)
+    assert load_compiled(source) is None
+
+    export_model(forest, compiled_path(source), source=source)
+    np.testing.assert_array_equal(load_compiled(source).predict_proba(X_test), forest.predict_proba(X_test))
+
+    # Another model saved over the pickle leaves the compiled copy stale.
+    with open(source, 'wb') as f:
+        pickle.dump(LogisticRegression().fit(X, y), f)
+    assert load_compiled(source) is None
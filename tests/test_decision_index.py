@@ -0,0 +1,36 @@
+import numpy as np
+import pytest
+
+import action
+from decision_index import DecisionIndex, write_decision_index
+
+IDS = ['9b1c6c5e-3a8e-4c4e-9f34-0d6b1b8a1f01', '0a7d4f2e-6c1b-4e5a-8d3c-2f9e1b7c4a02',
+       'f3e2d1c0-b9a8-4765-8432-10fedcba9803']
+
+
+@pytest.fixture
+def index_path(tmp_path):
+    path = str(tmp_path / 'predictions.idx')
+    write_decision_index(path, IDS, action.action_codes([.1, .7, .95]), np.array([.1, .7, .95]))
+    return path
+
+
+def test_lookup(index_path):
+    index = DecisionIndex(index_path)
+    try:
+        assert [index.lookup(i)[0] for i in IDS] == [0, 1, 2]
+        assert index.lookup('00000000-0000-0000-0000-000000000000') is None
+        for user_id in ['not a uuid', '9b1c6c5e-3a8e-4c4e-9f34-0d6b1b8a1fzz', None]:
+            with pytest.raises(ValueError):
+                index.lookup(user_id)
+    finally:
+        index.close()
+
+
+def test_patrol_reports_unknown_and_invalid_users(index_path, monkeypatch):
+    monkeypatch.setattr(action, '_index', DecisionIndex(index_path))
+    assert action.patrol(IDS[2]) == action.DECISIONS[2]
+    for user_id, error in [('00000000-0000-0000-0000-000000000000', 'unknown user'), ('xyz', 'invalid user id')]:
+        with pytest.raises(KeyError) as e:
+            action.patrol(user_id)
+        assert e.value.args[0] == error
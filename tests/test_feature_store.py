@@ -0,0 +1,72 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+from sklearn.ensemble import RandomForestClassifier
+
+from aggregates import aggregate_users
+from feature_store import refresh, load_store
+from fx import FxRateIndex
+from generate_features import user_frame
+from pipeline import FeaturePipeline, PIPELINE_PATH
+from synthetic import synthetic_tables
+from transformations import transform_part1, transform_transactions, country_code_lookup
+
+
+@pytest.fixture(scope='module')
+def tables():
+    t = synthetic_tables(20000, seed=17)
+    code_lookup = country_code_lookup(t['countries'])
+    _, df_users, df_fx, df_currency = transform_part1(None, t['users'], t['countries'], t['fx'], t['currency'])
+    # In time order, as the store expects, with one timestamp shared by the transactions around the split below.
+    df_t = t['transactions'].sort_values('CREATED_DATE', kind='mergesort').reset_index(drop=True)
+    df_t.loc[11990:12010, 'CREATED_DATE'] = df_t.loc[12000, 'CREATED_DATE']
+    df_t = transform_transactions(df_t, code_lookup)
+
+    pipeline = FeaturePipeline()
+    frame = user_frame(df_users.copy(), aggregate_users(df_t, FxRateIndex.from_frames(df_fx, df_currency)))
+    X = pipeline.fit(frame).transform(frame)
+    pipeline.clf = RandomForestClassifier(n_estimators=10, random_state=0).fit(X, np.arange(len(X)) % 7 == 0)
+    return df_t, df_users, df_fx, df_currency, pipeline
+
+
+def run(tables, parts, directory):
+    df_t, df_users, df_fx, df_currency, _ = tables
+    os.makedirs(directory)
+    paths = {'directory': os.path.join(directory, 'store'),
+             'predictions_path': os.path.join(directory, 'predictions.csv'),
+             'index_path': os.path.join(directory, 'predictions.idx')}
+    counts = [refresh([df_t.iloc[rows].copy()], df_users, df_fx, df_currency, **paths) for rows in parts]
+    return paths, counts
+
+
+@pytest.mark.parametrize('history', [False, True])
+def test_split_refresh_matches_full_build(tables, tmp_path, monkeypatch, history):
+    monkeypatch.chdir(tmp_path)
+    os.makedirs('models')
+    tables[4].save(PIPELINE_PATH)
+    n = len(tables[0])
+
+    full, _ = run(tables, [slice(0, n)], 'full')
+    # The second refresh gets either only the new transactions or the whole history again.
+    split, counts = run(tables, [slice(0, 12000), slice(0 if history else 12000, n)], 'split')
+    assert counts[1][0] == n - 12000 and counts[1][2] == (11990 if history else 0)
+
+    pd.testing.assert_frame_equal(pd.read_csv(split['predictions_path']), pd.read_csv(full['predictions_path']))
+    with open(split['index_path'], 'rb') as f, open(full['index_path'], 'rb') as g:
+        assert f.read() == g.read()
+    stored, state = load_store(split['directory'])
+    expected, expected_state = load_store(full['directory'])
+    pd.testing.assert_frame_equal(stored['users'].sort_index(), expected['users'].sort_index())
+    assert state['watermark'] == expected_state['watermark'] and state['transactions'] == n
+
+
+def test_late_transactions_are_counted(tables, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    os.makedirs('models')
+    tables[4].save(PIPELINE_PATH)
+    n = len(tables[0])
+
+    _, counts = run(tables, [slice(5000, n), slice(0, 5000)], 'late')
+    assert counts[1][0] == 0 and counts[1][2] == 5000
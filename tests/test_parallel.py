@@ -0,0 +1,45 @@
+import os
+
+import pandas as pd
+import pytest
+
+from aggregates import aggregate_users
+from fx import FxRateIndex
+from parallel import aggregate_users_parallel
+from synthetic import synthetic_tables
+from transformations import transform_part1, compact_transactions
+
+
+@pytest.fixture(scope='module')
+def tables():
+    t = synthetic_tables(20000, seed=7)
+    df_t, _, df_fx, df_c = transform_part1(t['transactions'], t['users'], t['countries'], t['fx'], t['currency'])
+    # Users whose transactions all share one timestamp: the first one in the file has to win.
+    for user in df_t['USER_ID'].value_counts().index[:5]:
+        rows = df_t['USER_ID'] == user
+        df_t.loc[rows, 'CREATED_DATE'] = df_t.loc[rows, 'CREATED_DATE'].values[-1]
+    return df_t, FxRateIndex.from_frames(df_fx, df_c)
+
+
+@pytest.mark.parametrize('n_shards', [1, 3, 8])
+def test_parallel_matches_aggregate_users(tables, n_shards):
+    df_t, fx_index = tables
+    result = aggregate_users_parallel(df_t, fx_index, n_shards=n_shards, max_workers=2)
+    pd.testing.assert_frame_equal(result, aggregate_users(df_t, fx_index))
+
+
+def test_parallel_compact(tables):
+    df_t, fx_index = tables
+    df_t = compact_transactions(df_t.copy())
+    result = aggregate_users_parallel(df_t, fx_index, n_shards=4, max_workers=2)
+    pd.testing.assert_frame_equal(result, aggregate_users(df_t, fx_index), check_categorical=False)
+
+
+def test_parallel_spawn(tables):
+    # Spawned workers get nothing from the parent's memory: the columns have to come through shared memory.
+    df_t, fx_index = tables
+    before = set(os.listdir('/dev/shm')) if os.path.isdir('/dev/shm') else set()
+    result = aggregate_users_parallel(df_t, fx_index, n_shards=3, max_workers=2, start_method='spawn')
+    pd.testing.assert_frame_equal(result, aggregate_users(df_t, fx_index))
+    if os.path.isdir('/dev/shm'):
+        assert set(os.listdir('/dev/shm')) <= before
@@ -0,0 +1,51 @@
+import asyncio
+import json
+
+import pandas as pd
+import pytest
+
+from patrol_server import PatrolServer
+
+
+class FakeScorer:
+    """
+    Two known users; scoring 'broken' fails.
+    """
+
+    def __init__(self):
+        self.users = pd.DataFrame({'ID': ['a', 'broken']}).set_index('ID', drop=False)
+
+    def score_users(self, user_ids):
+        if 'broken' in user_ids:
+            raise ValueError('scoring failed')
+        return [0.2] * len(user_ids)
+
+
+def respond(lines):
+    async def run():
+        server = PatrolServer(FakeScorer(), max_wait=0)
+        batcher = asyncio.ensure_future(server.batcher.run())
+        try:
+            return [await server.respond(line) for line in lines]
+        finally:
+            batcher.cancel()
+
+    return asyncio.run(run())
+
+
+def test_known_user():
+    response, = respond([json.dumps({'user_id': 'a'})])
+    assert response['user_id'] == 'a' and response['confidence'] == 0.2 and 'decision' in response
+
+
+@pytest.mark.parametrize('line, error', [('{', 'invalid json'),
+                                         ('5', 'invalid request'),
+                                         ('[]', 'invalid request'),
+                                         ('"x"', 'invalid request'),
+                                         ('{"user_id": []}', 'invalid user id'),
+                                         ('{"user_id": {"a": 1}}', 'invalid user id'),
+                                         ('{"user_id": "b"}', 'unknown user'),
+                                         ('{"user_id": "broken"}', 'scoring failed')])
+def test_bad_requests_get_an_error(line, error):
+    response, = respond([line])
+    assert response['error'] == error
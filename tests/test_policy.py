@@ -0,0 +1,30 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from policy import load_scores, simulate
+
+
+def test_simulate_matches_brute_force():
+    r = np.random.RandomState(0)
+    confidences = np.round(r.rand(500), 2)
+    labels = r.rand(500) < .1
+    thresholds = np.linspace(0, 1, 11)
+    sweep = simulate(confidences, labels, thresholds, thresholds)
+    for row in sweep.itertuples():
+        alerted = confidences > row.alert
+        locked = alerted & (confidences >= row.lock)
+        assert row.alerts == (alerted & ~locked).sum() and row.locks == locked.sum()
+        assert row.recall == (alerted & labels).sum() / labels.sum()
+
+
+def test_load_scores_needs_labels_of_the_scored_users(tmp_path):
+    pd.DataFrame({'ID': ['a', 'b', 'c'], 'Prediction': [0, 1, 0], 'Confidence': [.1, .9, .2]}).to_csv(
+        tmp_path / 'predictions.csv')
+    pd.DataFrame({'user_id': ['b']}).to_csv(tmp_path / 'fraudsters.csv')
+    pd.DataFrame({'user_id': ['x', 'y']}).to_csv(tmp_path / 'other.csv')
+
+    confidences, labels = load_scores(tmp_path / 'predictions.csv', tmp_path / 'fraudsters.csv')
+    assert labels.tolist() == [False, True, False]
+    with pytest.raises(ValueError):
+        load_scores(tmp_path / 'predictions.csv', tmp_path / 'other.csv')
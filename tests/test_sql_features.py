@@ -0,0 +1,84 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from aggregates import aggregate_users
+from cache import read_tables
+from fx import FxRateIndex
+from synthetic import synthetic_tables, write_tables
+from transformations import country_code_lookup, transform_transactions
+
+# A SQLAlchemy URL of a PostgreSQL database, e.g. postgresql+psycopg2://postgres@/postgres. The tests work in a schema
+# of their own, which they drop afterwards.
+DATABASE_URL = os.environ.get('FRAUD_TEST_DATABASE_URL')
+if DATABASE_URL is None:
+    pytest.skip('FRAUD_TEST_DATABASE_URL is not set', allow_module_level=True)
+
+from sqlalchemy import create_engine
+
+from part1 import Base, bulk_load, bulk_load_table, read_chunks
+from sql_features import create_feature_views, sql_aggregates
+
+SCHEMA = 'fraud_features_test'
+
+
+@pytest.fixture(scope='module')
+def loaded(tmp_path_factory):
+    """
+    Synthetic tables loaded in two steps, in a schema of their own: everything but a tenth of the transactions and
+    every transaction of ten users, then first_transactions is created, then the rest is loaded without refreshing it.
+    Returns the engine and the aggregates of the pandas path on all the transactions.
+    """
+
+    directory = str(tmp_path_factory.mktemp('sql'))
+    files = write_tables(synthetic_tables(5000, seed=5), directory)
+    df_t = pd.read_csv(files['transactions'], index_col=0)
+    held_out = df_t['USER_ID'].drop_duplicates().values[:10]
+    late = df_t['USER_ID'].isin(held_out).values | (np.arange(len(df_t)) % 10 == 0)
+    early_path, late_path = os.path.join(directory, 'early.csv'), os.path.join(directory, 'late.csv')
+    df_t[~late].to_csv(early_path)
+    df_t[late].to_csv(late_path)
+
+    admin = create_engine(DATABASE_URL)
+    with admin.begin() as conn:
+        conn.exec_driver_sql('DROP SCHEMA IF EXISTS {} CASCADE'.format(SCHEMA))
+        conn.exec_driver_sql('CREATE SCHEMA {}'.format(SCHEMA))
+    db = create_engine(DATABASE_URL, connect_args={'options': '-csearch_path={}'.format(SCHEMA)})
+    try:
+        Base.metadata.create_all(db)
+        bulk_load(db, dict(files, transactions=early_path))
+        create_feature_views(db)
+        code_lookup = country_code_lookup(pd.read_csv(files['countries'], index_col=False))
+        bulk_load_table(db, 'transactions',
+                        read_chunks(late_path, lambda df: transform_transactions(df, code_lookup), 1000))
+
+        tables = read_tables(files, test_time=False)
+        expected = aggregate_users(tables['transactions'], FxRateIndex.from_frames(tables['fx'], tables['currency']))
+        yield db, expected, held_out
+    finally:
+        db.dispose()
+        with admin.begin() as conn:
+            conn.exec_driver_sql('DROP SCHEMA IF EXISTS {} CASCADE'.format(SCHEMA))
+        admin.dispose()
+
+
+def assert_aggregates_equal(result, expected):
+    result, expected = result.sort_index(), expected.sort_index()
+    pd.testing.assert_frame_equal(result[expected.columns], expected, check_dtype=False, check_index_type=False,
+                                  check_names=False)
+
+
+def test_sql_aggregates_match_pandas(loaded):
+    db, expected, held_out = loaded
+    result = sql_aggregates(db)
+    # The users whose first transaction came after first_transactions was built are still there.
+    assert set(held_out) <= set(result.index)
+    assert_aggregates_equal(result, expected)
+
+
+def test_sql_aggregates_of_some_users(loaded):
+    db, expected, held_out = loaded
+    user_ids = list(held_out) + list(expected.index[::7])
+    assert_aggregates_equal(sql_aggregates(db, user_ids=user_ids), expected.loc[pd.unique(np.asarray(user_ids))])
@@ -0,0 +1,80 @@
+import importlib
+import os
+import sys
+
+import numpy as np
+import pytest
+
+import stages
+from generate_features import generate_features
+from pipeline import FeaturePipeline
+from stages import StageGraph, Stage, code_hash, memoized_features, prune
+from synthetic import synthetic_tables
+from transformations import transform_part1
+
+
+@pytest.fixture(scope='module')
+def tables():
+    t = synthetic_tables(5000, seed=11)
+    df_t, df_u, df_fx, df_c = transform_part1(t['transactions'], t['users'], t['countries'], t['fx'], t['currency'])
+    return df_t, df_u, df_fx, df_c
+
+
+@pytest.mark.parametrize('velocity', [False, True])
+def test_memoized_features_match(tables, tmp_path, velocity):
+    df_t, df_u, df_fx, df_c = tables
+    X = generate_features(df_t.copy(), df_u.copy(), df_fx, df_c, preprocessed=True, velocity=velocity)
+    for status in ['computed', 'cached']:
+        pipeline = FeaturePipeline(velocity=velocity)
+        memoized, graph = memoized_features(df_t, df_u, df_fx, df_c, pipeline, cache_dir=str(tmp_path))
+        np.testing.assert_array_equal(np.asarray(memoized), np.asarray(X))
+        assert {s for name, s, _ in graph.log if name == 'features'} == {status}
+
+
+def test_unlisted_helper_invalidates(tmp_path, monkeypatch):
+    # A project of its own, with a stage function that calls a helper through another one.
+    monkeypatch.setattr(stages, 'PROJECT_DIR', str(tmp_path))
+    monkeypatch.syspath_prepend(str(tmp_path))
+    (tmp_path / 'stage_helpers.py').write_text('SCALE = 2\n\ndef inner(x):\n    return x * SCALE\n')
+    (tmp_path / 'stage_fns.py').write_text('from stage_helpers import inner\n\ndef outer(x):\n'
+                                           '    return [inner(v) for v in x]\n')
+    import stage_fns
+    import stage_helpers
+    try:
+        before = code_hash([stage_fns.outer])
+        for source in ['SCALE = 3\n\ndef inner(x):\n    return x * SCALE\n',
+                       'SCALE = 3\n\ndef inner(x):\n    return x * SCALE + 0\n']:
+            (tmp_path / 'stage_helpers.py').write_text(source)
+            importlib.reload(stage_helpers)
+            importlib.reload(stage_fns)
+            after = code_hash([stage_fns.outer])
+            assert after != before
+            before = after
+    finally:
+        sys.modules.pop('stage_fns', None)
+        sys.modules.pop('stage_helpers', None)
+
+
+def test_prune_keeps_recent_outputs(tmp_path):
+    graph = StageGraph([Stage('double', double, ['x'])], str(tmp_path))
+    directory = tmp_path / 'double'
+    for x in range(4):
+        before = set(os.listdir(directory)) if directory.exists() else set()
+        graph.run(['double'], {'x': np.arange(x + 1)})
+        key, = set(os.listdir(directory)) - before
+        os.utime(directory / key / 'complete', (x + 1, x + 1))
+    os.makedirs(directory / 'partial.tmp')
+    # The first input is used again, so it is recent now.
+    graph.run(['double'], {'x': np.arange(1)})
+
+    # The second and third outputs and the partly written one go.
+    assert prune(str(tmp_path), keep=2) == 3
+    assert len(os.listdir(directory)) == 2
+    graph.log = []
+    for x in [0, 3]:
+        graph.run(['double'], {'x': np.arange(x + 1)})
+    assert [status for _, status, _ in graph.log] == ['cached', 'cached']
+
+
+def double(x):
+    return x * 2
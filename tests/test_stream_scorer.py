@@ -0,0 +1,58 @@
+import io
+import json
+
+import numpy as np
+import pytest
+from sklearn.ensemble import RandomForestClassifier
+
+from action import DECISIONS
+from aggregates import aggregate_users
+from fx import FxRateIndex
+from generate_features import user_frame
+from pipeline import FeaturePipeline
+from stream_scorer import StreamScorer, run
+from synthetic import synthetic_tables
+from transformations import transform_part1, transform_transactions, country_code_lookup
+
+
+@pytest.fixture(scope='module')
+def tables():
+    t = synthetic_tables(10000, seed=19)
+    _, df_users, df_fx, df_currency = transform_part1(None, t['users'], t['countries'], t['fx'], t['currency'])
+    raw = t['transactions'].reset_index(drop=True)
+    df_t = transform_transactions(raw.copy(), country_code_lookup(t['countries']))
+
+    pipeline = FeaturePipeline()
+    frame = user_frame(df_users.copy(), aggregate_users(df_t, FxRateIndex.from_frames(df_fx, df_currency)))
+    X = pipeline.fit(frame).transform(frame)
+    pipeline.clf = RandomForestClassifier(n_estimators=10, random_state=0).fit(X, np.arange(len(X)) % 5 == 0)
+    return raw, df_t, df_users, df_fx, df_currency, t['countries'], pipeline
+
+
+def batch_confidences(pipeline, df_t, df_users, df_fx, df_currency):
+    aggregates = aggregate_users(df_t, FxRateIndex.from_frames(df_fx, df_currency))
+    return pipeline.predict_proba(user_frame(df_users.copy(), aggregates))
+
+
+@pytest.mark.parametrize('n_history', [0, 4000])
+def test_streaming_matches_batch(tables, tmp_path, n_history):
+    raw, df_t, df_users, df_fx, df_currency, df_countries, pipeline = tables
+    path = str(tmp_path / 'pipeline.pkl')
+    pipeline.save(path)
+
+    scorer = StreamScorer.load(df_users, df_fx, df_currency, df_countries, df_history=df_t.iloc[:n_history], path=path)
+    # A StringIO has no file descriptor, and the events are read as they come.
+    events = io.StringIO(raw.iloc[n_history:].to_json(orient='records', lines=True))
+    out = io.StringIO()
+    stats = run(scorer, events, out, max_batch=500)
+
+    assert stats['events'] == len(raw) - n_history and stats['unknown_users'] == 0
+    np.testing.assert_allclose(scorer.confidences, batch_confidences(pipeline, df_t, df_users, df_fx, df_currency),
+                               rtol=0, atol=1e-12)
+    # The last action change reported for a user is their current action.
+    last = {}
+    for line in out.getvalue().splitlines():
+        action = json.loads(line)
+        last[action['user_id']] = DECISIONS.index(action['action'])
+    rows = df_users.reset_index(drop=True).reset_index().set_index('ID')['index']
+    assert last and all(scorer.codes[rows[user]] == code for user, code in last.items())
@@ -0,0 +1,40 @@
+import numpy as np
+import pytest
+
+from aggregates import aggregate_users
+from cache import load_tables
+from fx import FxRateIndex
+from generate_features import generate_features, user_frame
+from pipeline import FeaturePipeline
+from synthetic import synthetic_tables, write_tables
+from train import cached_features, undersample
+
+
+@pytest.fixture(scope='module')
+def files(tmp_path_factory):
+    return write_tables(synthetic_tables(20000, seed=13), str(tmp_path_factory.mktemp('data')))
+
+
+@pytest.mark.parametrize('negatives', [0, 300])
+def test_cached_features_match_in_memory(files, tmp_path, negatives):
+    X, y, pipeline = cached_features(files, negatives=negatives, seed=1, cache_dir=str(tmp_path), mmap=True,
+                                     chunksize=3000)
+    assert isinstance(X, np.memmap)
+
+    df_transactions, df_users, df_fx, df_currency = load_tables(files, test_time=False, cache_dir=str(tmp_path))
+    df_users = undersample(df_users, negatives, seed=1).reset_index(drop=True)
+    expected, expected_y = generate_features(df_transactions, df_users, df_fx, df_currency, test_time=False,
+                                             pipeline=FeaturePipeline())
+    np.testing.assert_array_equal(X, expected)
+    np.testing.assert_array_equal(y, expected_y.values)
+
+    # A second call reads the cache.
+    X_cached, _, _ = cached_features(files, negatives=negatives, seed=1, cache_dir=str(tmp_path))
+    np.testing.assert_array_equal(X_cached, expected)
+
+
+def test_batched_scaler_fit(files, tmp_path):
+    df_transactions, df_users, df_fx, df_currency = load_tables(files, test_time=False, cache_dir=str(tmp_path))
+    X, _ = generate_features(df_transactions, df_users, df_fx, df_currency, test_time=False)
+    frame = user_frame(df_users.copy(), aggregate_users(df_transactions, FxRateIndex.from_frames(df_fx, df_currency)))
+    np.testing.assert_allclose(FeaturePipeline().fit(frame, batch_size=97).transform(frame), X, rtol=0, atol=1e-9)
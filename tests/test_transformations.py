@@ -0,0 +1,72 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from synthetic import synthetic_tables
+from transformations import transform_part1
+
+
+def baseline_transform_part1(df_t, df_u, df_countries, df_fx, df_c, df_f=None, test_time=True):
+    """
+    transform_part1 before it was vectorized, kept as the reference.
+    """
+
+    df_t.loc[df_t['MERCHANT_COUNTRY'].str.len() > 3, 'MERCHANT_COUNTRY'] = 'UNK'
+    df_countries.dropna(inplace=True)
+    df_countries['code3'] = df_countries['code3'].apply(lambda x: x.upper())
+    code_lookup = pd.Series(df_countries['code'].values, index=df_countries['code3']).to_dict()
+    manual_code_lookup = {'ROU': 'RO', 'SRB': 'CS', 'NSW': 'AU', 'MNE': 'CS'}
+    code_lookup = {**code_lookup, **manual_code_lookup}
+    df_t.replace({'MERCHANT_COUNTRY': code_lookup}, inplace=True)
+
+    if test_time == False:
+        frauds = set(df_f['user_id'])
+        df_u['IS_FRAUDSTER'] = False
+        df_u['IS_FRAUDSTER'] = df_u['ID'].apply(lambda x: x in frauds)
+
+    df_u['HAS_EMAIL'] = df_u['HAS_EMAIL'].apply(lambda x: bool(x))
+    df_u['TERMS_VERSION'] = df_u['TERMS_VERSION'].fillna('1900-01-01')
+
+    df_fx.rename(columns={'Unnamed: 0': 'TS'}, inplace=True)
+    df_fx = pd.melt(df_fx, id_vars=['TS']).sort_values(by=['TS', 'variable'])
+    df_fx['BASE_CCY'], df_fx['CCY'] = df_fx['variable'].apply(lambda x: x[:3]), df_fx['variable'].apply(lambda x: x[3:])
+    df_fx.rename(columns={'value': 'RATE'}, inplace=True)
+    df_fx.drop(columns=['variable'], inplace=True)
+
+    df_c.fillna(-1, inplace=True)
+
+    return df_t, df_u.reset_index().drop(columns='index'), df_fx, df_c
+
+
+@pytest.fixture(scope='module')
+def tables():
+    tables = synthetic_tables(20000, seed=3)
+    # A shuffled slice of the fx table with duplicate and missing timestamps.
+    fx = tables['fx'].iloc[:300].sample(frac=1, random_state=0).reset_index(drop=True)
+    fx.loc[[3, 50, 51, 120], 'Unnamed: 0'] = fx.loc[[10, 10, 60, 61], 'Unnamed: 0'].values
+    fx.loc[[7, 200, 201], 'Unnamed: 0'] = np.nan
+    tables['fx'] = fx
+    return tables
+
+
+def run(transform, tables, test_time):
+    return transform(tables['transactions'].copy(), tables['users'].copy(), tables['countries'].copy(),
+                     tables['fx'].copy(), tables['currency'].copy(), df_f=tables['fraudsters'].copy(),
+                     test_time=test_time)
+
+
+@pytest.mark.parametrize('test_time', [True, False])
+def test_transform_part1_matches_baseline(tables, test_time):
+    expected = run(baseline_transform_part1, tables, test_time)
+    result = run(transform_part1, tables, test_time)
+    for name, e, r in zip(['transactions', 'users', 'fx', 'currency'], expected, result):
+        pd.testing.assert_frame_equal(r, e, obj=name)
+
+
+def test_transform_fx_without_duplicates(tables):
+    fx = tables['fx'].dropna(subset=['Unnamed: 0']).drop_duplicates('Unnamed: 0')
+    expected = baseline_transform_part1(tables['transactions'].copy(), tables['users'].copy(),
+                                        tables['countries'].copy(), fx.copy(), tables['currency'].copy())[2]
+    result = transform_part1(None, tables['users'].copy(), tables['countries'].copy(), fx.copy(),
+                             tables['currency'].copy())[2]
+    pd.testing.assert_frame_equal(result, expected)
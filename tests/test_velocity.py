@@ -0,0 +1,55 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from fx import FxRateIndex, to_timestamps, NAT
+from synthetic import synthetic_tables
+from transformations import transform_part1
+from velocity import velocity_features, WINDOWS, VELOCITY_COLUMNS
+
+
+@pytest.fixture(scope='module')
+def tables():
+    t = synthetic_tables(4000, n_users=60, seed=23)
+    df_t, df_u, df_fx, df_c = transform_part1(t['transactions'], t['users'], t['countries'], t['fx'], t['currency'])
+    # A burst of one user: 30 transactions sharing a timestamp, then 10 exactly one window width later.
+    later = pd.Timestamp(df_t['CREATED_DATE'].iloc[0]) + pd.Timedelta(hours=1)
+    df_t.loc[df_t.index[:40], 'USER_ID'] = df_t['USER_ID'].iloc[0]
+    df_t.loc[df_t.index[:30], 'CREATED_DATE'] = df_t['CREATED_DATE'].iloc[0]
+    df_t.loc[df_t.index[30:40], 'CREATED_DATE'] = str(later)
+    # Transactions without a timestamp only count towards the ratios.
+    df_t.loc[df_t.index[-5:], 'CREATED_DATE'] = None
+    return df_t, df_u, FxRateIndex.from_frames(df_fx, df_c)
+
+
+def brute_force(df_t, df_u, fx_index):
+    ts = to_timestamps(df_t['CREATED_DATE'])
+    usd = np.nan_to_num(fx_index.to_usd(df_t['AMOUNT'].values, df_t['CURRENCY'], ts.view('datetime64[ns]')))
+    signup = dict(zip(df_u['ID'].values, to_timestamps(df_u['CREATED_DATE'])))
+    rows = {}
+    for user, idx in df_t.groupby('USER_ID', sort=False).indices.items():
+        row = {'DECLINED_RATIO': (df_t['STATE'].values[idx] == 'DECLINED').mean(),
+               'N_MERCHANT_COUNTRIES': df_t['MERCHANT_COUNTRY'].iloc[idx].dropna().nunique()}
+        timed = idx[ts[idx] != NAT]
+        for w, width in WINDOWS.items():
+            # Window (t - width, t] around every transaction.
+            inside = [(ts[timed] > ts[i] - width) & (ts[timed] <= ts[i]) for i in timed]
+            row['MAX_COUNT_' + w] = max((m.sum() for m in inside), default=0)
+            row['MAX_USD_' + w] = max((usd[timed][m].sum() for m in inside), default=0.)
+        first = ts[timed].min() if len(timed) else NAT
+        row['HOURS_TO_FIRST'] = np.nan if first == NAT or signup.get(user, NAT) == NAT else \
+            (first - signup[user]) / (3600 * 10 ** 9)
+        rows[user] = row
+    return pd.DataFrame.from_dict(rows, orient='index')[VELOCITY_COLUMNS]
+
+
+def test_velocity_matches_brute_force(tables):
+    df_t, df_u, fx_index = tables
+    result = velocity_features(df_t, df_u, fx_index)
+    expected = brute_force(df_t, df_u, fx_index).reindex(result.index)
+    assert len(result) == df_t['USER_ID'].nunique()
+    assert (result['MAX_COUNT_1H'] >= 30).any()
+
+    for c in VELOCITY_COLUMNS:
+        np.testing.assert_allclose(result[c].values.astype(float), expected[c].values.astype(float), rtol=1e-9,
+                                   err_msg=c)
@@ -0,0 +1,329 @@
+import argparse
+import hashlib
+import json
+import os
+import sys
+from time import time
+
+import numpy as np
+import pandas as pd
+from joblib import Parallel, delayed
+
+from sklearn.base import clone
+from sklearn.experimental import enable_halving_search_cv # noqa: F401, enables HalvingGridSearchCV
+from sklearn.model_selection import GridSearchCV, HalvingGridSearchCV, train_test_split
+from sklearn.neighbors import KNeighborsClassifier
+from sklearn.ensemble import RandomForestClassifier
+from sklearn.svm import SVC
+from sklearn.linear_model import LogisticRegression, SGDClassifier
+from sklearn.metrics import precision_score, recall_score, f1_score, roc_auc_score, accuracy_score
+
+from cache import load_tables, source_key, written_directory, is_complete, CACHE_DIR, TRAIN_FILES
+from compiled_model import export_model, compiled_path
+from generate_features import generate_features, write_features
+from pipeline import FeaturePipeline, PIPELINE_PATH
+from transformations import transform_part1, transform_transactions, country_code_lookup
+
+
+REPORT_PATH = 'models/train_report.json'
+
+# Rows of the transactions csv read at a time when building the feature matrix.
+CHUNKSIZE = 10 ** 6
+
+# The model families and grids of part3b_model.ipynb. liblinear was the LogisticRegression default when the notebook
+# was written and is the solver that supports both penalties.
+FAMILIES = {
+    'LR': (LogisticRegression(solver='liblinear'),
+           {'penalty': ['l1', 'l2'], 'C': [0.0001, 0.001, 0.01, 0.1, 1, 10, 100], 'tol': [1e-8, 1e-6, 1e-4]}),
+    'SVM': (SVC(),
+            {'C': [0.5, 0.7, 0.9, 1], 'kernel': ['rbf', 'poly', 'sigmoid', 'linear']}),
+    'KNN': (KNeighborsClassifier(),
+            {'n_neighbors': list(range(1, 10)), 'algorithm': ['auto', 'ball_tree', 'kd_tree', 'brute']}),
+    'RF': (RandomForestClassifier(),
+           {'criterion': ['gini', 'entropy'], 'max_depth': [None, 1, 2, 3], 'min_samples_split': [2, 3, 4, 5],
+            'min_samples_leaf': [1, 2, 3]}),
+}
+
+# What successive halving grows between rounds, the number of training samples unless set here. Forests are cheaper
+# to screen with a few trees on all of the samples; the winner is refitted with the default number of trees.
+HALVING_RESOURCES = {'RF': {'resource': 'n_estimators', 'max_resources': 100}}
+
+# Every module whose code changes the features, so editing one of them invalidates the cached matrices.
+FEATURE_MODULES = ['aggregates.py', 'fx.py', 'generate_features.py', 'pipeline.py', 'velocity.py']
+
+
+def undersample(df_users, negatives, seed):
+    """
+    random_undersample with a seed and any number of non-fraudsters (all of them when negatives is 0).
+    """
+
+    neg = df_users[df_users['IS_FRAUDSTER'] == False]
+    if negatives:
+        neg = neg.sample(negatives, random_state=seed)
+    return pd.concat([neg, df_users[df_users['IS_FRAUDSTER'] == True]])
+
+
+def features_key(files, negatives, seed, velocity=False):
+    h = hashlib.sha256(source_key(files, test_time=False).encode())
+    h.update('{} {}{}'.format(negatives, seed, ' velocity' if velocity else '').encode())
+    for module in FEATURE_MODULES:
+        with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), module), 'rb') as f:
+            h.update(f.read())
+    return h.hexdigest()[:16]
+
+
+def build_features(files, negatives, seed, directory, velocity=False, chunksize=CHUNKSIZE):
+    """
+    Writes the X.npy, y.npy and pipeline.pkl of cached_features to directory. The transactions are streamed
+    chunksize rows at a time and X is written a batch of users at a time (see generate_features.write_features), so
+    neither is ever in memory whole. The velocity features need every transaction at once, so with velocity the
+    tables are loaded and the matrix built in memory. Written through cache.written_directory, so an interrupted build
+    is never loaded.
+    """
+
+    with written_directory(directory) as tmp:
+        pipeline = FeaturePipeline(velocity=velocity)
+        if velocity:
+            df_transactions, df_users, df_fx, df_currency = load_tables(files, test_time=False)
+            df_users = undersample(df_users, negatives, seed).reset_index(drop=True)
+            X, y = generate_features(df_transactions, df_users, df_fx, df_currency, test_time=False, pipeline=pipeline)
+            np.save(os.path.join(tmp, 'X.npy'), X)
+        else:
+            df_countries = pd.read_csv(files['countries'], index_col=False)
+            _, df_users, df_fx, df_currency = transform_part1(None, pd.read_csv(files['users'], index_col=0),
+                                                              df_countries, pd.read_csv(files['fx'], index_col=False),
+                                                              pd.read_csv(files['currency'], index_col=False),
+                                                              df_f=pd.read_csv(files['fraudsters'], index_col=0),
+                                                              test_time=False)
+            df_users = undersample(df_users, negatives, seed).reset_index(drop=True)
+            code_lookup = country_code_lookup(df_countries)
+            chunks = (transform_transactions(df, code_lookup)
+                      for df in pd.read_csv(files['transactions'], index_col=0, chunksize=chunksize))
+            write_features(chunks, df_users, df_fx, df_currency, os.path.join(tmp, 'X.npy'), pipeline=pipeline)
+            y = df_users['IS_FRAUDSTER']
+
+        np.save(os.path.join(tmp, 'y.npy'), y.astype(int).values)
+        pipeline.save(os.path.join(tmp, 'pipeline.pkl'))
+
+
+def cached_features(files=TRAIN_FILES, negatives=300, seed=42, cache_dir=CACHE_DIR, mmap=False, velocity=False,
+                    chunksize=CHUNKSIZE):
+    """
+    The training matrix, labels and fitted FeaturePipeline, built once by build_features and cached under
+    cache_dir/features keyed by the source files, the feature code, the sampling and whether the velocity features
+    are in. With mmap the matrix is memory-mapped instead of read.
+    """
+
+    directory = os.path.join(cache_dir, 'features', features_key(files, negatives, seed, velocity))
+    if not is_complete(directory):
+        build_features(files, negatives, seed, directory, velocity, chunksize)
+    X = np.load(os.path.join(directory, 'X.npy'), mmap_mode='r' if mmap else None)
+    y = np.load(os.path.join(directory, 'y.npy'))
+    return X, y, FeaturePipeline.load(os.path.join(directory, 'pipeline.pkl'))
+
+
+def search(family, X, y, scoring, halving, n_jobs, seed):
+    """
+    Best model of one family. Successive halving fits every candidate with a small resource first (see
+    HALVING_RESOURCES) and only keeps the best third for each larger one, so most of the grid is never fitted in full.
+    """
+
+    estimator, grid = FAMILIES[family]
+    t = time()
+    if halving:
+        cv = HalvingGridSearchCV(estimator, grid, scoring=scoring, factor=3, cv=5, n_jobs=n_jobs, random_state=seed,
+                                 **HALVING_RESOURCES.get(family, {}))
+    else:
+        cv = GridSearchCV(estimator, grid, scoring=scoring, cv=5, n_jobs=n_jobs)
+    cv.fit(X, y)
+    return {'family': family,
+            'estimator': cv.best_estimator_,
+            'params': {k: v for k, v in cv.best_params_.items() if k in grid},
+            'cv_score': cv.best_score_,
+            'candidates': len(cv.cv_results_['params']),
+            'seconds': time() - t}
+
+
+def metrics(clf, X, y):
+    predictions = clf.predict(X)
+    if hasattr(clf, 'predict_proba'):
+        return score_metrics(y, predictions, clf.predict_proba(X)[:, 1])
+    return score_metrics(y, predictions, clf.decision_function(X))
+
+
+def score_metrics(y, predictions, scores):
+    return {'accuracy': accuracy_score(y, predictions),
+            'precision': precision_score(y, predictions),
+            'recall': recall_score(y, predictions),
+            'f1': f1_score(y, predictions),
+            'roc_auc': roc_auc_score(y, scores)}
+
+
+def mini_batches(rows, batch_size, rng):
+    """
+    rows shuffled and cut into mini-batches, each sorted so it is read from a memory-mapped matrix in file order.
+    """
+
+    rows = rng.permutation(rows)
+    for start in range(0, len(rows), batch_size):
+        yield np.sort(rows[start:start + batch_size])
+
+
+def fit_out_of_core(X, y, rows, batch_size=4096, epochs=5, undersample=None, seed=42):
+    """
+    A logistic regression fitted by SGD one mini-batch of rows of X at a time, so only one batch is in memory. The
+    classes are balanced by weighting every sample inversely to its class frequency over rows or, with undersample,
+    by keeping every fraudster of a batch and only that fraction of its non-fraudsters (a fresh draw every epoch).
+    """
+
+    rng = np.random.RandomState(seed)
+    classes = np.array([0, 1])
+    weights = len(rows) / (len(classes) * np.maximum(np.bincount(y[rows], minlength=len(classes)), 1))
+    clf = SGDClassifier(loss='log_loss', random_state=seed)
+    for _ in range(epochs):
+        for batch in mini_batches(rows, batch_size, rng):
+            X_batch, y_batch = np.asarray(X[batch]), y[batch]
+            if undersample is None:
+                clf.partial_fit(X_batch, y_batch, classes=classes, sample_weight=weights[y_batch])
+                continue
+            keep = (y_batch == 1) | (rng.random_sample(len(batch)) < undersample)
+            if keep.any():
+                clf.partial_fit(X_batch[keep], y_batch[keep], classes=classes)
+    return clf
+
+
+def out_of_core_metrics(clf, X, y, rows, batch_size):
+    predictions, scores = [], []
+    for start in range(0, len(rows), batch_size):
+        X_batch = np.asarray(X[rows[start:start + batch_size]])
+        predictions.append(clf.predict(X_batch))
+        scores.append(clf.predict_proba(X_batch)[:, 1])
+    return score_metrics(y[rows], np.concatenate(predictions), np.concatenate(scores))
+
+
+def train_out_of_core(batch_size=4096, epochs=5, undersample=None, seed=42, velocity=False, chunksize=CHUNKSIZE,
+                      pipeline_path=PIPELINE_PATH, report_path=REPORT_PATH):
+    """
+    Trains on every user instead of an undersample (see fit_out_of_core), streaming the memory-mapped training matrix
+    from the feature cache. Reports holdout metrics on 20% of the users, then refits on all of them and saves the
+    model like train does.
+    """
+
+    t = time()
+    X, y, pipeline = cached_features(negatives=0, seed=seed, mmap=True, velocity=velocity, chunksize=chunksize)
+    y = np.asarray(y).astype(int)
+    train_rows, test_rows = train_test_split(np.arange(len(y)), test_size=0.2, random_state=seed, stratify=y)
+    train_rows.sort()
+    test_rows.sort()
+
+    clf = fit_out_of_core(X, y, train_rows, batch_size, epochs, undersample, seed)
+    holdout = out_of_core_metrics(clf, X, y, test_rows, batch_size)
+    print('SGD  holdout f1 {:.3f}  roc auc {:.3f}  {} users in {:.1f} s'.format(holdout['f1'], holdout['roc_auc'],
+                                                                          len(y), time() - t))
+    clf = fit_out_of_core(X, y, np.arange(len(y)), batch_size, epochs, undersample, seed)
+
+    os.makedirs(os.path.dirname(pipeline_path) or '.', exist_ok=True)
+    pipeline.clf = clf
+    pipeline.save(pipeline_path)
+    export_model(clf, compiled_path(pipeline_path), source=pipeline_path)
+
+    report = {'winner': 'SGD',
+              'params': {'batch_size': batch_size, 'epochs': epochs,
+                         'balancing': 'class weights' if undersample is None else 'undersample {}'.format(undersample)},
+              'search': 'out of core',
+              'velocity': velocity,
+              'samples': len(y),
+              'fraudsters': int(y.sum()),
+              'seconds': time() - t,
+              'holdout': holdout}
+    with open(report_path, 'w') as f:
+        json.dump(report, f, indent=1, default=str)
+    print('SGD saved to {} ({:.1f} s)'.format(pipeline_path, time() - t))
+    return clf, report
+
+
+def train(families=tuple(FAMILIES), scoring='f1', halving=True, negatives=300, seed=42, n_jobs=-1, velocity=False,
+          chunksize=CHUNKSIZE, pipeline_path=PIPELINE_PATH, report_path=REPORT_PATH):
+    """
+    Searches every family on 80% of the (cached) training matrix, all families at the same time, picks the best
+    cross-validated score, reports holdout metrics for each, then refits the winner on all of the data and saves it
+    with its FeaturePipeline (used by test.py) and the report.
+    """
+
+    t = time()
+    X, y, pipeline = cached_features(negatives=negatives, seed=seed, velocity=velocity, chunksize=chunksize)
+    X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=0.2, random_state=seed, stratify=y)
+
+    # The families run side by side, and their fits share the remaining cores.
+    cores = os.cpu_count() if n_jobs == -1 else n_jobs
+    inner = max(1, cores // len(families))
+    results = Parallel(n_jobs=min(len(families), cores))(
+        delayed(search)(family, X_train, y_train, scoring, halving, inner, seed) for family in families)
+
+    for r in results:
+        r['holdout'] = metrics(r['estimator'], X_test, y_test)
+        print('{:<4} cv {} {:.3f}  holdout f1 {:.3f}  {} candidates in {:.1f} s'.format(
+            r['family'], scoring, r['cv_score'], r['holdout']['f1'], r['candidates'], r['seconds']))
+    best = max(results, key=lambda r: r['cv_score'])
+
+    # Refit on the full training set, with probabilities for test.py and patrol.
+    params = dict(best['params'], **({'probability': True} if best['family'] == 'SVM' else {}))
+    clf = clone(FAMILIES[best['family']][0]).set_params(**params).fit(X, y)
+
+    os.makedirs(os.path.dirname(pipeline_path) or '.', exist_ok=True)
+    pipeline.clf = clf
+    pipeline.save(pipeline_path)
+
+    # The compiled copy test.py prefers. A winner that cannot be compiled (SVM, KNN) removes the old one, which
+    # belongs to another model.
+    try:
+        export_model(clf, compiled_path(pipeline_path), source=pipeline_path)
+    except ValueError:
+        if os.path.exists(compiled_path(pipeline_path)):
+            os.remove(compiled_path(pipeline_path))
+
+    report = {'winner': best['family'],
+              'params': best['params'],
+              'scoring': scoring,
+              'search': 'successive halving' if halving else 'grid',
+              'velocity': velocity,
+              'samples': len(y),
+              'fraudsters': int(y.sum()),
+              'seconds': time() - t,
+              'families': [{k: v for k, v in r.items() if k != 'estimator'} for r in results]}
+    with open(report_path, 'w') as f:
+        json.dump(report, f, indent=1, default=str)
+    print('{} wins, saved to {} ({:.1f} s)'.format(best['family'], pipeline_path, time() - t))
+    return clf, report
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Searches the model families of part3b_model.ipynb and saves the best.')
+    parser.add_argument('--families', nargs='+', default=list(FAMILIES), choices=list(FAMILIES))
+    parser.add_argument('--scoring', default='f1', help='scikit-learn scorer the search maximises')
+    parser.add_argument('--grid', action='store_true', help='exhaustive grid search instead of successive halving')
+    parser.add_argument('--negatives', type=int, default=300,
+                        help='non-fraudsters sampled for training as in random_undersample, 0 keeps them all')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--n-jobs', type=int, default=-1)
+    parser.add_argument('--chunksize', type=int, default=CHUNKSIZE,
+                        help='rows of the transactions csv read at a time when building the feature matrix')
+    parser.add_argument('--velocity', action='store_true',
+                        help='add the time-window velocity features of velocity.py')
+    parser.add_argument('--out-of-core', action='store_true',
+                        help='train a logistic regression by SGD on every user, streaming the feature matrix')
+    parser.add_argument('--batch-size', type=int, default=4096, help='users per mini-batch with --out-of-core')
+    parser.add_argument('--epochs', type=int, default=5, help='passes over the users with --out-of-core')
+    parser.add_argument('--undersample', type=float, default=None,
+                        help='with --out-of-core, keep this fraction of the non-fraudsters of every mini-batch '
+                             'instead of weighting the classes')
+    args = parser.parse_args()
+
+    if args.out_of_core:
+        train_out_of_core(batch_size=args.batch_size, epochs=args.epochs, undersample=args.undersample, seed=args.seed,
+                          velocity=args.velocity, chunksize=args.chunksize)
+        sys.exit()
+
+    train(families=args.families, scoring=args.scoring, halving=not args.grid, negatives=args.negatives,
+          seed=args.seed, n_jobs=args.n_jobs, velocity=args.velocity, chunksize=args.chunksize)
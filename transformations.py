@@ -6,98 +6,216 @@ from sklearn.preprocessing import LabelEncoder
 from sklearn.preprocessing import OneHotEncoder
 from sklearn.preprocessing import StandardScaler
 
+from fx import FxRateIndex, to_timestamps
+
 import warnings
 warnings.filterwarnings("ignore")
 
 np.random.seed(42)
 
 
-def transform_part1(df_t, df_u, df_countries, df_fx, df_c, df_f=None, test_time=True):
-    """ The transformations needed to part 1 of the project.
+# Compact mode (see compact_frame): these columns are kept as categoricals. TERMS_VERSION is ordered so that its newest
+# version is still its max. The transaction ids, unique per row, are kept as their 128 bits instead (see uuid_halves).
+TRANSACTION_CATEGORIES = ['CURRENCY', 'STATE', 'MERCHANT_CATEGORY', 'MERCHANT_COUNTRY', 'ENTRY_METHOD', 'USER_ID', 'TYPE',
+                          'SOURCE']
+USER_CATEGORIES = ['ID', 'PHONE_COUNTRY', 'STATE', 'COUNTRY', 'KYC']
+ORDERED_USER_CATEGORIES = ['TERMS_VERSION']
+
+
+def country_code_lookup(df_countries):
+    """ Maps 3-letter merchant country codes to the 2-letter codes used for the user countries.
     """
     
-    # Preprocess transactions
-    df_t.loc[df_t['MERCHANT_COUNTRY'].str.len() > 3, 'MERCHANT_COUNTRY'] = 'UNK'
-    df_countries.dropna(inplace=True)
-    df_countries['code3'] = df_countries['code3'].apply(lambda x: x.upper())
-    code_lookup = pd.Series(df_countries['code'].values,index=df_countries['code3']).to_dict()
+    df_countries = df_countries.dropna()
+    code3 = df_countries['code3'].str.upper()
+    code_lookup = pd.Series(df_countries['code'].values,index=code3).to_dict()
     manual_code_lookup = {'ROU': 'RO', 'SRB': 'CS', 'NSW': 'AU', 'MNE': 'CS'}
-    code_lookup = {**code_lookup, **manual_code_lookup}
-    df_t.replace({'MERCHANT_COUNTRY': code_lookup}, inplace=True)
+    return {**code_lookup, **manual_code_lookup}
+
+
+def transform_transactions(df_t, code_lookup):
+    """ Cleans the merchant country column. Works on any chunk of the transactions table.
+    """
     
-    # Preprocess users
-    if test_time==False:
-        frauds = set(df_f['user_id'])
-        df_u['IS_FRAUDSTER'] = False
-        df_u['IS_FRAUDSTER'] = df_u['ID'].apply(lambda x: x in frauds)
+    # Each distinct country is cleaned once: codes longer than 3 characters become 'UNK', then known 3-letter codes are
+    # mapped to 2-letter ones. Missing values are kept as they are.
+    values = df_t['MERCHANT_COUNTRY'].values
+    codes, uniques = pd.factorize(values)
+    cleaned = ['UNK' if isinstance(c, str) and len(c) > 3 else c for c in uniques]
+    # The extra trailing entry is picked up by the -1 code of missing values.
+    mapped = np.array([code_lookup.get(c, c) for c in cleaned] + [None], dtype=object)
+    df_t['MERCHANT_COUNTRY'] = np.where(codes >= 0, mapped[codes], values)
+    return df_t
+
+
+def transform_users(df_u, df_f=None):
+    """ Adds the fraudster labels (when df_f is given) and cleans HAS_EMAIL and TERMS_VERSION.
+    Works on any chunk of the users table.
+    """
+    
+    if df_f is not None:
+        df_u['IS_FRAUDSTER'] = df_u['ID'].isin(df_f['user_id']).values
         
-    df_u['HAS_EMAIL'] = df_u['HAS_EMAIL'].apply(lambda x: bool(x))
+    df_u['HAS_EMAIL'] = df_u['HAS_EMAIL'].astype(bool)
     df_u['TERMS_VERSION'] = df_u['TERMS_VERSION'].fillna('1900-01-01')
+    return df_u
+
+
+def transform_fx(df_fx):
+    """ Unpivots the wide fx rates table into (TS, RATE, BASE_CCY, CCY) rows. Works on any chunk of rows.
+    """
     
-    # Preprocess fx_rates
     df_fx.rename(columns={'Unnamed: 0': 'TS'}, inplace=True)
-    df_fx = pd.melt(df_fx, id_vars=['TS']).sort_values(by=['TS', 'variable']) # Unpivots df_fx to get it in long form.
-    df_fx['BASE_CCY'], df_fx['CCY'] = df_fx['variable'].apply(lambda x: x[:3]), df_fx['variable'].apply(lambda x: x[3:])
-    df_fx.rename(columns={'value': 'RATE'}, inplace=True)
-    df_fx.drop(columns=['variable'], inplace=True)
+    pairs = np.array([c for c in df_fx.columns if c != 'TS'], dtype=object)
+    n, k = len(df_fx), len(pairs)
     
-    # Preprocess currency_details
+    # Same rows as melting the rate columns and sorting by (TS, pair), without sorting the long table: the rows of the
+    # wide table are put in TS order (missing TS last) and its columns in pair order, so reading it row by row gives
+    # the sorted long form. The index is the one of the melted row: column position * n + row position.
+    ts_codes = pd.factorize(df_fx['TS'].values, sort=True)[0]
+    ts_codes = np.where(ts_codes < 0, n, ts_codes)
+    rows = np.argsort(ts_codes, kind='stable')
+    cols = np.argsort(pairs, kind='stable')
+    order = slice(None)
+    if len(np.unique(ts_codes)) < n:
+        # Rows sharing a TS are interleaved pair by pair, as in the sorted long table.
+        order = np.lexsort((np.tile(np.arange(k), n), np.repeat(ts_codes[rows], k)))
+    
+    # The pair names are split once, not once per row.
+    base = np.array([p[:3] for p in pairs], dtype=object)
+    ccy = np.array([p[3:] for p in pairs], dtype=object)
+    return pd.DataFrame({'TS': np.repeat(df_fx['TS'].values[rows], k)[order],
+                         'RATE': df_fx[list(pairs)].values[rows][:, cols].ravel()[order],
+                         'BASE_CCY': np.tile(base[cols], n)[order],
+                         'CCY': np.tile(ccy[cols], n)[order]},
+                        index=(cols[np.newaxis, :] * n + rows[:, np.newaxis]).ravel()[order])
+
+
+def transform_currency(df_c):
     df_c.fillna(-1, inplace=True)
+    return df_c
+
+
+def transform_part1(df_t, df_u, df_countries, df_fx, df_c, df_f=None, test_time=True):
+    """ The transformations needed to part 1 of the project.
+    """
+    
+    # Preprocess transactions (df_t can be None when the transactions are streamed, see generate_features)
+    if df_t is not None:
+        df_t = transform_transactions(df_t, country_code_lookup(df_countries))
+    
+    # Preprocess users
+    df_u = transform_users(df_u, df_f=None if test_time else df_f)
+    
+    # Preprocess fx_rates
+    df_fx = transform_fx(df_fx)
+    
+    # Preprocess currency_details
+    df_c = transform_currency(df_c)
     
     return df_t, df_u.reset_index().drop(columns='index'), df_fx, df_c
     
     
-def query2(df_users, df_transactions, df_fx, df_currency):
+def compact_frame(df, categories, ordered=()):
+    """
+    Compact mode: the categories columns become categoricals (integer codes plus one copy of every distinct value, in
+    order of appearance; sorted for the ordered ones), integers are downcast to the smallest type that holds them and
+    floats are stored as float32. Integer amounts stay exact, so the features do not change. Works in place and
+    returns df.
+    """
+    
+    for c in df.columns:
+        if c in categories or c in ordered:
+            if not isinstance(df[c].dtype, pd.CategoricalDtype):
+                df[c] = pd.Categorical.from_codes(*pd.factorize(df[c].values))
+            if c in ordered and not df[c].cat.ordered:
+                df[c] = df[c].cat.reorder_categories(np.sort(df[c].cat.categories.values), ordered=True)
+        elif pd.api.types.is_integer_dtype(df[c].dtype) and not pd.api.types.is_bool_dtype(df[c].dtype):
+            df[c] = pd.to_numeric(df[c], downcast='integer')
+        elif pd.api.types.is_float_dtype(df[c].dtype):
+            df[c] = df[c].astype('float32')
+    return df
+
+
+def uuid_halves(values):
+    """
+    UUID strings as their 128 bits in two uint64 arrays, the high and the low half, read from the characters of a
+    fixed-width unicode array without a Python object per row. uuid.UUID(int=(int(hi) << 64) | int(lo)) gives the
+    UUID back. Raises ValueError when any value is not a UUID string.
+    """
+    
+    strings = np.asarray(values, dtype=str)
+    if len(strings) and (strings.dtype != 'U36' or (np.char.str_len(strings) != 36).any()):
+        raise ValueError('Not a UUID string')
+    chars = strings.astype('U36').view('uint32').reshape(-1, 36)
+    digits = np.delete(chars, [8, 13, 18, 23], axis=1)
+    nibbles = np.where(digits >= ord('a'), digits - (ord('a') - 10),
+                       np.where(digits >= ord('A'), digits - (ord('A') - 10), digits - ord('0')))
+    if (chars[:, [8, 13, 18, 23]] != ord('-')).any() or (nibbles > 15).any():
+        raise ValueError('Not a UUID string')
+    
+    halves = []
+    for part in [nibbles[:, :16], nibbles[:, 16:]]:
+        half = np.zeros(len(chars), dtype='uint64')
+        for i in range(16):
+            half = (half << np.uint64(4)) | part[:, i].astype('uint64')
+        halves.append(half)
+    return halves
+
+
+def compact_ids(df_t, hi, lo):
+    """
+    Replaces the ID column of df_t by its ID_HI and ID_LO halves (see uuid_halves), in place.
+    """
+    
+    at = df_t.columns.get_loc('ID')
+    df_t.drop(columns='ID', inplace=True)
+    df_t.insert(at, 'ID_HI', hi)
+    df_t.insert(at + 1, 'ID_LO', lo)
+    return df_t
+
+
+def compact_transactions(df_t):
+    if 'ID' in df_t:
+        try:
+            compact_ids(df_t, *uuid_halves(df_t['ID'].values))
+        except ValueError:
+            # Ids that are not all UUIDs stay a categorical.
+            return compact_frame(df_t, TRANSACTION_CATEGORIES + ['ID'])
+    return compact_frame(df_t, TRANSACTION_CATEGORIES)
+
+
+def compact_users(df_u):
+    return compact_frame(df_u, USER_CATEGORIES, ordered=ORDERED_USER_CATEGORIES)
+
+
+def query2(df_users, df_transactions, df_fx, df_currency, fx_index=None):
     """ 
-    Just does what we did in query 2.
-    """
-    
-    df_currency = df_currency[df_currency['exponent'] != -1] 
-    def convert_to_cash(amount, exponent):
-        return amount / 10**exponent
-    CURRENCY_MAP = pd.Series(df_currency['exponent'].values, index=df_currency['currency']).to_dict()
-    df_transactions['AMOUNT'] = df_transactions.apply(lambda x: convert_to_cash(x['AMOUNT'], CURRENCY_MAP[x['CURRENCY']]), axis=1)
-    to_convert = df_transactions[df_transactions['CURRENCY'] != 'USD']
-    CCYs = to_convert['CURRENCY'].unique()
-    df_fx = df_fx[(df_fx['BASE_CCY'] == 'USD') & (df_fx['CCY'].isin(CCYs))]
-    to_convert['CREATED_DATE'] = to_convert['CREATED_DATE'].apply(lambda x: x.split('.', 1)[0])
-    to_convert['CREATED_DATE'] = to_convert['CREATED_DATE'].apply(lambda x: datetime.strptime(x, '%Y-%m-%d %H:%M:%S'))
-    df_fx['TS'] = df_fx['TS'].apply(lambda x: datetime.strptime(x, '%Y-%m-%d %H:%M:%S'))
-    df_fx['TS'] = df_fx['TS'].apply(lambda x: x.date())
-    to_convert['CREATED_DATE'] = to_convert['CREATED_DATE'].apply(lambda x: x.date())
-    fx_grouped = df_fx.groupby(['BASE_CCY', 'CCY', 'TS'])[['RATE']].mean()
-    fx_grouped = pd.DataFrame(fx_grouped.to_records())
-    fx_grouped.rename(columns={'CCY': 'CURRENCY', 'TS' : 'CREATED_DATE'}, inplace=True)
-    to_convert = pd.merge(to_convert, fx_grouped, on=['CURRENCY', 'CREATED_DATE'], how='left')
-    def mult(x, y):
-        return x*y
-    to_convert['AMOUNT_USD'] = to_convert.apply(lambda x: mult(x['AMOUNT'], x['RATE']), axis=1)
-    df_transactions = pd.merge(df_transactions, to_convert, on=['ID'], how='left')
-    df_transactions['AMOUNT_USD'].fillna(df_transactions['AMOUNT_x'], inplace=True)
-    df_transactions = df_transactions[['CURRENCY_x',
-                                       'AMOUNT_x',
-                                       'AMOUNT_USD',
-                                       'STATE_x',
-                                       'CREATED_DATE_x',
-                                       'MERCHANT_CATEGORY_x',
-                                       'MERCHANT_COUNTRY_x',
-                                       'ENTRY_METHOD_x',
-                                       'USER_ID_x',
-                                       'TYPE_x',
-                                       'SOURCE_x',
-                                       'ID']]
-    df_transactions.rename(columns={'CURRENCY_x': 'CURRENCY',
-                                     'AMOUNT_x': 'AMOUNT',
-                                     'STATE_x': 'STATE',
-                                     'CREATED_DATE_x': 'CREATED_DATE',
-                                     'MERCHANT_CATEGORY_x': 'MERCHANT_CATEGORY',
-                                     'MERCHANT_COUNTRY_x': 'MERCHANT_COUNTRY',
-                                     'ENTRY_METHOD_x': 'ENTRY_METHOD',
-                                     'USER_ID_x': 'USER_ID',
-                                     'TYPE_x': 'TYPE',
-                                     'SOURCE_x': 'SOURCE'}, inplace=True)
-    
-    first_transactions = df_transactions.sort_values('CREATED_DATE').groupby('USER_ID', as_index=False).first()
+    Just does what we did in query 2. Amounts are converted with the latest rate before each transaction (see fx.py),
+    pass fx_index to reuse an index that is already built.
+    """
+    
+    if fx_index is None:
+        fx_index = FxRateIndex.from_frames(df_fx, df_currency)
+    
+    # In compact mode the transaction id is the ID_HI and ID_LO pair (see compact_transactions).
+    ids = ['ID'] if 'ID' in df_transactions else ['ID_HI', 'ID_LO']
+    df_transactions = df_transactions[['CURRENCY',
+                                       'AMOUNT',
+                                       'STATE',
+                                       'CREATED_DATE',
+                                       'MERCHANT_CATEGORY',
+                                       'MERCHANT_COUNTRY',
+                                       'ENTRY_METHOD',
+                                       'USER_ID',
+                                       'TYPE',
+                                       'SOURCE'] + ids]
+    amount_usd = fx_index.to_usd(df_transactions['AMOUNT'].values, df_transactions['CURRENCY'], df_transactions['CREATED_DATE'])
+    df_transactions['AMOUNT'] = fx_index.to_cash(df_transactions['AMOUNT'].values, df_transactions['CURRENCY'])
+    df_transactions.insert(2, 'AMOUNT_USD', amount_usd)
+    
+    first_transactions = (df_transactions.sort_values('CREATED_DATE')
+                          .groupby('USER_ID', as_index=False, observed=True).first())
     fin = first_transactions[(first_transactions['STATE'] == 'COMPLETED') & (first_transactions['AMOUNT_USD'] >= 10)]
     fin['FIRST_SUCCESS'] = True
     fin = fin[['USER_ID', 'FIRST_SUCCESS']]
@@ -106,7 +224,7 @@ def query2(df_users, df_transactions, df_fx, df_currency):
     ret['FIRST_SUCCESS'] = ret['FIRST_SUCCESS'].fillna(False)
     ret['FIRST_SUCCESS'] = ret['FIRST_SUCCESS'].apply(lambda x: int(x))
     
-    amount = df_transactions.groupby('USER_ID')['AMOUNT_USD'].max()
+    amount = df_transactions.groupby('USER_ID', observed=True)['AMOUNT_USD'].max()
     amount = amount[amount < 5000]
     ret = pd.merge(ret, pd.DataFrame(amount), left_on='ID', right_on='USER_ID', how='left')
     ret.fillna(0, inplace=True)
@@ -120,11 +238,8 @@ def date_to_numerical(df_users):
     I make the assumption is the first transaction on Revolut.
     """
     
-    df_users['CREATED_DATE'] = df_users['CREATED_DATE'].apply(lambda x: x.split(' ', 1)[0])
-    df_users['CREATED_DATE'] = df_users['CREATED_DATE'].apply(lambda x: datetime.strptime(x, '%Y-%m-%d'))
-    df_users['CREATED_DATE'] = df_users['CREATED_DATE'].apply(lambda x: x.date())
-    first_date = df_users['CREATED_DATE'].sort_values().iloc[0]
-    df_users['CREATED_DATE'] = df_users['CREATED_DATE'].apply(lambda x: (x-first_date).days)
+    days = to_timestamps(df_users['CREATED_DATE']) // (24 * 3600 * 10**9)
+    df_users['CREATED_DATE'] = days - days.min()
     return df_users
 
 def terms_version_boolean(df_users):
@@ -138,8 +253,10 @@ def terms_version_boolean(df_users):
 
 def max_count_extractor(df_users, df_transactions, attribute):
     
-    grouped=df_transactions.groupby(['USER_ID', attribute]).count()
-    grouped = pd.DataFrame(grouped.to_records())
+    grouped=df_transactions.groupby(['USER_ID', attribute], observed=True).count()
+    # Groups in order of the values, as for object columns, so ties below are broken the same way for categoricals.
+    grouped = pd.DataFrame(grouped.to_records()).astype({'USER_ID': object, attribute: object})
+    grouped = grouped.sort_values(['USER_ID', attribute], kind='mergesort')
     grouped = grouped.sort_values('CURRENCY', ascending=False).groupby('USER_ID', as_index=False).first()[['USER_ID', attribute]]
     res = pd.merge(df_users, grouped, left_on='ID', right_on='USER_ID', how='left')
     res.drop(columns='USER_ID', inplace=True)
@@ -182,8 +299,16 @@ def KYC_transform(df_users):
     df_users[['F1', 'F2', 'F3', 'F4']] = pd.DataFrame(one_hot_encoded, index=df_users.index)
     return df_users
 
-def TRANSACTION_TYPE(df_users, df_transactions):
-    res = max_count_extractor(df_users, df_transactions, 'TYPE')
+def TRANSACTION_TYPE(df_users, df_transactions=None):
+    """
+    One-hot encode the most frequent transaction type. Uses the TYPE column of df_users when it is already there
+    (see transaction_features).
+    """
+    
+    if df_transactions is None:
+        res = df_users
+    else:
+        res = max_count_extractor(df_users, df_transactions, 'TYPE')
     vals = res['TYPE'].fillna('NaN')
     label_encoder = LabelEncoder()
     integer_encoded = label_encoder.fit_transform(vals)
@@ -194,7 +319,7 @@ def TRANSACTION_TYPE(df_users, df_transactions):
     return df_users
 
 def ID_CHECK(df_users, df_transactions):
-    user_ids = set(df_transactions.groupby('USER_ID')['USER_ID'].first().values)
+    user_ids = set(df_transactions.groupby('USER_ID', observed=True)['USER_ID'].first().values)
     def userid_in_id(ID):
         return ID in user_ids
     id_check = df_users.apply(lambda x: userid_in_id(x['ID']), axis=1)
@@ -203,6 +328,25 @@ def ID_CHECK(df_users, df_transactions):
     return df_users 
 
 
+def transaction_features(df_users, aggregates):
+    """
+    FIRST_SUCCESS, AMOUNT_USD, COUNTRIES_MATCH, IS_MINOS and ID_CHECK from the per-user aggregates of aggregate_users.
+    Same definitions as query2, countries_match, is_MINOS and ID_CHECK; the TYPE mode is added for TRANSACTION_TYPE.
+    """
+    
+    agg = aggregates.reindex(df_users['ID'].values)
+    agg.index = df_users.index
+    
+    df_users['FIRST_SUCCESS'] = ((agg['FIRST_STATE'] == 'COMPLETED') & (agg['FIRST_AMOUNT_USD'] >= 10)).astype(int)
+    df_users['AMOUNT_USD'] = agg['AMOUNT_USD'].where(agg['AMOUNT_USD'] < 5000, 0)
+    df_users['BIRTH_YEAR'] = df_users['BIRTH_YEAR'].fillna(0) # query2 used to fill every missing value with 0.
+    df_users['COUNTRIES_MATCH'] = (agg['MERCHANT_COUNTRY'] == df_users['COUNTRY']).astype(int)
+    df_users['IS_MINOS'] = (agg['SOURCE'] == 'MINOS').astype(int)
+    df_users['TYPE'] = agg['TYPE']
+    df_users['ID_CHECK'] = agg['N_TRANSACTIONS'].notna().astype(int)
+    return df_users
+
+
 def random_undersample(df_users):
     neg_sub = df_users[df_users['IS_FRAUDSTER'] == False].sample(300) 
     pos_sub = df_users[df_users['IS_FRAUDSTER'] == True]
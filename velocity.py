@@ -0,0 +1,94 @@
+import numpy as np
+import pandas as pd
+
+from aggregates import group_starts
+from fx import to_timestamps, NAT
+
+
+# Trailing windows of the velocity features, in nanoseconds.
+WINDOWS = {'1H': 3600 * 10 ** 9, '24H': 24 * 3600 * 10 ** 9, '7D': 7 * 24 * 3600 * 10 ** 9}
+
+VELOCITY_COLUMNS = (['MAX_COUNT_' + w for w in WINDOWS] + ['MAX_USD_' + w for w in WINDOWS] +
+                    ['DECLINED_RATIO', 'N_MERCHANT_COUNTRIES', 'HOURS_TO_FIRST'])
+
+
+def time_keys(user_codes, ts):
+    """
+    One int64 key per transaction that sorts by user, then time: the user code times the time span plus the time
+    since the first transaction. The time unit is the finest of ns, us, ms and s for which the keys fit in int64.
+    Returns the keys and the unit in nanoseconds.
+    """
+
+    span = int(ts.max()) - int(ts.min()) + 1 + max(WINDOWS.values())
+    n_users = int(user_codes.max()) + 1
+    unit = next((u for u in [1, 10 ** 3, 10 ** 6] if n_users * (span // u + 1) < 2 ** 62), 10 ** 9)
+    return user_codes.astype('int64') * (span // unit + 1) + (ts - ts.min()) // unit, unit
+
+
+def velocity_features(df_transactions, df_users, fx_index):
+    """
+    Per-user features of the CREATED_DATE sequence, indexed by user ID (users without transactions are absent):
+    the largest number of transactions and USD amount within any trailing 1h, 24h and 7d window, the share of
+    DECLINED transactions, the number of distinct merchant countries and the hours from signup to the first
+    transaction.
+
+    The transactions are sorted by (user, time) once; the start of every window is then one searchsorted over all
+    transactions (see time_keys) and the window sums are differences of one cumulative sum, so there is no loop over
+    users and the cost is O(n log n). Transactions without a valid timestamp only count towards the ratios.
+    """
+
+    user_codes, user_ids = pd.factorize(df_transactions['USER_ID'])
+    ts = to_timestamps(df_transactions['CREATED_DATE'])
+    amount_usd = fx_index.to_usd(df_transactions['AMOUNT'].values, df_transactions['CURRENCY'],
+                                 ts.view('datetime64[ns]'))
+    res = {}
+
+    declined = np.asarray(df_transactions['STATE'] == 'DECLINED')
+    n = np.bincount(user_codes, minlength=len(user_ids))
+    res['DECLINED_RATIO'] = np.bincount(user_codes, weights=declined, minlength=len(user_ids)) / n
+
+    country_codes, countries = pd.factorize(df_transactions['MERCHANT_COUNTRY'])
+    valid = country_codes >= 0
+    pairs = np.unique(user_codes[valid].astype('int64') * len(countries) + country_codes[valid])
+    res['N_MERCHANT_COUNTRIES'] = np.bincount(pairs // max(len(countries), 1), minlength=len(user_ids))
+
+    for w in WINDOWS:
+        res['MAX_COUNT_' + w], res['MAX_USD_' + w] = np.zeros(len(user_ids), dtype='int64'), np.zeros(len(user_ids))
+    res['HOURS_TO_FIRST'] = np.full(len(user_ids), np.nan)
+
+    timed = ts != NAT
+    if timed.any():
+        # Sort once by (user, time).
+        codes, ts, usd = user_codes[timed], ts[timed], np.nan_to_num(amount_usd[timed])
+        keys, unit = time_keys(codes, ts)
+        order = np.argsort(keys, kind='stable')
+        keys, codes, ts, usd = keys[order], codes[order], ts[order], usd[order]
+        starts = group_starts(codes)
+        users = codes[starts]
+        cumulative = np.concatenate([[0.], np.cumsum(usd)])
+        positions = np.arange(len(keys))
+
+        for w, width in WINDOWS.items():
+            # Window (t - width, t]. The keys of the previous user are more than a window away, so it never reaches
+            # into them.
+            first = np.searchsorted(keys, keys - width // unit, side='right')
+            res['MAX_COUNT_' + w][users] = np.maximum.reduceat(positions - first + 1, starts)
+            res['MAX_USD_' + w][users] = np.maximum.reduceat(cumulative[positions + 1] - cumulative[first], starts)
+
+        signup = to_timestamps(df_users['CREATED_DATE'])
+        rows = pd.Index(df_users['ID'].values).get_indexer(np.asarray(user_ids, dtype=object)[users])
+        signup = np.where(rows >= 0, signup[rows], NAT)
+        res['HOURS_TO_FIRST'][users] = np.where(signup == NAT, np.nan, (ts[starts] - signup) / (3600 * 10 ** 9))
+
+    return pd.DataFrame(res, index=pd.Index(user_ids, name='USER_ID'))[VELOCITY_COLUMNS]
+
+
+def add_velocity(df_users, velocity):
+    """
+    The VELOCITY_COLUMNS of velocity_features on df_users, 0 for users without transactions.
+    """
+
+    features = velocity.reindex(df_users['ID'].values)
+    for c in VELOCITY_COLUMNS:
+        df_users[c] = features[c].fillna(0).values
+    return df_users